@@ -25,15 +25,18 @@ local CortexAPI = {}
 --- Send a chat message to Cortex and get NPC response
 -- @param message string: Player's message
 -- @param speaker string: Player name (optional)
+-- @param npcId string: NPC identifier; each NPC keeps its own memories (optional)
 -- @return table: {reply, emotion, resonance, memories_recalled}
-function CortexAPI.chat(message, speaker)
+function CortexAPI.chat(message, speaker, npcId)
     speaker = speaker or "Player"
+    npcId = npcId or "default"
     
     local response = http.post(
         CORTEX_URL .. "/chat",
         textutils.serialiseJSON({
             text = message,
-            speaker = speaker
+            speaker = speaker,
+            npc_id = npcId
         }),
         {["Content-Type"] = "application/json"}
     )
@@ -49,17 +52,23 @@ end
 
 --- Inject game context into Cortex
 -- @param context table: Game state information
-function CortexAPI.inject(context)
+-- @param npcId string: NPC identifier (optional)
+function CortexAPI.inject(context, npcId)
     http.post(
         CORTEX_URL .. "/inject",
-        textutils.serialiseJSON({info = context}),
+        textutils.serialiseJSON({info = context, npc_id = npcId or "default"}),
         {["Content-Type"] = "application/json"}
     )
 end
 
---- Reset NPC memory
-function CortexAPI.forget()
-    http.post(CORTEX_URL .. "/forget", "{}", {["Content-Type"] = "application/json"})
+--- Reset NPC context and short-term memory
+-- @param npcId string: NPC identifier (optional)
+function CortexAPI.forget(npcId)
+    http.post(
+        CORTEX_URL .. "/forget",
+        textutils.serialiseJSON({npc_id = npcId or "default"}),
+        {["Content-Type"] = "application/json"}
+    )
 end
 
 -- ============================================
@@ -129,7 +138,7 @@ function NPCController.new(npcName)
     }
     
     function self:speak(playerMessage, playerName)
-        local result = CortexAPI.chat(playerMessage, playerName)
+        local result = CortexAPI.chat(playerMessage, playerName, self.name)
         
         -- Update NPC state based on emotion
         self.lastEmotion = result.emotion
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence, Union
+
+import numpy as np
+
+import config
+
+TokenKey = Union[str, bytes]
+
+
+class TokenCodebook:
+    """
+    トークン → 超次元ベクトル (Hypervector) のコードブック。
+
+    各トークンのベクトルは、シードを前置した SHAKE-256 (可変長出力ハッシュ) で
+    トークンのバイト列から直接導出します。Python の hash() と違い、プロセス間・再起動間で
+    完全に決定的なので、永続化された LTM との照合が壊れません。
+    ベクトルは 1bit/次元 のパック形式 (4096dim → 512 bytes, bit=1 が +1) で保持します。
+
+    - 文字列トークン: 上限付き LRU キャッシュ
+    - トークンID: 語彙全体を事前計算した .npy ファイルを mmap で共有 (attach_vocab)
+    """
+
+    def __init__(
+        self,
+        hdc_dim: int = config.HDC_DIM,
+        seed: int = 42,
+        cache_size: int = config.CODEBOOK_CACHE_SIZE,
+    ):
+        """
+        Args:
+            hdc_dim: HDCベクトルの次元数 (8の倍数)
+            seed: ハッシュの鍵となるシード
+            cache_size: 文字列トークン用 LRU の最大行数
+        """
+        if hdc_dim % 8 != 0:
+            raise ValueError(f"hdc_dim must be a multiple of 8 (got {hdc_dim})")
+
+        self.hdc_dim = hdc_dim
+        self.row_bytes = hdc_dim // 8
+        self.seed = seed
+        self.cache_size = cache_size
+
+        # 固定長の鍵を前置するので、トークン同士の連結衝突は起きない
+        self._key = b"cortex-hdc" + seed.to_bytes(8, "little", signed=False)
+        self._cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 語彙テーブル (attach_vocab 後に有効)
+        self.vocab_table: Optional[np.ndarray] = None
+
+    # =========================================
+    # 行の導出
+    # =========================================
+
+    @staticmethod
+    def _to_bytes(token: TokenKey) -> bytes:
+        if isinstance(token, bytes):
+            return token
+        return token.encode("utf-8", errors="surrogatepass")
+
+    def derive(self, token: TokenKey) -> np.ndarray:
+        """トークンのパック済みベクトル (row_bytes,) uint8 をハッシュから生成する"""
+        digest = hashlib.shake_256(self._key + self._to_bytes(token)).digest(
+            self.row_bytes
+        )
+        return np.frombuffer(digest, dtype=np.uint8)
+
+    def packed(self, token: TokenKey) -> np.ndarray:
+        """LRU キャッシュ経由でパック済みベクトルを取得する"""
+        key = self._to_bytes(token)
+        with self._lock:
+            row = self._cache.get(key)
+            if row is not None:
+                self._cache.move_to_end(key)
+                return row
+
+        row = self.derive(key)
+
+        with self._lock:
+            self._cache[key] = row
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return row
+
+    def packed_rows(self, tokens: Sequence[TokenKey]) -> np.ndarray:
+        """複数トークンの行を (k, row_bytes) 行列として集める (Gather)"""
+        if not tokens:
+            return np.empty((0, self.row_bytes), dtype=np.uint8)
+        return np.stack([self.packed(t) for t in tokens])
+
+    # =========================================
+    # 語彙テーブル (トークンID → 行, mmap共有)
+    # =========================================
+
+    def attach_vocab(
+        self, path: str, n_vocab: int, piece_fn: Callable[[int], bytes]
+    ) -> np.ndarray:
+        """
+        語彙全体のコードブックを .npy ファイルとして mmap する。
+        ファイルが無い・形が合わない・シードが違う場合はその場で構築する。
+
+        Args:
+            path: コードブックファイルのパス
+            n_vocab: 語彙サイズ
+            piece_fn: トークンID → トークンのバイト列 (detokenize)
+
+        Returns:
+            (n_vocab, row_bytes) の読み取り専用 memmap
+        """
+        table = None
+        if os.path.exists(path):
+            try:
+                table = np.load(path, mmap_mode="r")
+                if table.shape != (n_vocab, self.row_bytes) or not np.array_equal(
+                    table[0], self.derive(piece_fn(0))
+                ):
+                    table = None  # 別モデル・別シードのファイル
+            except (ValueError, OSError):
+                table = None
+
+        if table is None:
+            self.build_vocab(path, n_vocab, piece_fn)
+            table = np.load(path, mmap_mode="r")
+
+        self.vocab_table = table
+        return table
+
+    def build_vocab(
+        self, path: str, n_vocab: int, piece_fn: Callable[[int], bytes]
+    ) -> None:
+        """語彙全体の行を計算してファイルに書き出す (一時ファイル経由でアトミックに置換)"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        table = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.uint8, shape=(n_vocab, self.row_bytes)
+        )
+        for token_id in range(n_vocab):
+            table[token_id] = self.derive(piece_fn(token_id))
+        table.flush()
+        del table
+        os.replace(tmp_path, path)
+
+    def packed_ids(self, token_ids: Sequence[int]) -> np.ndarray:
+        """トークンIDの行を語彙テーブルから集める (Gather)"""
+        if self.vocab_table is None:
+            raise RuntimeError("Vocabulary codebook is not attached")
+        return np.asarray(self.vocab_table[np.asarray(token_ids, dtype=np.int64)])
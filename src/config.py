@@ -12,10 +12,87 @@ BRAIN_FILENAME = "my_agent.brain"
 HDC_DIM = 4096  # Hyperdimensional Vector Size
 EMBED_DIM_DETECT = 1536  # Default fallback embedding size for Qwen2.5-1.5B
 CTX_SIZE = 4096  # Context Window
+SHARED_MODEL = True  # 生成と埋め込みで1つのモデル (重み・KV) を共有する
+EMBED_CTX_SIZE = 512  # 共有モードで埋め込み専用に作る小さなコンテキストの長さ
+
+# Startup
+WARMUP = True  # 起動時にペルソナを prefill しておく (KV スナップショット)
+WARMUP_PREFAULT = True  # モデルファイルを先読みして mmap のページフォルトを減らす
+
+# Hippocampus Codebook
+CODEBOOK_FILENAME = "codebook.npy"  # 語彙全体のパック済みトークンベクトル表 (mmap)
+CODEBOOK_CACHE_SIZE = 8192  # 文字列トークン用 LRU の上限 (1行 = HDC_DIM / 8 bytes)
+
+# Long-Term Memory
+LTM_MAX_MEMORIES = 50000  # LTMファイルごとの記憶の上限 (重要度の低い古い記憶から削除)
+LTM_COMPACT_SLACK = 0.1  # 上限をこの割合だけ超えたらバックグラウンドでコンパクション
+LTM_FSYNC = False  # 追記ごとに fsync する (False でも flush はするのでプロセスのクラッシュには耐える)
+LTM_ANN_MIN_SIZE = 20000  # これ以上の記憶では近似検索 (LSH) で想起する
+LTM_ANN_TABLES = 32  # LSH のテーブル数 (多いほど取りこぼしが減り、遅くなる)
+LTM_ANN_BITS = 20  # テーブルごとのキーのビット数 (多いほど候補が減り、速くなる)
+LTM_ANN_PROBE_RADIUS = 1  # キーを1ビット反転したバケットも引く (0 で無効)
+LTM_ANN_MERGE_ROWS = 2048  # LSH に未登録の行がこれだけ溜まったらマージする
+
+# Memory Writer (LTM への書き込みはバックグラウンドでまとめて行う)
+MEMORY_WRITE_QUEUE = 256  # 書き込み待ちの記憶の上限 (一杯なら /chat が空きを待つ)
+MEMORY_WRITE_BATCH = 64  # 1回にまとめて書く記憶の上限
+MEMORY_WRITE_TIMEOUT = 5.0  # 秒。キューの空きをこれ以上待てなければ直接書く
+
+# Memory Cortex (SentenceTransformer による非同期エンコード)
+MEMORY_ENCODE_BATCH = 32  # 1回の encode にまとめる依頼の上限
+MEMORY_ENCODE_WAIT_MS = 10.0  # 後続の依頼を待ってまとめる最大時間
+MEMORY_ENCODE_DIM = 384  # 埋め込み次元 (all-MiniLM-L6-v2)
+MEMORY_ENCODE_WORKERS = 1  # ProcessMemoryCortex のエンコーダープロセス数
+MEMORY_ENCODE_CPUS = None  # ワーカーを固定するコア (例: [6, 7])。生成用のコアと分ける
+MEMORY_ENCODE_SLOTS = 256  # 共有メモリ上の結果スロット数 (処理中の依頼の上限)
+
+# NPC Sessions
+MAX_SESSIONS = 256  # 同時に保持する NPC セッション数の上限
+SESSION_TTL = 1800.0  # 秒。これ以上話しかけられていないセッションは破棄 (LTM は flush)
+SESSION_MEMORY_BUDGET_MB = 512.0  # 読み込み済み LTM インデックスの合計サイズ上限
+
+# Inference Scheduler
+SCHEDULER_MAX_CONCURRENCY = (
+    4  # 同時にデコードするリクエスト数 (llama.cpp のシーケンス数)
+)
+SCHEDULER_MAX_QUEUE = 32  # これ以上待ちがあれば 503 で断る
+SCHEDULER_SEQ_CTX = 2048  # シーケンスごとの KV キャッシュ長 (トークン)
+SCHEDULER_BATCH_SIZE = 512  # 1回の llama_decode に載せる最大トークン数
+
+# Prompt Context (/inject されたコンテキストの並べ方)
+# 頻繁に変わるキーはシステムブロックではなくプロンプトの末尾寄りに置く
+CONTEXT_FAST_KEYS = ("time", "time_of_day", "hp", "health", "mana", "stamina")
+CONTEXT_VOLATILE_AFTER = 3  # 値がこの回数変わったキーも末尾寄りに移す (0 で無効)
+
+# Prefix Cache (ペルソナ部分の KV キャッシュ再利用)
+PREFIX_CACHE_DIRNAME = "prefix_cache"  # スナップショットの保存先 (実行ディレクトリ直下)
+PREFIX_CACHE_MAX_ENTRIES = 8  # メモリに保持するスナップショット数
+PREFIX_CACHE_MAX_DISK_MB = 512.0  # ディスク上のスナップショットの合計サイズ上限
+PREFIX_CACHE_WRITE_QUEUE = 4  # ディスクへの書き出し待ちの上限 (超えたら保存を諦める)
 
 # Active Inference
 CURIOSITY_THRESHOLD = 2.5
+REFLECTION = False  # 不確実性が閾値を超えたら考え直す (NeuralSymbolicBrain.forward)
+ENTROPY_BUDGET_MS = 1.0  # トークンごとのエントロピー計測の時間予算 (超えたら間引く)
 ENERGY_BUDGET = 100.0
 
+# Adaptive Decoding (エントロピーに応じた早期終了・射影幅の調整)
+ADAPTIVE_DECODE = True
+DECODE_MIN_TOKENS = 12  # これより短い応答は早期終了しない
+DECODE_CALM_ENTROPY = 0.6  # 文の平均エントロピーがこれ未満で文が閉じたら終了
+DECODE_BASE_TOP_K = 8  # 通常のトークンで思考ベクトルに射影する候補数
+DECODE_WIDE_TOP_K = 40  # エントロピーが跳ねたトークンで射影する候補数
+DECODE_SPIKE_ENTROPY = 1.5  # これ以上を「迷い」のスパイクとみなす
+DECODE_SKIP_ENTROPY = 0.05  # これ未満のほぼ決定的なトークンは射影しない
+
+# Metrics (/metrics と /chat の timings)
+METRICS = True  # 各段階の所要時間をヒストグラムに記録する
+
+# Logging (キュー経由でバックグラウンドのスレッドが書き出す)
+LOG_LEVEL = "INFO"
+LOG_BRAIN_ACTIVITY = True  # 脳の活動 (発話・想起・保存) をコンソールに表示する
+LOG_TOKEN_SAMPLE = 0  # トークンごとのイベントを何件に1件出すか (0 = 出さない, DEBUG)
+LOG_QUEUE_SIZE = 10000  # 書き出し待ちのログの上限 (超えたら捨てて生成を待たせない)
+
 # System Defaults
 DEFAULT_PERSONA = "You are a helpful AI assistant."
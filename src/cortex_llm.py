@@ -1,14 +1,54 @@
+import time
+from collections import deque
+from itertools import islice
+
 import numpy as np
-from llama_cpp import Llama
-from typing import Generator, Tuple, List, Dict, Any, Optional
+from llama_cpp import Llama, LogitsProcessorList
+from typing import (
+    Generator,
+    Tuple,
+    List,
+    Dict,
+    Any,
+    Optional,
+    Deque,
+    Union,
+)
 import config
+import cortex_log
+import metrics
+from decode_policy import AdaptiveDecodePolicy
+from entropy import log_softmax
 from hippocampus import Hippocampus
+from prompt_context import (
+    HISTORY,
+    PERSONA,
+    STATUS,
+    TURN,
+    WORLD,
+    ContextSnapshot,
+    as_snapshot,
+    render_fields,
+)
+
+log = cortex_log.get_logger("cortex")
+
+# ストップワード強化
+DEFAULT_STOP_TOKENS = [
+    "<|im_end|>",
+    "<|endoftext|>",
+    "User:",
+    "Human:",
+    "HumanHuman:",
+    "Assistant:",
+    "\n\n",
+]
 
 
 class MonolithicCortex:
     """
     create_completion ストリームを使用した高レベルなモノリシック脳実装。
-    logprobs を使用して能動的推論（Active Inference / エントロピー）を近似します。
+    各ステップの生ロジットから能動的推論（Active Inference / エントロピー）を近似します。
     Hippocampus モジュールにより、思考パターンをHDCベクトルとして記憶化します。
     """
 
@@ -18,20 +58,35 @@ class MonolithicCortex:
         system_prompt: str = config.DEFAULT_PERSONA,
         n_ctx: int = config.CTX_SIZE,
         n_gpu_layers: int = 0,
+        hippocampus: Optional[Hippocampus] = None,
     ):
-        print(f"[MonolithicCortex] モデルをロード中: {model_path}...")
+        log.info("モデルをロード中: %s...", model_path)
         self.llm = Llama(
             model_path=model_path,
             n_ctx=n_ctx,
             n_gpu_layers=n_gpu_layers,
             embedding=False,
-            logits_all=True,
             verbose=False,
         )
         self.system_prompt = system_prompt
         # 海馬モジュールの初期化 (Zero-Cost Memory)
-        self.hippocampus = Hippocampus()
-        print(f"[MonolithicCortex] 初期化完了。ペルソナ: {system_prompt[:30]}...")
+        # 起動時にモデルと並行して LTM を読み込む場合は、作成済みのものを受け取る
+        self.hippocampus = hippocampus if hippocampus is not None else Hippocampus()
+        # 射影を省いたトークンに返す共有のゼロベクトル (読み取り専用)
+        self._no_thought = np.zeros(self.hippocampus.hdc_dim, dtype=np.float32)
+        self._no_thought.flags.writeable = False
+        self._pieces: Dict[int, bytes] = {}
+        log.info("初期化完了。ペルソナ: %s...", system_prompt[:30])
+
+    def attach_codebook(self, path: str):
+        """
+        語彙全体のトークンベクトル表を mmap する (無ければこのモデルの語彙から構築する)。
+        """
+        return self.hippocampus.codebook.attach_vocab(
+            path,
+            self.llm.n_vocab(),
+            lambda token_id: self.llm.detokenize([token_id], special=True),
+        )
 
     def calculate_entropy_from_logprobs(self, top_logprobs: Dict[str, float]) -> float:
         """
@@ -62,33 +117,45 @@ class MonolithicCortex:
         max_tokens: int = 128,
         temperature: float = 0.4,  # 0.3->0.4 少し緩和して表現の幅を広げる
         repeat_penalty: float = 1.05,  # ループ防止のため1.05に設定（1.0だとループする）
-        stop_tokens: List[str] = [
-            "<|im_end|>",
-            "<|endoftext|>",
-            "User:",
-            "Human:",
-            "HumanHuman:",
-            "Assistant:",
-            "\n\n",
-        ],  # ストップワード強化
+        stop_tokens: List[str] = DEFAULT_STOP_TOKENS,
+        policy: Optional[AdaptiveDecodePolicy] = None,
     ) -> Generator[Tuple[str, np.ndarray, float], None, None]:
         """
         思考ストリームを生成するジェネレータ。
         各ステップで (トークン文字列, 埋め込みベクトル, エントロピー値) を返します。
+        max_tokens は上限で、policy (省略時は既定の AdaptiveDecodePolicy) により
+        迷いの無い文が閉じた時点で早めに終わることがあります。
         """
-        context_str = self._format_context(game_context)
-
-        # Qwen ChatML Format
-        # <|im_start|>system...<|im_end|><|im_start|>user...<|im_end|><|im_start|>assistant
-        sys_content = f"{self.system_prompt}\n{context_str}"
-
-        full_prompt = (
-            f"<|im_start|>system\n{sys_content}<|im_end|>\n"
-            f"<|im_start|>user\n{user_input}<|im_end|>\n"
-            f"<|im_start|>assistant\n"
+        with metrics.stage(metrics.PROMPT_FORMAT):
+            full_prompt = self.build_prompt(user_input, game_context)
+        yield from self.stream_prompt(
+            full_prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            repeat_penalty=repeat_penalty,
+            stop_tokens=stop_tokens,
+            policy=policy,
         )
 
-        # create_completion をストリーミングモードかつ logprobs 有効で呼び出す
+    def stream_prompt(
+        self,
+        full_prompt: str,
+        max_tokens: int = 128,
+        temperature: float = 0.4,
+        repeat_penalty: float = 1.05,
+        stop_tokens: List[str] = DEFAULT_STOP_TOKENS,
+        policy: Optional[AdaptiveDecodePolicy] = None,
+        timings: Optional[metrics.StageTimings] = None,
+    ) -> Generator[Tuple[str, np.ndarray, float], None, None]:
+        """
+        組み立て済みのプロンプトから思考ストリームを生成する (think_stream の本体)。
+        timings があれば、各段階の所要時間をそこにも足す (リクエストごとの内訳)。
+        """
+        if policy is None:
+            policy = AdaptiveDecodePolicy()
+        # logprobs (候補ごとに文字列化された辞書) は使わず、サンプリング前の生ロジットを
+        # logits processor で直接読む (能動的推論 & 海馬記憶形成に必要)
+        probe = _ThoughtProbe(self, policy, timings)
         stream = self.llm.create_completion(
             full_prompt,
             max_tokens=max_tokens,
@@ -96,7 +163,7 @@ class MonolithicCortex:
             repeat_penalty=repeat_penalty,
             stop=stop_tokens,
             stream=True,
-            logprobs=40,  # 能動的推論 & 海馬記憶形成に必要
+            logits_processor=LogitsProcessorList([probe]),
         )
 
         for chunk in stream:
@@ -105,34 +172,176 @@ class MonolithicCortex:
                 text = choice["text"]
 
                 # エントロピーの抽出 & 思考ベクトルの形成
-                entropy = 0.0
-                embedding = np.zeros(4096)  # Default
-
-                if (
-                    "logprobs" in choice
-                    and choice["logprobs"]
-                    and "top_logprobs" in choice["logprobs"]
-                ):
-                    # top_logprobs は List[Dict] (チャンク内のトークンごと。通常は1つ)
-                    step_logprobs = choice["logprobs"]["top_logprobs"][0]
-
-                    # 1. Active Inference (Metacognition)
-                    entropy = self.calculate_entropy_from_logprobs(step_logprobs)
-
-                    # 2. Hippocampus Projection (Zero-Cost Memory)
-                    # 思考パターン(logprobs)を直接ベクトルに焼き付ける
-                    embedding = self.hippocampus.project_thought(step_logprobs)
+                entropy, embedding = probe.take()
 
                 yield text, embedding, entropy
 
                 if choice["finish_reason"] is not None:
                     break
+                # 迷いの無い文が閉じたら、max_tokens を待たずに終える
+                if policy.should_stop(entropy, text):
+                    break
 
             except KeyError:
                 continue
 
-    def _format_context(self, context: Optional[Dict[str, Any]]) -> str:
-        if not context:
-            return ""
-        s = ", ".join([f"{k}={v}" for k, v in context.items()])
-        return f"[System: Status={{{s}}}]"
+    def perceive_logits(
+        self,
+        logits: np.ndarray,
+        policy: Optional[AdaptiveDecodePolicy] = None,
+        k: int = config.DECODE_WIDE_TOP_K,
+        timings: Optional[metrics.StageTimings] = None,
+    ) -> Tuple[float, np.ndarray]:
+        """
+        1ステップ分の生ロジット (n_vocab,) から (エントロピー, 思考ベクトル) を求める。
+        上位 k 候補をトークンIDのまま NumPy で選び、コードブックも ID で引く (文字列化しない)。
+        エントロピーは上位 k 候補の中で正規化した分布のもの (perceive_step と同じ定義)。
+        """
+        start = time.perf_counter()
+        logits = np.asarray(logits)
+        k = min(k, logits.shape[-1] - 1)
+        top = np.argpartition(logits, -k)[-k:]
+        top = top[np.argsort(-logits[top])]
+        log_probs = log_softmax(logits[top])
+        entropy = float(-np.sum(np.exp(log_probs) * log_probs))
+        measured = time.perf_counter()
+        metrics.observe(metrics.ENTROPY, measured - start, timings)
+
+        n = k if policy is None else policy.projection_k(entropy)
+        if n == 0:
+            return entropy, self._no_thought
+        embedding = self.hippocampus.project_ids(
+            top[:n], log_probs[:n], self._token_piece
+        )
+        metrics.observe(
+            metrics.PROJECT_THOUGHT, time.perf_counter() - measured, timings
+        )
+        return entropy, embedding
+
+    def _token_piece(self, token_id: int) -> bytes:
+        """トークンID → バイト列 (語彙テーブルが無いときのコードブック用。キャッシュする)"""
+        piece = self._pieces.get(token_id)
+        if piece is None:
+            piece = self.llm.detokenize([token_id], special=True)
+            self._pieces[token_id] = piece
+        return piece
+
+    def perceive_step(
+        self,
+        step_logprobs: Dict[str, float],
+        policy: Optional[AdaptiveDecodePolicy] = None,
+    ) -> Tuple[float, np.ndarray]:
+        """
+        1ステップ分の top_logprobs (確率の高い順) から (エントロピー, 思考ベクトル) を求める。
+        policy があれば、射影する候補数をエントロピーに応じて絞る (0 ならゼロベクトル)。
+        """
+        # 1. Active Inference (Metacognition)
+        # エントロピーは常に全候補から求める (感情・共鳴度の値を変えない)
+        entropy = self.calculate_entropy_from_logprobs(step_logprobs)
+
+        # 2. Hippocampus Projection (Zero-Cost Memory)
+        # 思考パターン(logprobs)を直接ベクトルに焼き付ける
+        if policy is not None:
+            k = policy.projection_k(entropy)
+            if k == 0:
+                return entropy, self._no_thought
+            if k < len(step_logprobs):
+                step_logprobs = dict(islice(step_logprobs.items(), k))
+        embedding = self.hippocampus.project_thought(step_logprobs)
+        return entropy, embedding
+
+    def build_prompt(
+        self,
+        user_input: str,
+        game_context: Union[ContextSnapshot, Dict[str, Any], None] = None,
+    ) -> str:
+        """
+        Qwen ChatML 形式のプロンプトを組み立てる。
+        <|im_start|>system...<|im_end|><|im_start|>user...<|im_end|><|im_start|>assistant
+        """
+        return "".join(
+            text for _, text in self.prompt_segments(user_input, game_context)
+        )
+
+    def prompt_segments(
+        self,
+        user_input: str,
+        game_context: Union[ContextSnapshot, Dict[str, Any], None] = None,
+    ) -> List[Tuple[str, str]]:
+        """
+        build_prompt を (セグメント名, テキスト) に分けたもの。変わりにくい順に並ぶ:
+        ペルソナ → 世界の状態 → 会話履歴 → 頻繁に変わる状態 → 今回の発話。
+        """
+        context = as_snapshot(game_context)
+        status = render_fields(context.status, label="Now")
+        return [
+            (PERSONA, f"<|im_start|>system\n{self.system_prompt}\n"),
+            (WORLD, render_fields(context.world)),
+            (HISTORY, context.history),
+            (STATUS, f"\n{status}" if status else ""),
+            (
+                TURN,
+                f"<|im_end|>\n<|im_start|>user\n{user_input}<|im_end|>\n"
+                f"<|im_start|>assistant\n",
+            ),
+        ]
+
+    def prompt_prefixes(
+        self, game_context: Union[ContextSnapshot, Dict[str, Any], None] = None
+    ) -> List[str]:
+        """
+        build_prompt の先頭のうち、ターンをまたいで変わらない部分 (短い順)。
+        プレフィックスキャッシュはこの境界で KV キャッシュのスナップショットを取ります。
+        世界の状態はキー順が固定で、会話履歴や頻繁に変わる値より前にあるので、
+        会話が続いても再利用できます。
+        """
+        return self.segment_prefixes(self.prompt_segments("", game_context))
+
+    @staticmethod
+    def segment_prefixes(segments: List[Tuple[str, str]]) -> List[str]:
+        """prompt_segments の結果から prompt_prefixes と同じ先頭部分を取り出す"""
+        (_, persona), (_, world) = segments[:2]
+        prefixes = [persona]
+        if world:
+            prefixes.append(persona + world)
+        return prefixes
+
+
+class _ThoughtProbe:
+    """
+    create_completion の logits processor。
+    各トークンのサンプリング前に生ロジットから (エントロピー, 思考ベクトル) を求めて溜め、
+    ストリームのチャンク (1トークンに1つ) が届いたら take() で古い順に取り出す。
+    stop 文字列の保留でチャンクが遅れて届いても、トークンとの対応はずれない。
+    最初の呼び出しまでを prefill、以降の呼び出しの間隔をデコード1ステップとして記録する。
+    """
+
+    def __init__(
+        self,
+        cortex: MonolithicCortex,
+        policy: AdaptiveDecodePolicy,
+        timings: Optional[metrics.StageTimings] = None,
+    ):
+        self.cortex = cortex
+        self.policy = policy
+        self.timings = timings
+        self.pending: Deque[Tuple[float, np.ndarray]] = deque()
+        self._last = time.perf_counter()
+        self._prefilled = False
+
+    def __call__(self, input_ids: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        now = time.perf_counter()
+        stage = metrics.DECODE_STEP if self._prefilled else metrics.PREFILL
+        metrics.observe(stage, now - self._last, self.timings)
+        self._prefilled = True
+        self.pending.append(
+            self.cortex.perceive_logits(scores, self.policy, timings=self.timings)
+        )
+        # 知覚にかかった時間は次のデコードステップに含めない
+        self._last = time.perf_counter()
+        return scores
+
+    def take(self) -> Tuple[float, np.ndarray]:
+        if not self.pending:
+            return 0.0, self.cortex._no_thought
+        return self.pending.popleft()
@@ -0,0 +1,139 @@
+"""
+Non-blocking logging for the server and the generation path.
+ログは呼び出し元のスレッドではキューに積むだけで、書き出しはバックグラウンドのリスナーが行います。
+コンソールが遅くても (Windows のコンソール・リダイレクト先のパイプ)、トークン生成は待たされません。
+"""
+
+import atexit
+import itertools
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+import config
+
+ROOT = "cortex"
+ACTIVITY = "cortex.activity"  # 「脳の活動」のコンソール表示 (Modder 向け)
+TOKENS = "cortex.tokens"  # トークンごとのイベント (間引いて出す)
+
+_listener: Optional[QueueListener] = None
+_handler: Optional["DroppingQueueHandler"] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """cortex.<name> のロガー (出力先は setup() で決まる)"""
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+activity = logging.getLogger(ACTIVITY)
+tokens = logging.getLogger(TOKENS)
+
+
+class SampleFilter(logging.Filter):
+    """every 件に1件だけ通す (トークンごとのイベントを間引く)"""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self._seen = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return next(self._seen) % self.every == 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that never blocks: when the queue is full the record is dropped
+    (and counted) instead of waiting for the writer thread.
+    """
+
+    def __init__(self, log_queue: "queue.Queue"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    """書き出しのたびに sys.stdout を引く (実行中のリダイレクトに追従する)"""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def setup(
+    level: str = config.LOG_LEVEL,
+    brain_activity: bool = config.LOG_BRAIN_ACTIVITY,
+    token_sample: int = config.LOG_TOKEN_SAMPLE,
+    queue_size: int = config.LOG_QUEUE_SIZE,
+) -> QueueListener:
+    """
+    cortex.* のロガーをキュー経由にし、書き出し用のリスナースレッドを起動する (2回目以降は何もしない)。
+
+    Args:
+        level: cortex.* のログレベル ("DEBUG", "INFO", ...)
+        brain_activity: 脳の活動 (発話・想起・保存) をコンソールに表示する
+        token_sample: トークンごとのイベントを何件に1件出すか (0 なら出さない)
+        queue_size: 書き出し待ちの上限 (超えた分は捨てる)
+    """
+    global _listener, _handler
+    if _listener is not None:
+        return _listener
+
+    log_queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+    _handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    root.handlers = [_handler]
+    root.propagate = False
+
+    # 活動表示はメッセージだけを出す (従来のコンソール表示と同じ見た目)
+    activity_sink = _ConsoleHandler()
+    activity_sink.setFormatter(logging.Formatter("%(message)s"))
+    activity_sink.addFilter(lambda record: record.name == ACTIVITY)
+    console = _ConsoleHandler()
+    console.setFormatter(
+        logging.Formatter(
+            "%(asctime)s %(levelname)s [%(name)s] %(message)s", "%H:%M:%S"
+        )
+    )
+    console.addFilter(lambda record: record.name != ACTIVITY)
+
+    # 無効なものはレベルで止め、レコード自体を作らせない
+    activity.setLevel(logging.INFO if brain_activity else logging.CRITICAL + 1)
+    tokens.setLevel(logging.DEBUG if token_sample > 0 else logging.CRITICAL + 1)
+    tokens.filters = [SampleFilter(token_sample)] if token_sample > 0 else []
+
+    _listener = QueueListener(log_queue, activity_sink, console)
+    _listener.start()
+    atexit.register(shutdown)
+    return _listener
+
+
+def shutdown():
+    """キューに残ったログを書き出してリスナーを止める"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    logging.getLogger(ROOT).handlers = []
+
+
+def dropped() -> int:
+    """キューが一杯で捨てたログの件数"""
+    return _handler.dropped if _handler is not None else 0
@@ -0,0 +1,91 @@
+import re
+
+import config
+
+# 文末 (閉じ括弧・引用符が続いてもよい)。"3.5" のような数字中のピリオドは除く
+_SENTENCE_END = re.compile(r"(?:[。！？!?…]|(?<!\d)\.)[」』”’\"')\]]*\s*$")
+
+
+class AdaptiveDecodePolicy:
+    """
+    Entropy-driven decoding decisions for one generated reply.
+
+    - Early exit: once a sentence has closed and its tokens were all decoded with low
+      entropy (the NPC said something it is sure about), the reply ends there instead of
+      running to max_tokens.
+    - Projection width: the thought vector is built from the top `base_k` candidates;
+      only on entropy spikes are all `wide_k` candidates projected.
+    - Low-information tokens (near-deterministic continuations) are not projected at all.
+
+    Entropy itself is still measured on every token, so emotion/resonance are unchanged.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = config.ADAPTIVE_DECODE,
+        base_k: int = config.DECODE_BASE_TOP_K,
+        wide_k: int = config.DECODE_WIDE_TOP_K,
+        spike_entropy: float = config.DECODE_SPIKE_ENTROPY,
+        skip_entropy: float = config.DECODE_SKIP_ENTROPY,
+        calm_entropy: float = config.DECODE_CALM_ENTROPY,
+        min_tokens: int = config.DECODE_MIN_TOKENS,
+    ):
+        """
+        Args:
+            enabled: False keeps the fixed behaviour (all candidates, no early exit)
+            base_k: Candidates projected on ordinary tokens
+            wide_k: Candidates projected when entropy spikes
+            spike_entropy: Entropy (nats) at or above which a token counts as a spike
+            skip_entropy: Entropy below which a token is not projected
+            calm_entropy: Mean entropy of a closed sentence that allows an early exit
+            min_tokens: Never exit before this many tokens
+        """
+        self.enabled = enabled
+        self.base_k = base_k
+        self.wide_k = wide_k
+        self.spike_entropy = spike_entropy
+        self.skip_entropy = skip_entropy
+        self.calm_entropy = calm_entropy
+        self.min_tokens = min_tokens
+
+        self.n_tokens = 0
+        self.n_projected = 0
+        self._tail = ""  # 文末判定用に直近のテキストだけを持つ
+        self._sentence_sum = 0.0
+        self._sentence_len = 0
+
+    def projection_k(self, entropy: float) -> int:
+        """このトークンの思考ベクトルに使う候補数 (0 = 射影しない)"""
+        if not self.enabled or entropy >= self.spike_entropy:
+            k = self.wide_k
+        elif entropy < self.skip_entropy and self.n_projected:
+            # 最初のトークンは必ず射影する (想起・記憶に使うベクトルを確保する)
+            return 0
+        else:
+            k = self.base_k
+        self.n_projected += 1
+        return k
+
+    def should_stop(self, entropy: float, piece: str) -> bool:
+        """
+        生成されたトークンを記録し、ここで応答を打ち切るべきかを返す。
+
+        Args:
+            entropy: このトークンのエントロピー
+            piece: このトークンのテキスト
+        """
+        self.n_tokens += 1
+        self._sentence_sum += entropy
+        self._sentence_len += 1
+        self._tail = (self._tail + piece)[-8:]
+        if (
+            not self.enabled
+            or not piece.strip()
+            or not _SENTENCE_END.search(self._tail)
+        ):
+            return False
+
+        calm = self._sentence_sum / self._sentence_len < self.calm_entropy
+        self._sentence_sum = 0.0
+        self._sentence_len = 0
+        return calm and self.n_tokens >= self.min_tokens
@@ -0,0 +1,86 @@
+"""
+Entropy of next-token distributions, computed directly from llama.cpp's raw logits.
+生のロジットから NumPy だけで予測エントロピー (能動的推論の「迷い」) を計算します。
+"""
+
+import time
+from typing import List, Optional
+
+import numpy as np
+
+import config
+
+
+def log_softmax(logits: np.ndarray) -> np.ndarray:
+    """最終軸の log-softmax (最大値を引いてオーバーフローを防ぐ)"""
+    logits = np.asarray(logits, dtype=np.float32)
+    shifted = logits - np.max(logits, axis=-1, keepdims=True)
+    return shifted - np.log(np.sum(np.exp(shifted), axis=-1, keepdims=True))
+
+
+def entropy_from_logits(logits: np.ndarray) -> np.ndarray:
+    """
+    シャノンエントロピー H = -Σ p log p (nats) を最終軸について計算する。
+    exp は1回だけ: H = log Z - Σ e·x / Z  (x = logits - max, e = exp(x), Z = Σ e)
+
+    Returns:
+        (...,) のエントロピー。1次元のロジットならスカラー (0次元配列)
+    """
+    logits = np.asarray(logits, dtype=np.float32)
+    shifted = logits - np.max(logits, axis=-1, keepdims=True)
+    e = np.exp(shifted)
+    z = np.sum(e, axis=-1)
+    return np.log(z) - np.sum(e * shifted, axis=-1) / z
+
+
+class EntropyProbe:
+    """
+    Logits processor that records the entropy of every sampled token's distribution.
+
+    Pass it in `logits_processor` of Llama.create_completion: it sees the last-token
+    logits llama.cpp already computed, so `logits_all` is not needed. The time spent per
+    measured token is tracked; when the average exceeds `budget_ms`, the probe measures
+    only every 2nd, 4th, ... token so the overhead stays within the budget.
+    """
+
+    def __init__(
+        self,
+        budget_ms: float = config.ENTROPY_BUDGET_MS,
+        max_stride: int = 8,
+    ):
+        self.budget_ms = budget_ms
+        self.max_stride = max_stride
+        self.stride = 1
+        self.entropies: List[float] = []
+        self.total_ms = 0.0
+        self._step = 0
+
+    def __call__(self, input_ids: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        self._step += 1
+        if (self._step - 1) % self.stride:
+            return scores
+
+        start = time.perf_counter()
+        self.entropies.append(float(entropy_from_logits(scores)))
+        self.total_ms += (time.perf_counter() - start) * 1000
+
+        # 予算を超えていたら計測を間引く
+        if self.mean_ms > self.budget_ms and self.stride < self.max_stride:
+            self.stride *= 2
+        return scores
+
+    @property
+    def mean_ms(self) -> float:
+        """計測1回あたりの平均オーバーヘッド (ms)"""
+        return self.total_ms / len(self.entropies) if self.entropies else 0.0
+
+    @property
+    def mean(self) -> float:
+        return float(np.mean(self.entropies)) if self.entropies else 0.0
+
+    @property
+    def peak(self) -> float:
+        return max(self.entropies, default=0.0)
+
+    def last(self) -> Optional[float]:
+        return self.entropies[-1] if self.entropies else None
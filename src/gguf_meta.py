@@ -0,0 +1,129 @@
+"""
+Minimal GGUF metadata reader.
+モデルをロードせずに GGUF ヘッダの key-value メタデータだけを読みます
+(埋め込み次元・語彙サイズなどを推論なしで知るため)。
+"""
+
+import struct
+from typing import Any, BinaryIO, Dict, NamedTuple, Optional
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF value types
+_SCALARS = {
+    0: "<B",  # UINT8
+    1: "<b",  # INT8
+    2: "<H",  # UINT16
+    3: "<h",  # INT16
+    4: "<I",  # UINT32
+    5: "<i",  # INT32
+    6: "<f",  # FLOAT32
+    7: "<?",  # BOOL
+    10: "<Q",  # UINT64
+    11: "<q",  # INT64
+    12: "<d",  # FLOAT64
+}
+_STRING = 8
+_ARRAY = 9
+
+
+class GGUFArray(NamedTuple):
+    """読み飛ばした大きな配列 (要素型と要素数だけを保持)"""
+
+    item_type: int
+    length: int
+
+
+class _Reader:
+    def __init__(self, f: BinaryIO, version: int):
+        self.f = f
+        # v1 は長さ・個数が uint32、v2 以降は uint64
+        self.len_fmt = "<I" if version == 1 else "<Q"
+
+    def unpack(self, fmt: str):
+        size = struct.calcsize(fmt)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError("Unexpected end of GGUF header")
+        return struct.unpack(fmt, data)[0]
+
+    def string(self) -> str:
+        n = self.unpack(self.len_fmt)
+        return self.f.read(n).decode("utf-8", errors="replace")
+
+    def skip_string(self):
+        self.f.seek(self.unpack(self.len_fmt), 1)
+
+    def value(self, value_type: int, max_array_len: int) -> Any:
+        if value_type in _SCALARS:
+            return self.unpack(_SCALARS[value_type])
+        if value_type == _STRING:
+            return self.string()
+        if value_type == _ARRAY:
+            item_type = self.unpack("<I")
+            length = self.unpack(self.len_fmt)
+            if length <= max_array_len:
+                return [self.value(item_type, max_array_len) for _ in range(length)]
+            self.skip_array(item_type, length)
+            return GGUFArray(item_type, length)
+        raise ValueError(f"Unknown GGUF value type {value_type}")
+
+    def skip_array(self, item_type: int, length: int):
+        if item_type in _SCALARS:
+            self.f.seek(struct.calcsize(_SCALARS[item_type]) * length, 1)
+        elif item_type == _STRING:
+            for _ in range(length):
+                self.skip_string()
+        else:
+            for _ in range(length):
+                self.value(item_type, 0)
+
+
+def read_metadata(path: str, max_array_len: int = 64) -> Dict[str, Any]:
+    """
+    GGUF ファイルのメタデータを辞書で返す。
+    max_array_len を超える配列 (語彙リストなど) は読み飛ばし、GGUFArray (型, 要素数) にする。
+    """
+    with open(path, "rb") as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise ValueError(f"{path} is not a GGUF file")
+        version = struct.unpack("<I", f.read(4))[0]
+        reader = _Reader(f, version)
+        reader.unpack(reader.len_fmt)  # n_tensors
+        n_kv = reader.unpack(reader.len_fmt)
+
+        metadata: Dict[str, Any] = {"GGUF.version": version}
+        for _ in range(n_kv):
+            key = reader.string()
+            value_type = reader.unpack("<I")
+            metadata[key] = reader.value(value_type, max_array_len)
+        return metadata
+
+
+def _array_length(value: Any) -> Optional[int]:
+    if isinstance(value, GGUFArray):
+        return value.length
+    if isinstance(value, list):
+        return len(value)
+    return None
+
+
+def model_dims(path: str) -> Dict[str, Optional[int]]:
+    """
+    推論に使う主要な次元をメタデータから取り出す。
+
+    Returns:
+        {"architecture", "n_embd", "n_ctx_train", "n_layer", "n_vocab"} (無い値は None)
+    """
+    metadata = read_metadata(path)
+    arch = metadata.get("general.architecture")
+    n_vocab = metadata.get(f"{arch}.vocab_size")
+    if n_vocab is None:
+        n_vocab = _array_length(metadata.get("tokenizer.ggml.tokens"))
+    return {
+        "architecture": arch,
+        "n_embd": metadata.get(f"{arch}.embedding_length"),
+        "n_ctx_train": metadata.get(f"{arch}.context_length"),
+        "n_layer": metadata.get(f"{arch}.block_count"),
+        "n_vocab": n_vocab,
+    }
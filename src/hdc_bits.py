@@ -0,0 +1,62 @@
+"""
+Bit-packed hypervector helpers.
+バイポーラ (-1/+1) の超次元ベクトルを 1bit/次元 (bit=1 が +1) に詰めて扱うための関数群。
+
+バイポーラベクトル同士では、コサイン類似度とハミング距離が次の関係で厳密に対応します:
+    cos(a, b) = 1 - 2 * hamming(a, b) / D
+そのため類似度は XOR + popcount だけで計算できます (4096dim → 512 bytes)。
+"""
+
+from typing import Union
+
+import numpy as np
+
+# popcount: NumPy 2.x の bitwise_count があれば使い、無ければ 8bit ルックアップ表で代用
+_POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1, dtype=np.uint8
+)
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    """要素ごとの立っているビット数"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return _POPCOUNT_TABLE[x.view(np.uint8)].reshape(x.shape + (-1,)).sum(axis=-1)
+
+
+def pack_bipolar(vectors: Union[np.ndarray, list]) -> np.ndarray:
+    """
+    バイポーラベクトル (..., D) をパック済み (..., D/8) uint8 に変換する。
+    0以上を +1 (bit=1) として扱う (Bipolarize と同じ規則)。
+    """
+    return np.packbits(np.asarray(vectors) >= 0, axis=-1)
+
+
+def unpack_bipolar(
+    packed: np.ndarray, hdc_dim: int, dtype: np.dtype = np.float32
+) -> np.ndarray:
+    """パック済み (..., D/8) をバイポーラ (..., D) に戻す"""
+    bits = np.unpackbits(packed, axis=-1, count=hdc_dim)
+    return (bits.astype(dtype) * 2) - 1
+
+
+def hamming_distance(query: np.ndarray, packed_matrix: np.ndarray) -> np.ndarray:
+    """
+    パック済みクエリ (D/8,) と行列 (N, D/8) のハミング距離 (N,) を一括計算する。
+    行長が8の倍数なら uint64 単位で XOR + popcount する。
+    """
+    row_bytes = packed_matrix.shape[-1]
+    if row_bytes % 8 == 0 and packed_matrix.flags.c_contiguous:
+        words = packed_matrix.view(np.uint64)
+        q_words = np.ascontiguousarray(query).view(np.uint64)
+    else:
+        words, q_words = packed_matrix, query
+    return popcount(np.bitwise_xor(words, q_words)).sum(axis=-1, dtype=np.int64)
+
+
+def hamming_similarity(
+    query: np.ndarray, packed_matrix: np.ndarray, hdc_dim: int
+) -> np.ndarray:
+    """ハミング距離をコサイン類似度 (-1.0 ~ 1.0) に換算する"""
+    distance = hamming_distance(query, packed_matrix)
+    return (1.0 - 2.0 * distance / hdc_dim).astype(np.float32)
@@ -3,8 +3,76 @@ import json
 import os
 import uuid
 import base64
+import shutil
+import threading
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import config
+import cortex_log
+import metrics
+from codebook import TokenCodebook
+from hdc_bits import hamming_similarity, pack_bipolar
+from ltm_index import LTMIndex
+from ltm_store import LTMStore
+
+
+class ThoughtAccumulator:
+    """
+    思考ベクトルの逐次的な重ね合わせ (Running Sum)。
+    トークンごとのベクトルをリストに溜めず、事前に確保した1本のバッファに加算するので、
+    1リクエストのメモリは応答の長さによらず O(hdc_dim) で済みます。
+    """
+
+    def __init__(self, hdc_dim: int = config.HDC_DIM):
+        self.hdc_dim = hdc_dim
+        self._sum = np.zeros(hdc_dim, dtype=np.float32)
+        self._scratch = np.empty(hdc_dim, dtype=np.float32)  # 重み付き加算用
+        self._bits = np.empty(hdc_dim, dtype=bool)  # snapshot 用
+        self.count = 0
+        self.total_weight = 0.0
+
+    def add(self, vector: np.ndarray, weight: float = 1.0) -> bool:
+        """
+        思考ベクトルを重ね合わせる (ゼロベクトル = 射影されなかったトークンは無視)。
+
+        Args:
+            vector: バイポーラ (hdc_dim,) のベクトル、またはその重ね合わせ
+            weight: 重要度などによる重み
+
+        Returns:
+            加算したか
+        """
+        if weight == 0.0 or not vector.any():
+            return False
+        if weight == 1.0:
+            self._sum += vector
+        else:
+            np.multiply(vector, weight, out=self._scratch)
+            self._sum += self._scratch
+        self.count += 1
+        self.total_weight += weight
+        return True
+
+    @property
+    def sum(self) -> np.ndarray:
+        """現在の重ね合わせ (読み取り専用のビュー)"""
+        view = self._sum.view()
+        view.flags.writeable = False
+        return view
+
+    def snapshot(self) -> np.ndarray:
+        """
+        現在の重ね合わせを二値化したパック済みベクトル (hdc_dim/8,) uint8。
+        生成の途中でも想起 (recall) のクエリや保存にそのまま使える。
+        """
+        np.greater_equal(self._sum, 0, out=self._bits)
+        return np.packbits(self._bits)
+
+    def reset(self):
+        self._sum.fill(0.0)
+        self.count = 0
+        self.total_weight = 0.0
 
 
 class Hippocampus:
@@ -14,67 +82,176 @@ class Hippocampus:
     思考ベクトル（Semantic Hypervector）を生成します。
     """
 
-    def __init__(self, vocab_size: int = 152064, hdc_dim: int = 4096, seed: int = 42):
+    def __init__(
+        self,
+        vocab_size: int = 152064,
+        hdc_dim: int = 4096,
+        seed: int = 42,
+        codebook: Optional[TokenCodebook] = None,
+        max_memories: int = config.LTM_MAX_MEMORIES,
+    ):
         """
         Args:
             vocab_size: モデルの語彙サイズ (Qwen2.5-1.5B は ~152k)
             hdc_dim: HDCベクトルの次元数
-            seed: ランダム射影行列の固定シード
+            seed: トークンコードブックのハッシュ鍵
+            codebook: 共有するコードブック (省略時は新規作成)
+            max_memories: LTMファイルごとに保持する記憶の上限
         """
-        # 再現性のためシード固定
-        np.random.seed(seed)
-
         # 射影行列: スパースなLogprobsを密なHDCベクトルへ変換
-        # メモリ節約のため、使用時にオンデマンド生成するか、または軽量なハッシュ関数で代用も検討可能だが、
-        # ここでは単純化のため行列を持つ (ただしスパースアクセスのため行列全体は保持せずとも良いが、実装を簡単にするため保持)
-        # Note: 152k * 4k * float16 は巨大(1.2GB)になるため、
-        # メモリ効率の良い「ハッシュ射影」または「固定ランダムシードからの動的生成」が理想。
-        # 今回はMVPとして、クラス初期化時に行列を持たず、encode時に動的に計算する「擬似射影」を採用する。
-        # (巨大な行列を持つとメモリ圧迫の原因になるため)
+        # Note: 152k * 4k * float16 の行列は巨大(1.2GB)になるため、行列は持たない。
+        # 代わりに「トークン → ビットパック済みベクトル」のコードブックを引き、
+        # 射影を Gather + 重み付き和 として計算する。
+        # (コードブックは安定ハッシュ由来なので、再起動しても同じベクトルになる)
 
         self.vocab_size = vocab_size
         self.hdc_dim = hdc_dim
         self.seed = seed
+        self.codebook = codebook or TokenCodebook(hdc_dim=hdc_dim, seed=seed)
+
+        # LTMファイルごとの追記型ストアと常駐インデックス
+        self.max_memories = max_memories
+        self._indexes: Dict[str, LTMIndex] = {}
+        self._stores: Dict[str, LTMStore] = {}
+        self._index_lock = threading.RLock()
 
     def project_thought(self, top_logprobs: Dict[str, float]) -> np.ndarray:
         """
         Logprobs (Top-K thinking pattern) を思考ベクトルに射影する。
-        行列を持たず、トークンIDをシードとした乱数生成で射影をシミュレートする（メモリ消費ほぼゼロ）。
+        各トークンのベクトルをコードブックから集め (Gather)、確率で重み付けして加算する。
         """
-        thought_vector = np.zeros(self.hdc_dim, dtype=np.float32)
+        if not top_logprobs:
+            return np.zeros(self.hdc_dim, dtype=np.float32)
 
         # 確率分布の正規化
         # APIからは対数確率が来る -> 確率に戻す
-        log_probs = np.array(list(top_logprobs.values()))
         token_strs = list(top_logprobs.keys())
+        log_probs = np.fromiter(
+            top_logprobs.values(), dtype=np.float32, count=len(token_strs)
+        )
 
         # 数値安定性のためのMax引き
         probs = np.exp(log_probs - np.max(log_probs))
         probs = probs / (np.sum(probs) + 1e-10)  # 正規化
 
-        for i, token_str in enumerate(token_strs):
-            p = probs[i]
-            if p < 0.01:
-                continue  # 影響の小さいトークンは無視して高速化
+        # 影響の小さいトークンは無視して高速化
+        keep = probs >= 0.01
+        tokens = [t for t, k in zip(token_strs, keep) if k]
+
+        # トークン文字列そのものをキーにする（TokenizerのID変更に強い）
+        packed_rows = self.codebook.packed_rows(tokens)
+        return self._bundle(packed_rows, probs[keep])
 
-            # トークン文字列をハッシュ化してシードにする（一貫性確保）
-            # 注意: 文字列そのものを使うことで、TokenizerのID変更に強くなる
-            token_seed = hash(token_str) % (2**32)
+    def project_ids(
+        self,
+        token_ids: np.ndarray,
+        log_probs: np.ndarray,
+        piece_fn: Optional[Callable[[int], bytes]] = None,
+    ) -> np.ndarray:
+        """
+        トークンID と対数確率 (上位 k 候補) を思考ベクトルに射影する。
+        文字列を経由せず、語彙テーブル (attach_vocab) の行を ID で直接集める。
 
-            # このトークン固有のベクトルを動的生成 (正規分布)
-            rng = np.random.RandomState(token_seed)
-            # バイポーラ (-1, 1) のスパースベクトルを生成して加算
-            # 全次元作ると重いので、非ゼロ要素のみを選択的に加算する「Sparse Coding」的アプローチも可だが
-            # ここではシンプルにランダムベクトル生成（サイズ小なら高速）
-            token_vector = rng.choice([-1.0, 1.0], size=self.hdc_dim)
+        Args:
+            token_ids: 候補のトークンID (k,)
+            log_probs: 各候補の対数確率 (k,)
+            piece_fn: 語彙テーブルが無いときに使う ID → トークンのバイト列
 
-            thought_vector += p * token_vector
+        Returns:
+            (hdc_dim,) のバイポーラベクトル (project_thought と同じ行・同じ重み付け)
+        """
+        if len(token_ids) == 0:
+            return np.zeros(self.hdc_dim, dtype=np.float32)
 
-        # 二値化 (Bipolarize) してHDCの特性（ノイズ耐性）を得る
-        # 0以上なら1, 未満なら-1
-        bipolar_vector = np.where(thought_vector >= 0, 1.0, -1.0)
+        log_probs = np.asarray(log_probs, dtype=np.float32)
+        probs = np.exp(log_probs - np.max(log_probs))
+        probs = probs / (np.sum(probs) + 1e-10)
+
+        # 影響の小さいトークンは無視して高速化
+        keep = probs >= 0.01
+        ids = np.asarray(token_ids)[keep]
+        if self.codebook.vocab_table is not None:
+            packed_rows = self.codebook.packed_ids(ids)
+        elif piece_fn is not None:
+            packed_rows = self.codebook.packed_rows([piece_fn(int(t)) for t in ids])
+        else:
+            raise RuntimeError("Vocabulary codebook is not attached")
+        return self._bundle(packed_rows, probs[keep])
+
+    def project_sequence(
+        self, sequence: List[Dict[str, float]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        応答全体の Logprobs 列 (トークン数 × Top-K) をまとめて射影する。
+        2次元配列に対する1回の Softmax と、コードブック行との1回の行列積で計算する。
 
-        return bipolar_vector
+        Args:
+            sequence: 各ステップの top_logprobs (空の Dict はゼロベクトルになる)
+
+        Returns:
+            (ステップごとの思考ベクトル (T, hdc_dim), 全体を重ね合わせた思考ベクトル (hdc_dim,))
+        """
+        n_steps = len(sequence)
+        width = max((len(step) for step in sequence), default=0)
+        per_step = np.zeros((n_steps, self.hdc_dim), dtype=np.float32)
+        if width == 0:
+            return per_step, np.zeros(self.hdc_dim, dtype=np.float32)
+
+        # (T, K) の対数確率行列と、各要素のトークン列番号 (応答内でユニーク化)
+        columns: Dict[str, int] = {}
+        log_probs = np.full((n_steps, width), -np.inf, dtype=np.float32)
+        token_cols = np.zeros((n_steps, width), dtype=np.int64)
+        for t, step in enumerate(sequence):
+            for j, (token_str, lp) in enumerate(step.items()):
+                token_cols[t, j] = columns.setdefault(token_str, len(columns))
+                log_probs[t, j] = lp
+
+        # 行ごとの Softmax (空ステップの行は全て0になる)
+        row_max = np.max(log_probs, axis=1, keepdims=True)
+        row_max[~np.isfinite(row_max)] = 0.0
+        probs = np.exp(log_probs - row_max)
+        probs /= np.sum(probs, axis=1, keepdims=True) + 1e-10
+        probs[probs < 0.01] = 0.0  # 影響の小さいトークンは無視
+
+        # (T, U) の重み行列に散布する
+        n_cols = len(columns)
+        flat_idx = np.arange(n_steps)[:, None] * n_cols + token_cols
+        weights = np.bincount(
+            flat_idx.ravel(), weights=probs.ravel(), minlength=n_steps * n_cols
+        ).reshape(n_steps, n_cols)
+
+        packed_rows = self.codebook.packed_rows(list(columns))
+        active = np.any(weights > 0, axis=1)
+        per_step[active] = self._bundle(packed_rows, weights[active])
+
+        # 全ステップの重ね合わせ → 二値化
+        pooled = np.zeros(self.hdc_dim, dtype=np.float32)
+        if active.any():
+            pooled = np.where(
+                per_step[active].sum(axis=0) >= 0, np.float32(1.0), np.float32(-1.0)
+            )
+        return per_step, pooled
+
+    def _bundle(self, packed_rows: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        パック済み行 (k, D/8) を重み付きで重ね合わせ、二値化 (Bipolarize) する。
+        Σ w_i * (2b_i - 1) >= 0  ⇔  Σ w_i * b_i >= Σ w_i / 2 なので、
+        ビット (0/1) のまま行列積で計算できる。weights は (k,) または (T, k)。
+        """
+        weights = weights.astype(np.float32, copy=False)
+        score = np.zeros(weights.shape[:-1] + (self.hdc_dim,), dtype=np.float32)
+
+        # 展開後のビット行列が大きくなりすぎないよう、行をブロックに分けて加算する
+        block = 512
+        for start in range(0, packed_rows.shape[0], block):
+            bits = np.unpackbits(
+                packed_rows[start : start + block], axis=-1, count=self.hdc_dim
+            )
+            score += weights[..., start : start + block] @ bits.astype(np.float32)
+        half = 0.5 * np.sum(weights, axis=-1, keepdims=weights.ndim > 1)
+
+        # 0以上なら1, 未満なら-1
+        return np.where(score >= half, np.float32(1.0), np.float32(-1.0))
 
     def cosine_similarity(self, v1: np.ndarray, v2: np.ndarray) -> float:
         """
@@ -86,17 +263,115 @@ class Hippocampus:
             return 0.0
         return np.dot(v1, v2) / (norm1 * norm2)
 
+    def hamming_similarity(self, v1: np.ndarray, v2: np.ndarray) -> float:
+        """
+        バイポーラベクトル同士の類似度をビット演算 (XOR + popcount) で計算する。
+        バイポーラ入力に対しては cosine_similarity と同じ値になる。
+        """
+        p1 = v1 if v1.dtype == np.uint8 else pack_bipolar(v1)
+        p2 = v2 if v2.dtype == np.uint8 else pack_bipolar(v2)
+        return float(hamming_similarity(p1, p2[None, :], self.hdc_dim)[0])
+
     # =========================================
     # 長期記憶 (LTM) 永続化機能
     # =========================================
 
     def _encode_vector(self, vec: np.ndarray) -> str:
-        """ベクトルをBase64文字列にエンコード（ストレージ効率化）"""
-        return base64.b64encode(vec.astype(np.float32).tobytes()).decode("ascii")
+        """
+        ベクトルをビットパックしてBase64文字列にエンコード (4096dim → 512 bytes)。
+        パック済み (uint8) のベクトルはそのままエンコードする。
+        """
+        vec = np.asarray(vec)
+        if vec.dtype != np.uint8:
+            vec = pack_bipolar(vec)
+        return base64.b64encode(vec.tobytes()).decode("ascii")
 
     def _decode_vector(self, encoded: str) -> np.ndarray:
-        """Base64文字列からベクトルをデコード"""
-        return np.frombuffer(base64.b64decode(encoded), dtype=np.float32)
+        """
+        Base64文字列からパック済みベクトル (hdc_dim/8,) uint8 をデコード。
+        旧形式 (float32 の生バイト列) は二値化してパックし直す。
+        """
+        raw = base64.b64decode(encoded)
+        if len(raw) == self.hdc_dim // 8:
+            return np.frombuffer(raw, dtype=np.uint8)
+        if len(raw) == self.hdc_dim * 4:
+            return pack_bipolar(np.frombuffer(raw, dtype=np.float32))
+        raise ValueError(f"unexpected vector size: {len(raw)} bytes")
+
+    def store_path(self, filepath: str) -> str:
+        """LTMファイルパスに対応する追記型ストアのディレクトリ (例: ltm.json → ltm.ltm)"""
+        return os.path.splitext(filepath)[0] + ".ltm"
+
+    def index_for(self, filepath: str) -> LTMIndex:
+        """
+        LTMファイルに対応する常駐インデックスを返す。
+        初回のみストアを開いて全記憶を読み込み、以降はメモリ上のインデックスを使い回す。
+        旧形式のJSONファイルしか無い場合は、最初に追記型ストアへ移行する。
+        """
+        index = self._indexes.get(filepath)
+        if index is not None:
+            return index
+
+        with self._index_lock:
+            index = self._indexes.get(filepath)
+            if index is None:
+                index = LTMIndex(hdc_dim=self.hdc_dim)
+                store = LTMStore(
+                    self.store_path(filepath),
+                    hdc_dim=self.hdc_dim,
+                    max_memories=self.max_memories,
+                    on_compact=index.remove,
+                )
+                if not store.exists() and os.path.exists(filepath):
+                    self._migrate_legacy(filepath, store.directory)
+
+                records, packed, valid = store.open()
+                index.extend(records, packed, valid)
+                self._stores[filepath] = store
+                self._indexes[filepath] = index
+            return index
+
+    def loaded_index(self, filepath: str) -> Optional[LTMIndex]:
+        """読み込み済みの常駐インデックスを返す (未読み込みなら None, 読み込みはしない)"""
+        return self._indexes.get(filepath)
+
+    def _migrate_legacy(self, filepath: str, directory: str):
+        """
+        旧形式のJSONファイルを追記型ストアへ変換する。
+        一時ディレクトリに書いてから置換するので、途中で落ちても移行は中途半端にならない。
+        """
+        tmp_dir = directory + ".tmp"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+        records, packed, valid = [], [], []
+        for mem in self._load_legacy(filepath):
+            records.append({k: v for k, v in mem.items() if k != "vector"})
+            try:
+                packed.append(self._decode_vector(mem["vector"]))
+                valid.append(True)
+            except (KeyError, ValueError):
+                # 破損した記憶は想起されない行として保持
+                packed.append(np.zeros(self.hdc_dim // 8, dtype=np.uint8))
+                valid.append(False)
+
+        store = LTMStore(tmp_dir, hdc_dim=self.hdc_dim, max_memories=self.max_memories)
+        store.open()
+        store.append_many(records, packed, valid)
+        store.close()
+        os.replace(tmp_dir, directory)
+
+    def new_memory(
+        self, user_input: str, response: str, importance: float = 0.5
+    ) -> Dict:
+        """保存前の記憶レコードを作る (IDはこの時点で確定する)"""
+        return {
+            "id": str(uuid.uuid4()),
+            "timestamp": datetime.now().isoformat(),
+            "user_input": user_input,
+            "response": response,
+            "importance": importance,
+        }
 
     def save_memory(
         self,
@@ -108,47 +383,75 @@ class Hippocampus:
     ) -> str:
         """
         思考ベクトルとメタデータをLTMに保存する。
+        ストアへの小さな逐次追記1回だけで済み、ファイル全体は書き直さない。
 
         Args:
             vector: 4096dim HDCベクトル
             user_input: ユーザーの発話
             response: NPCの応答
-            filepath: 保存先JSONファイルパス
+            filepath: LTMファイルパス (ストアは store_path(filepath) に置かれる)
             importance: 重要度 (0.0-1.0)
 
         Returns:
             記憶のUUID
         """
-        memories = self.load_memories(filepath)
+        memory = self.new_memory(user_input, response, importance)
+        memory_id = memory["id"]
+        self.save_memories(filepath, [(memory, vector)])
 
-        memory_id = str(uuid.uuid4())
-        memory = {
-            "id": memory_id,
-            "timestamp": datetime.now().isoformat(),
-            "user_input": user_input,
-            "response": response,
-            "vector": self._encode_vector(vector),
-            "importance": importance,
-        }
-
-        memories.append(memory)
+        cortex_log.activity.info(
+            "             [LTM]: 💾 Memory Saved (ID: %s...)", memory_id[:8]
+        )
+        return memory_id
 
-        # 保存 (最大100件に制限してメモリ節約)
-        if len(memories) > 100:
-            # 重要度の低い古い記憶から削除
-            memories.sort(
-                key=lambda m: (m.get("importance", 0), m.get("timestamp", ""))
-            )
-            memories = memories[-100:]
+    def save_memories(
+        self,
+        filepath: str,
+        entries: Sequence[Tuple[Dict, np.ndarray]],
+        close_if_unloaded: bool = False,
+    ) -> List[str]:
+        """
+        複数の記憶を1つのLTMファイルにまとめて保存する (ストアへの追記・flush は1回)。
 
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(memories, f, ensure_ascii=False, indent=2)
+        Args:
+            filepath: LTMファイルパス
+            entries: (new_memory で作ったレコード, 思考ベクトル) のリスト
+            close_if_unloaded: 読み込まれていなかったファイルは、書き込み後に閉じる
 
-        print(f"             [LTM]: 💾 Memory Saved (ID: {memory_id[:8]}...)")
-        return memory_id
+        Returns:
+            保存した記憶IDのリスト
+        """
+        records, packed, valid = [], [], []
+        for memory, vector in entries:
+            vector = np.asarray(vector)
+            records.append(memory)
+            valid.append(bool(vector.any()))
+            packed.append(vector if vector.dtype == np.uint8 else pack_bipolar(vector))
+
+        # close() と競合しないよう、ストアの取得から追記までをロック内で行う
+        with metrics.stage(metrics.SAVE_MEMORY), self._index_lock:
+            was_loaded = filepath in self._indexes
+            index = self.index_for(filepath)
+            store = self._stores[filepath]
+            # 上限を超えた分はストアのバックグラウンドコンパクションで削除される
+            store.append_many(records, packed, valid)
+            for memory, bits, is_valid in zip(records, packed, valid):
+                index.add(memory, bits, is_valid)
+            if close_if_unloaded and not was_loaded:
+                self.close(filepath)
+        return [memory["id"] for memory in records]
 
     def load_memories(self, filepath: str) -> List[Dict]:
-        """LTMファイルから全記憶を読み込む"""
+        """LTMから全記憶を読み込む ('vector' はBase64エンコード済み)"""
+        index = self.index_for(filepath)
+        with index.lock:
+            return [
+                dict(record, vector=self._encode_vector(bits))
+                for record, bits in zip(index.records, index.packed)
+            ]
+
+    def _load_legacy(self, filepath: str) -> List[Dict]:
+        """旧形式のLTMファイル (JSON配列) を読み込む"""
         if not os.path.exists(filepath):
             return []
         try:
@@ -157,39 +460,45 @@ class Hippocampus:
         except (json.JSONDecodeError, IOError):
             return []
 
+    def close(self, filepath: Optional[str] = None):
+        """
+        ストアを閉じて常駐インデックスを破棄する (省略時は全て)。
+        次に使うときは再びストアから読み込まれる。
+        """
+        with self._index_lock:
+            targets = [filepath] if filepath else list(self._stores)
+            for path in targets:
+                store = self._stores.pop(path, None)
+                self._indexes.pop(path, None)
+                if store is not None:
+                    store.close()
+
     def recall(
         self,
         query_vector: np.ndarray,
         filepath: str,
         top_k: int = 3,
         similarity_threshold: float = 0.3,
+        exact: bool = False,
     ) -> List[Tuple[Dict, float]]:
         """
         類似記憶を検索して想起する。
+        ディスクは読まず、常駐インデックスに対する一括 XOR + popcount で検索する。
+        記憶が多いときは LSH で候補を絞る (近似検索)。
 
         Args:
             query_vector: 検索クエリとなる思考ベクトル
             filepath: LTMファイルパス
             top_k: 返す記憶の最大数
             similarity_threshold: 類似度の閾値
+            exact: True なら記憶の数に関わらず全件を比較する
 
         Returns:
             [(記憶Dict, 類似度), ...] のリスト（類似度降順）
         """
-        memories = self.load_memories(filepath)
-        if not memories:
-            return []
-
-        results = []
-        for mem in memories:
-            try:
-                stored_vec = self._decode_vector(mem["vector"])
-                sim = self.cosine_similarity(query_vector, stored_vec)
-                if sim >= similarity_threshold:
-                    results.append((mem, sim))
-            except (KeyError, ValueError):
-                continue  # 破損した記憶はスキップ
-
-        # 類似度でソートして上位K件を返す
-        results.sort(key=lambda x: x[1], reverse=True)
-        return results[:top_k]
+        return self.index_for(filepath).search(
+            query_vector,
+            top_k=top_k,
+            similarity_threshold=similarity_threshold,
+            exact=exact,
+        )
@@ -0,0 +1,234 @@
+"""
+Thin helpers over the low-level llama.cpp API (llama_cpp.*).
+llama-cpp-python の低レベル API は版によって関数名が変わるため、ここで吸収します。
+"""
+
+import ctypes
+from typing import Optional
+
+import llama_cpp
+import numpy as np
+
+
+def _first_attr(*names):
+    for name in names:
+        fn = getattr(llama_cpp, name, None)
+        if fn is not None:
+            return fn
+    return None
+
+
+def supports_batching() -> bool:
+    """Multi-sequence batching に必要な API が揃っているか"""
+    return all(
+        fn is not None
+        for fn in (
+            getattr(llama_cpp, "llama_batch_init", None),
+            getattr(llama_cpp, "llama_get_logits_ith", None),
+            _first_attr("llama_init_from_model", "llama_new_context_with_model"),
+        )
+    ) and (
+        getattr(llama_cpp, "llama_memory_seq_rm", None) is not None
+        or _first_attr("llama_kv_self_seq_rm", "llama_kv_cache_seq_rm") is not None
+    )
+
+
+def new_context(
+    model,
+    n_ctx: int,
+    n_batch: int = 512,
+    n_seq_max: int = 1,
+    embeddings: bool = False,
+    n_threads: Optional[int] = None,
+):
+    """
+    Creates an extra llama.cpp context on an already loaded model.
+    The weights (mmap) are shared; only the KV cache and compute buffers are new.
+    """
+    params = llama_cpp.llama_context_default_params()
+    params.n_ctx = n_ctx
+    params.n_batch = n_batch
+    if hasattr(params, "n_ubatch"):
+        params.n_ubatch = min(n_batch, 512)
+    params.n_seq_max = n_seq_max
+    params.embeddings = embeddings
+    if n_threads:
+        params.n_threads = n_threads
+        params.n_threads_batch = n_threads
+
+    create = _first_attr("llama_init_from_model", "llama_new_context_with_model")
+    ctx = create(model, params)
+    if not ctx:
+        raise RuntimeError("Failed to create llama.cpp context")
+    return ctx
+
+
+def free_context(ctx):
+    llama_cpp.llama_free(ctx)
+
+
+def kv_seq_rm(ctx, seq_id: int, p0: int = -1, p1: int = -1):
+    """Removes the KV cache cells of seq_id in [p0, p1) (-1 = open range)"""
+    if getattr(llama_cpp, "llama_memory_seq_rm", None) is not None:
+        llama_cpp.llama_memory_seq_rm(llama_cpp.llama_get_memory(ctx), seq_id, p0, p1)
+    else:
+        _first_attr("llama_kv_self_seq_rm", "llama_kv_cache_seq_rm")(
+            ctx, seq_id, p0, p1
+        )
+
+
+def logits_row(ctx, i: int, n_vocab: int) -> np.ndarray:
+    """
+    Logits of the i-th token of the last batch (a view into llama.cpp's buffer;
+    copy it before the next decode if it must be kept).
+    """
+    ptr = llama_cpp.llama_get_logits_ith(ctx, i)
+    return np.ctypeslib.as_array(ptr, shape=(n_vocab,))
+
+
+def is_eog(model, token: int) -> bool:
+    """End-of-generation token (EOS / EOT / <|im_end|> ...)"""
+    vocab_is_eog = getattr(llama_cpp, "llama_vocab_is_eog", None)
+    if vocab_is_eog is not None:
+        return bool(vocab_is_eog(llama_cpp.llama_model_get_vocab(model), token))
+    token_is_eog = getattr(llama_cpp, "llama_token_is_eog", None)
+    if token_is_eog is not None:
+        return bool(token_is_eog(model, token))
+    return False
+
+
+class TokenBatch:
+    """
+    A reusable llama_batch that can hold tokens of several sequences.
+    """
+
+    def __init__(self, capacity: int, n_seq_max: int = 1):
+        self.capacity = capacity
+        self.batch = llama_cpp.llama_batch_init(capacity, 0, n_seq_max)
+        self.n_tokens = 0
+
+    def clear(self):
+        self.n_tokens = 0
+        self.batch.n_tokens = 0
+
+    def add(self, token: int, pos: int, seq_id: int, logits: bool) -> int:
+        """Appends a token and returns its index in the batch"""
+        i = self.n_tokens
+        if i >= self.capacity:
+            raise ValueError("batch is full")
+        self.batch.token[i] = token
+        self.batch.pos[i] = pos
+        self.batch.n_seq_id[i] = 1
+        self.batch.seq_id[i][0] = seq_id
+        self.batch.logits[i] = logits
+        self.n_tokens = i + 1
+        self.batch.n_tokens = self.n_tokens
+        return i
+
+    def decode(self, ctx):
+        ret = llama_cpp.llama_decode(ctx, self.batch)
+        if ret != 0:
+            raise RuntimeError(f"llama_decode failed ({ret})")
+
+    def free(self):
+        if self.batch is not None:
+            llama_cpp.llama_batch_free(self.batch)
+            self.batch = None
+
+
+def supports_seq_state() -> bool:
+    """Per-sequence state save/restore (used by the prefix cache)"""
+    return getattr(llama_cpp, "llama_state_seq_set_data", None) is not None
+
+
+def seq_state_get(ctx, seq_id: int) -> bytes:
+    """Serialized KV cache state of one sequence (llama_state_seq_get_data)"""
+    size = llama_cpp.llama_state_seq_get_size(ctx, seq_id)
+    buf = (ctypes.c_uint8 * size)()
+    written = llama_cpp.llama_state_seq_get_data(ctx, buf, size, seq_id)
+    return bytes(buf[:written])
+
+
+def seq_state_set(ctx, data: bytes, seq_id: int) -> bool:
+    """Restores a state saved by seq_state_get into seq_id. False if it was rejected."""
+    buf = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+    return llama_cpp.llama_state_seq_set_data(ctx, buf, len(data), seq_id) > 0
+
+
+def n_embd(model) -> int:
+    """Hidden size of the loaded model"""
+    return int(_first_attr("llama_model_n_embd", "llama_n_embd")(model))
+
+
+def set_embeddings(ctx, enabled: bool):
+    """Turns hidden-state output on/off for the following llama_decode calls"""
+    llama_cpp.llama_set_embeddings(ctx, enabled)
+
+
+def embeddings_row(ctx, i: int, dim: int) -> Optional[np.ndarray]:
+    """
+    Hidden state of the i-th output of the last batch (-1 = last).
+    None if the context did not compute embeddings for it.
+    """
+    ptr = llama_cpp.llama_get_embeddings_ith(ctx, i)
+    if not ptr:
+        return None
+    return np.ctypeslib.as_array(ptr, shape=(dim,))
+
+
+class HiddenStatePool:
+    """
+    Logits processor that mean-pools the generator's hidden states while it decodes.
+
+    Pass it in `logits_processor` of Llama.create_completion. Hidden-state output is
+    switched on right after the prompt is evaluated (so prefill does not pay for it)
+    and each later step adds the hidden state of the token just decoded. The thought
+    vector comes out of the KV/compute the generation already did; nothing is
+    re-encoded.
+    """
+
+    def __init__(self, llm, dim: int):
+        self.llm = llm
+        self.dim = dim
+        self.total = np.zeros(dim, dtype=np.float64)
+        self.count = 0
+        self._enabled = False
+
+    def __call__(self, input_ids: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        if not self._enabled:
+            set_embeddings(self.llm.ctx, True)
+            self._enabled = True
+        else:
+            row = embeddings_row(self.llm.ctx, -1, self.dim)
+            if row is not None:
+                self.total += row
+                self.count += 1
+        return scores
+
+    def close(self):
+        if self._enabled:
+            set_embeddings(self.llm.ctx, False)
+            self._enabled = False
+
+    def mean(self) -> Optional[np.ndarray]:
+        if self.count == 0:
+            return None
+        return (self.total / self.count).astype(np.float32)
+
+
+def mean_embedding(ctx, batch: "TokenBatch", tokens, dim: int) -> np.ndarray:
+    """
+    Encodes tokens in an embeddings context (seq 0) and mean-pools their hidden states.
+    The sequence is cleared afterwards so the context can be reused.
+    """
+    total = np.zeros(dim, dtype=np.float64)
+    for start in range(0, len(tokens), batch.capacity):
+        chunk = tokens[start : start + batch.capacity]
+        batch.clear()
+        for j, token in enumerate(chunk):
+            batch.add(token, start + j, 0, True)
+        batch.decode(ctx)
+        for j in range(len(chunk)):
+            total += embeddings_row(ctx, j, dim)
+    kv_seq_rm(ctx, 0, -1, -1)
+    return (total / max(len(tokens), 1)).astype(np.float32)
@@ -0,0 +1,311 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import config
+from hdc_bits import hamming_similarity, pack_bipolar, unpack_bipolar
+
+
+class BitSamplingLSH:
+    """
+    パック済み HDC ベクトル用の近似最近傍インデックス (ビットサンプリング LSH)。
+
+    各テーブルはランダムに選んだ bits 個のビットをキーにしてベクトルをバケットに分ける。
+    類似度 s のベクトル同士が1つのテーブルで同じキーになる確率は ((1+s)/2)^bits なので、
+    テーブル数を増やすほど再現率が上がり、bits を増やすほど候補が絞られて速くなる。
+    probe_radius=1 ならキーを1ビットずつ反転したバケットも引く (マルチプローブ)。
+
+    全テーブルのバケットは「(テーブル番号 << bits | キー) << 32 | 行番号」を整列した
+    1本の uint64 配列として持つ。キーの上位ビットごとの開始位置 (ディレクトリ) を
+    別に持つので、想起は二分探索せずにプローブごとの区間を直接引ける。
+    """
+
+    def __init__(
+        self,
+        hdc_dim: int = config.HDC_DIM,
+        n_tables: int = config.LTM_ANN_TABLES,
+        bits: int = config.LTM_ANN_BITS,
+        probe_radius: int = config.LTM_ANN_PROBE_RADIUS,
+        seed: int = 0,
+    ):
+        if not 0 < bits <= 24 or n_tables << bits > 1 << 32:
+            raise ValueError(
+                f"{n_tables} tables x {bits} bits do not fit in 32-bit keys"
+            )
+        rng = np.random.default_rng(seed)
+        positions = np.concatenate(
+            [rng.choice(hdc_dim, bits, replace=False) for _ in range(n_tables)]
+        )
+        # packbits はビッグエンディアン (次元 0 がバイトの最上位ビット)
+        self._byte = positions // 8
+        self._shift = (7 - positions % 8).astype(np.uint8)
+        self._bits = bits
+        self._weights = np.left_shift(np.uint32(1), np.arange(bits, dtype=np.uint32))
+        self._table_offset = np.arange(n_tables, dtype=np.uint32) << np.uint32(bits)
+        flips = [0] + ([1 << j for j in range(bits)] if probe_radius >= 1 else [])
+        self._flips = np.array(flips, dtype=np.uint32)
+
+        self._key_bits = bits + max(0, int(n_tables - 1).bit_length())
+        self._entries = np.empty(0, dtype=np.uint64)
+        self._directory = np.zeros(2, dtype=np.uint32)
+        self._dir_shift = self._key_bits
+        self.n_indexed = 0  # 行 0..n_indexed-1 がバケットに入っている
+
+    def hash(self, packed: np.ndarray, chunk: int = 8192) -> np.ndarray:
+        """(n, D/8) のパック済みベクトル → (n, n_tables) のバケットキー"""
+        n_tables = len(self._table_offset)
+        keys = np.empty((len(packed), n_tables), dtype=np.uint32)
+        for start in range(0, len(packed), chunk):
+            block = np.take(packed[start : start + chunk], self._byte, axis=1)
+            bits = ((block >> self._shift) & 1).reshape(-1, n_tables, self._bits)
+            keys[start : start + chunk] = np.sum(
+                bits * self._weights, axis=-1, dtype=np.uint32
+            )
+        return keys + self._table_offset
+
+    def insert(self, packed: np.ndarray):
+        """行 n_indexed 以降の記憶を追加する (整列済みの配列への線形マージ)"""
+        n_new = len(packed)
+        if n_new == 0:
+            return
+        rows = np.arange(self.n_indexed, self.n_indexed + n_new, dtype=np.uint64)
+        entries = (self.hash(packed).astype(np.uint64) << np.uint64(32)) | rows[:, None]
+        entries = np.sort(entries.ravel())
+        if len(self._entries):
+            entries = np.insert(
+                self._entries, np.searchsorted(self._entries, entries), entries
+            )
+        self._entries = entries
+        self.n_indexed += n_new
+        self._build_directory()
+
+    def remove(self, rows: np.ndarray):
+        """
+        行 rows をバケットから除き、後ろの行番号を詰める (LTMIndex.remove の詰め直しと同じ)。
+        行番号の付け替えは単調なので、entries は整列したまま作り直さずに済む。
+        """
+        gone = np.zeros(self.n_indexed, dtype=bool)
+        rows = np.asarray(rows, dtype=np.int64)
+        gone[rows[rows < self.n_indexed]] = True
+        n_removed = int(gone.sum())
+        if n_removed == 0:
+            return
+        # 行番号は下位 32 ビットなので、前にある削除行の数を引けばキーはそのまま残る
+        shift = np.cumsum(gone, dtype=np.uint64)
+        entry_rows = (self._entries & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        keep = ~gone[entry_rows]
+        self._entries = self._entries[keep] - shift[entry_rows[keep]]
+        self.n_indexed -= n_removed
+        self._build_directory()
+
+    def _build_directory(self):
+        """キーの上位ビット → entries の開始位置 (1区画あたり平均 ~4 件になる粒度)"""
+        n = len(self._entries)
+        dir_bits = min(self._key_bits, max(1, n.bit_length() - 2))
+        self._dir_shift = self._key_bits - dir_bits
+        prefixes = self._entries >> np.uint64(32 + self._dir_shift)
+        counts = np.bincount(prefixes.astype(np.int64), minlength=1 << dir_bits)
+        self._directory = np.zeros(len(counts) + 1, dtype=np.uint32)
+        np.cumsum(counts, out=self._directory[1:])
+
+    def candidates(self, query_packed: np.ndarray) -> np.ndarray:
+        """クエリといずれかのテーブル (プローブ) でキーが一致した行番号 (重複なし)"""
+        query_keys = self.hash(query_packed[None, :])[0]
+        probes = (query_keys[:, None] ^ self._flips[None, :]).ravel()
+        slots = probes >> np.uint32(self._dir_shift)
+        lo = self._directory[slots].astype(np.int64)
+        counts = self._directory[slots + 1] - lo
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # 各区画 [lo, lo + count) を連結し、キーが完全に一致するものだけを残す
+        offsets = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        entries = self._entries[offsets + np.arange(total)]
+        match = (entries >> np.uint64(32)) == np.repeat(probes, counts)
+        rows = entries[match] & np.uint64(0xFFFFFFFF)
+        return np.unique(rows.astype(np.int64))
+
+    @property
+    def nbytes(self) -> int:
+        return self._entries.nbytes + self._directory.nbytes
+
+
+class LTMIndex:
+    """
+    常駐型の長期記憶 (LTM) ベクトルインデックス。
+    全記憶のベクトルをビットパックした1つの連続した (N × D/8) 行列として保持し、
+    想起を「一括 XOR + popcount (ハミング距離) + argpartition」で行います。
+    バイポーラベクトルではハミング類似度がコサイン類似度と厳密に一致します。
+    ストアの読み込みは最初の1回だけで、以降は save_memory に合わせて差分更新されます。
+    記憶が ann_min_size 件以上になると、近似検索 (BitSamplingLSH) で候補を絞ってから
+    候補だけをハミング距離で並べ替えます (exact=True で常に全件比較)。
+    """
+
+    def __init__(
+        self,
+        hdc_dim: int = config.HDC_DIM,
+        capacity: int = 256,
+        ann_min_size: int = config.LTM_ANN_MIN_SIZE,
+        ann_merge_rows: int = config.LTM_ANN_MERGE_ROWS,
+    ):
+        """
+        Args:
+            hdc_dim: HDCベクトルの次元数
+            capacity: 初期確保する行数 (足りなくなれば倍々で拡張)
+            ann_min_size: 近似検索を使い始める記憶の件数 (これ未満は全件比較で十分速い)
+            ann_merge_rows: LSH に未登録の行がこれだけ溜まったらマージする (それまでは全件比較)
+        """
+        self.hdc_dim = hdc_dim
+        self.row_bytes = hdc_dim // 8
+        self._bits = np.zeros((capacity, self.row_bytes), dtype=np.uint8)
+        # ゼロベクトル (破損した記憶など) は想起対象から外す
+        self._valid = np.zeros(capacity, dtype=bool)
+        # ベクトル以外のメタデータ (行番号と同じ順序)
+        self.records: List[Dict] = []
+        self.lock = threading.RLock()
+
+        self.ann_min_size = ann_min_size
+        self.ann_merge_rows = ann_merge_rows
+        self._lsh: Optional[BitSamplingLSH] = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def nbytes(self) -> int:
+        """ベクトル行列と LSH が確保しているメモリ量 (メタデータは含まない)"""
+        lsh_bytes = self._lsh.nbytes if self._lsh is not None else 0
+        return self._bits.nbytes + self._valid.nbytes + lsh_bytes
+
+    @property
+    def packed(self) -> np.ndarray:
+        """有効な行だけの (N × D/8) パック済みビュー"""
+        return self._bits[: len(self.records)]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """有効な行をバイポーラ (N × D) に展開したもの (ゼロベクトルの行は0)"""
+        n = len(self.records)
+        return unpack_bipolar(self._bits[:n], self.hdc_dim) * self._valid[:n, None]
+
+    def _reserve(self, n_rows: int):
+        capacity = self._bits.shape[0]
+        if n_rows <= capacity:
+            return
+        while capacity < n_rows:
+            capacity *= 2
+        bits = np.zeros((capacity, self.row_bytes), dtype=np.uint8)
+        valid = np.zeros(capacity, dtype=bool)
+        n = len(self.records)
+        bits[:n] = self._bits[:n]
+        valid[:n] = self._valid[:n]
+        self._bits, self._valid = bits, valid
+
+    def _to_packed(self, vector: np.ndarray) -> Tuple[np.ndarray, bool]:
+        """バイポーラ (D,) またはパック済み (D/8,) uint8 を受け取り、パック済みにする"""
+        vector = np.asarray(vector)
+        if vector.dtype == np.uint8 and vector.shape == (self.row_bytes,):
+            return vector, True
+        return pack_bipolar(vector), bool(vector.any())
+
+    def add(self, record: Dict, vector: np.ndarray, valid: Optional[bool] = None):
+        """
+        記憶を1件追加する (record には 'vector' を含めない)。
+        vector はバイポーラ (D,) またはパック済み (D/8,) uint8。
+        valid=False の行は想起対象にならない (省略時はゼロベクトルかどうかで判定)。
+        """
+        packed, is_valid = self._to_packed(vector)
+        with self.lock:
+            row = len(self.records)
+            self._reserve(row + 1)
+            self._bits[row] = packed
+            self._valid[row] = is_valid if valid is None else valid
+            self.records.append(record)
+
+    def extend(self, records: List[Dict], packed: np.ndarray, valid: np.ndarray):
+        """パック済みの記憶をまとめて追加する (ストアからの読み込み用)"""
+        with self.lock:
+            start = len(self.records)
+            end = start + len(records)
+            self._reserve(end)
+            self._bits[start:end] = packed
+            self._valid[start:end] = valid
+            self.records.extend(records)
+
+    def remove(self, memory_ids: Iterable[str]) -> int:
+        """指定IDの記憶を削除し、行列を詰め直す。削除件数を返す"""
+        targets = set(memory_ids)
+        with self.lock:
+            keep = [i for i, r in enumerate(self.records) if r.get("id") not in targets]
+            removed = len(self.records) - len(keep)
+            if removed and self._lsh is not None:
+                # 検索を止めて作り直さないよう、削除した行だけをバケットから抜く
+                dropped = np.setdiff1d(np.arange(len(self.records)), keep)
+                self._lsh.remove(dropped)
+            if removed:
+                n = len(keep)
+                self._bits[:n] = self._bits[keep]
+                self._valid[:n] = self._valid[keep]
+                self._bits[n : len(self.records)] = 0
+                self._valid[n : len(self.records)] = False
+                self.records = [self.records[i] for i in keep]
+            return removed
+
+    def _sync_lsh(self) -> Optional[BitSamplingLSH]:
+        """近似検索を使う件数なら、未登録の行を LSH にマージして返す (lock 内で呼ぶ)"""
+        n = len(self.records)
+        if n < self.ann_min_size:
+            return None
+        if self._lsh is None:
+            self._lsh = BitSamplingLSH(self.hdc_dim)
+        lsh = self._lsh
+        if lsh.n_indexed == 0 or n - lsh.n_indexed >= self.ann_merge_rows:
+            lsh.insert(self._bits[lsh.n_indexed : n])
+        return lsh
+
+    def search(
+        self,
+        query_vector: np.ndarray,
+        top_k: int = 3,
+        similarity_threshold: float = 0.3,
+        exact: bool = False,
+    ) -> List[Tuple[Dict, float]]:
+        """
+        コサイン類似度 (= バイポーラ間のハミング類似度) の上位K件を返す。
+
+        Args:
+            exact: True なら件数に関わらず全件比較する (近似検索は似た記憶を取りこぼしうる)
+
+        Returns:
+            [(記憶Dict, 類似度), ...] のリスト（類似度降順）
+        """
+        query_packed, query_valid = self._to_packed(query_vector)
+        with self.lock:
+            n = len(self.records)
+            if n == 0 or not query_valid or top_k <= 0:
+                return []
+
+            lsh = None if exact else self._sync_lsh()
+            if lsh is None:
+                rows = np.arange(n)
+                sims = hamming_similarity(query_packed, self._bits[:n], self.hdc_dim)
+            else:
+                # LSH の候補 + まだマージしていない末尾の行だけを比較する
+                rows = np.concatenate(
+                    [lsh.candidates(query_packed), np.arange(lsh.n_indexed, n)]
+                )
+                sims = hamming_similarity(query_packed, self._bits[rows], self.hdc_dim)
+            sims[~self._valid[rows]] = 0.0
+
+            if len(rows) > top_k:
+                top = np.argpartition(-sims, top_k - 1)[:top_k]
+            else:
+                top = np.arange(len(rows))
+            top = top[np.argsort(-sims[top], kind="stable")]
+
+            return [
+                (self.records[rows[i]], float(sims[i]))
+                for i in top
+                if sims[i] >= similarity_threshold
+            ]
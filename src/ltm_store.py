@@ -0,0 +1,387 @@
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import config
+
+MANIFEST_NAME = "MANIFEST.json"
+STORE_VERSION = 1
+
+
+class LTMStore:
+    """
+    ログ構造型 (追記専用) の長期記憶ストア。
+
+    ディレクトリ構成:
+        MANIFEST.json      : 現在の世代・次元数 (一時ファイル + os.replace でアトミックに更新)
+        vectors.<gen>.bin  : パック済みベクトル (hdc_dim/8 bytes) の固定長レコード
+        meta.<gen>.jsonl   : メタデータログ (1行1レコード, 行番号 = ベクトルの行番号)
+
+    1ターン分の永続化は「ベクトル1行 + JSON1行」の逐次追記だけで済みます。
+    クラッシュで途中まで書かれた末尾レコードは、次回オープン時に切り詰めて復旧します。
+    記憶数が上限を超えると、バックグラウンドで重要度/新しさに基づく削除 (コンパクション) を行い、
+    新しい世代のファイルに書き直します。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        hdc_dim: int = config.HDC_DIM,
+        max_memories: int = config.LTM_MAX_MEMORIES,
+        compact_slack: float = config.LTM_COMPACT_SLACK,
+        fsync: bool = config.LTM_FSYNC,
+        on_compact: Optional[Callable[[List[str]], None]] = None,
+    ):
+        """
+        Args:
+            directory: ストアのディレクトリ
+            hdc_dim: HDCベクトルの次元数
+            max_memories: コンパクション後に残す記憶の上限
+            compact_slack: 上限をこの割合だけ超えたらコンパクションを開始する
+            fsync: 追記ごとに fsync するか (False なら OS のバッファへ flush のみ)
+            on_compact: コンパクションで削除された記憶IDを受け取るコールバック
+        """
+        self.directory = directory
+        self.hdc_dim = hdc_dim
+        self.row_bytes = hdc_dim // 8
+        self.max_memories = max_memories
+        self.compact_slack = compact_slack
+        self.fsync = fsync
+        self.on_compact = on_compact
+
+        self.generation = 0
+        self.n_rows = 0
+        self._vec_file = None
+        self._meta_file = None
+        self._lock = threading.RLock()
+        self._compactor: Optional[threading.Thread] = None
+
+    # =========================================
+    # パス
+    # =========================================
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def _vec_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"vectors.{generation}.bin")
+
+    def _meta_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"meta.{generation}.jsonl")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    # =========================================
+    # オープン / 復旧
+    # =========================================
+
+    def open(self) -> Tuple[List[Dict], np.ndarray, np.ndarray]:
+        """
+        ストアを開き、全記憶を読み込む。末尾の壊れたレコードは切り詰める。
+
+        Returns:
+            (メタデータのリスト, パック済みベクトル (N, hdc_dim/8), ベクトル有効フラグ (N,))
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.exists():
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if manifest.get("hdc_dim") != self.hdc_dim:
+                    raise ValueError(
+                        f"LTM store {self.directory} has hdc_dim={manifest.get('hdc_dim')}, "
+                        f"expected {self.hdc_dim}"
+                    )
+                self.generation = manifest["generation"]
+            else:
+                self.generation = 0
+                self._write_manifest()
+
+            records, packed, valid = self._recover(self.generation)
+            self.n_rows = len(records)
+            self._vec_file = open(self._vec_path(self.generation), "ab")
+            self._meta_file = open(self._meta_path(self.generation), "ab")
+            self._remove_stale_generations()
+            return records, packed, valid
+
+    def _recover(self, generation: int) -> Tuple[List[Dict], np.ndarray, np.ndarray]:
+        """セグメントを読み、ベクトルとメタデータが両方揃っている行までを有効とする"""
+        meta_path = self._meta_path(generation)
+        vec_path = self._vec_path(generation)
+
+        records: List[Dict] = []
+        line_ends: List[int] = []
+        if os.path.exists(meta_path):
+            offset = 0
+            with open(meta_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # 書き込み途中で途切れた行
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    offset += len(line)
+                    line_ends.append(offset)
+
+        n_vec = 0
+        if os.path.exists(vec_path):
+            n_vec = os.path.getsize(vec_path) // self.row_bytes
+
+        # ベクトルとメタデータの両方が揃っている行数に揃える
+        n = min(len(records), n_vec)
+        records = records[:n]
+        good_meta_bytes = line_ends[n - 1] if n else 0
+        self._truncate(meta_path, good_meta_bytes)
+        self._truncate(vec_path, n * self.row_bytes)
+
+        packed = np.zeros((n, self.row_bytes), dtype=np.uint8)
+        if n:
+            packed[:] = np.fromfile(
+                vec_path, dtype=np.uint8, count=n * self.row_bytes
+            ).reshape(n, self.row_bytes)
+        valid = np.array([r.pop("has_vector", True) for r in records], dtype=bool)
+        return records, packed, valid
+
+    @staticmethod
+    def _truncate(path: str, size: int):
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        elif os.path.getsize(path) != size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _write_manifest(self):
+        """MANIFEST を一時ファイルに書いてから置換する (アトミック)"""
+        manifest = {
+            "version": STORE_VERSION,
+            "generation": self.generation,
+            "hdc_dim": self.hdc_dim,
+            "rows": self.n_rows,
+        }
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def _remove_stale_generations(self):
+        for name in os.listdir(self.directory):
+            parts = name.split(".")
+            if len(parts) == 3 and parts[0] in ("vectors", "meta"):
+                if parts[1].isdigit() and int(parts[1]) != self.generation:
+                    os.remove(os.path.join(self.directory, name))
+
+    # =========================================
+    # 追記
+    # =========================================
+
+    @staticmethod
+    def _encode_meta(record: Dict, valid: bool) -> bytes:
+        if not valid:
+            record = dict(record, has_vector=False)
+        return json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+
+    def append(self, record: Dict, packed: np.ndarray, valid: bool = True):
+        """記憶を1件追記する (ベクトル1行 + メタデータ1行)"""
+        self.append_many([record], [packed], [valid])
+
+    def append_many(
+        self,
+        records: Sequence[Dict],
+        packed: Sequence[np.ndarray],
+        valid: Optional[Sequence[bool]] = None,
+    ):
+        """
+        複数の記憶をまとめて追記する。書き込み・flush・fsync はそれぞれ1回だけ。
+        ベクトルを先に書くので、途中で落ちてもメタデータの無い行は復旧時に捨てられる。
+        """
+        if not records:
+            return
+        if valid is None:
+            valid = [True] * len(records)
+        vec_bytes = b"".join(np.asarray(p, dtype=np.uint8).tobytes() for p in packed)
+        meta_bytes = b"".join(self._encode_meta(r, v) for r, v in zip(records, valid))
+
+        with self._lock:
+            if self._vec_file is None:
+                raise RuntimeError(f"LTM store {self.directory} is not open")
+            self._vec_file.write(vec_bytes)
+            self._vec_file.flush()
+            self._meta_file.write(meta_bytes)
+            self._meta_file.flush()
+            if self.fsync:
+                self.sync()
+            self.n_rows += len(records)
+            needs_compaction = self.n_rows > self.max_memories * (
+                1 + self.compact_slack
+            )
+
+        if needs_compaction:
+            self.compact_in_background()
+
+    def sync(self):
+        """セグメントをディスクまで書き出す"""
+        with self._lock:
+            for f in (self._vec_file, self._meta_file):
+                if f is not None:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    # =========================================
+    # コンパクション
+    # =========================================
+
+    def compact_in_background(self):
+        """コンパクションをバックグラウンドスレッドで開始する (実行中なら何もしない)"""
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(
+                target=self._compact_until_within_limit,
+                name="ltm-compactor",
+                daemon=True,
+            )
+            self._compactor.start()
+
+    def _needs_compaction(self) -> bool:
+        return self.n_rows > self.max_memories * (1 + self.compact_slack)
+
+    def _compact_until_within_limit(self):
+        # コンパクション中に追記された分で再び上限を超えていれば、もう一度行う
+        while self._vec_file is not None and self._needs_compaction():
+            self.compact()
+
+    def compact(self) -> List[str]:
+        """
+        上限を超えた記憶を「重要度の低い古いもの」から削除し、新しい世代に書き直す。
+        ロックを持つのは開始時のスナップショットと最後の世代切り替えだけなので、
+        書き直している間も追記 (save_memory) は待たされません。
+
+        Returns:
+            削除された記憶IDのリスト
+        """
+        with self._lock:
+            if self._vec_file is None:
+                return []
+            self._vec_file.flush()
+            self._meta_file.flush()
+            generation = self.generation
+            n_rows = self.n_rows
+            meta_end = self._meta_file.tell()
+
+        # スナップショット時点までの行を読み、新しい世代に書き直す (ロックの外)
+        records, packed, valid = self._read_rows(generation, 0, 0, meta_end)
+        keep = self._select_survivors(records)
+        keep_set = set(keep)
+        evicted = [r.get("id") for i, r in enumerate(records) if i not in keep_set]
+        new_gen = generation + 1
+        self._write_segment(
+            new_gen,
+            packed[keep].tobytes(),
+            b"".join(self._encode_meta(records[i], valid[i]) for i in keep),
+        )
+
+        with self._lock:
+            if self._vec_file is None or self.generation != generation:
+                # 書き直している間に閉じられた: 新しい世代は使わない
+                self._remove_segment(new_gen)
+                return []
+            # スナップショット以降に追記された行を新しい世代の末尾に移す
+            self._vec_file.flush()
+            self._meta_file.flush()
+            tail = self.n_rows - n_rows
+            if tail:
+                tail_records, tail_packed, tail_valid = self._read_rows(
+                    generation, n_rows, meta_end, self._meta_file.tell()
+                )
+                self._write_segment(
+                    new_gen,
+                    tail_packed.tobytes(),
+                    b"".join(
+                        self._encode_meta(r, v)
+                        for r, v in zip(tail_records, tail_valid)
+                    ),
+                    mode="ab",
+                )
+
+            # MANIFEST の置換が世代切り替えのコミットポイント
+            self._vec_file.close()
+            self._meta_file.close()
+            self.generation = new_gen
+            self.n_rows = len(keep) + tail
+            self._write_manifest()
+            self._vec_file = open(self._vec_path(new_gen), "ab")
+            self._meta_file = open(self._meta_path(new_gen), "ab")
+            self._remove_stale_generations()
+
+        if evicted and self.on_compact:
+            self.on_compact(evicted)
+        return evicted
+
+    def _read_rows(
+        self, generation: int, start_row: int, meta_start: int, meta_end: int
+    ) -> Tuple[List[Dict], np.ndarray, np.ndarray]:
+        """セグメントの start_row 行目以降を、メタデータの [meta_start, meta_end) の範囲だけ読む"""
+        with open(self._meta_path(generation), "rb") as f:
+            f.seek(meta_start)
+            lines = f.read(meta_end - meta_start).splitlines()
+        records = [json.loads(line) for line in lines]
+        n = len(records)
+        packed = np.fromfile(
+            self._vec_path(generation),
+            dtype=np.uint8,
+            count=n * self.row_bytes,
+            offset=start_row * self.row_bytes,
+        ).reshape(n, self.row_bytes)
+        valid = np.array([r.pop("has_vector", True) for r in records], dtype=bool)
+        return records, packed, valid
+
+    def _write_segment(
+        self, generation: int, vec_bytes: bytes, meta_bytes: bytes, mode: str = "wb"
+    ):
+        for path, data in (
+            (self._vec_path(generation), vec_bytes),
+            (self._meta_path(generation), meta_bytes),
+        ):
+            with open(path, mode) as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _remove_segment(self, generation: int):
+        for path in (self._vec_path(generation), self._meta_path(generation)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _select_survivors(self, records: List[Dict]) -> List[int]:
+        """重要度・新しさの上位 max_memories 件の行番号を、元の順序で返す"""
+        if len(records) <= self.max_memories:
+            return list(range(len(records)))
+        ranked = sorted(
+            range(len(records)),
+            key=lambda i: (
+                records[i].get("importance", 0),
+                records[i].get("timestamp", ""),
+            ),
+        )
+        return sorted(ranked[-self.max_memories :])
+
+    def close(self):
+        """追記ファイルを閉じ、MANIFEST にチェックポイントを書く"""
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            if self._vec_file is None:
+                return
+            self.sync()
+            self._vec_file.close()
+            self._meta_file.close()
+            self._vec_file = self._meta_file = None
+            self._write_manifest()
@@ -1,9 +1,38 @@
+import os
 import threading
 import queue
 import time
+import multiprocessing as mp
+from concurrent.futures import Future
+from multiprocessing import connection as mp_connection
+from multiprocessing import shared_memory
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from typing import Tuple, Optional, Callable
+from typing import Tuple, Optional, Callable, List, Sequence, Dict, Set
+
+import config
+
+EncodeCallback = Callable[[str, np.ndarray], None]
+
+
+def _drain_batch(tasks, first, max_batch: int, max_wait: float) -> Tuple[List, bool]:
+    """
+    キューから最初の依頼に続けて、max_batch 件か max_wait 秒まで依頼を集める。
+    None (停止の合図。それまでの依頼は処理してから終わる) を受け取ったら、
+    そこまでの依頼と True を返す。
+    """
+    batch = [first]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_batch:
+        remaining = deadline - time.monotonic()
+        try:
+            item = tasks.get(timeout=remaining) if remaining > 0 else tasks.get_nowait()
+        except queue.Empty:
+            break
+        if item is None:
+            return batch, True
+        batch.append(item)
+    return batch, False
 
 
 class MemoryCortex(threading.Thread):
@@ -11,59 +40,119 @@ class MemoryCortex(threading.Thread):
     非同期メモリエンコーダー（海馬サブプロセス）。
     軽量モデル（SentenceTransformer）を使用して、メインスレッドをブロックせずに
     テキストをベクトル化（記憶化）します。
+    依頼はまとめて (マイクロバッチ) 1回の encode で処理します。
     """
 
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        max_batch: int = config.MEMORY_ENCODE_BATCH,
+        max_wait_ms: float = config.MEMORY_ENCODE_WAIT_MS,
+        collect_results: bool = True,
+    ):
+        """
+        Args:
+            model_name: SentenceTransformer のモデル名
+            max_batch: 1回の encode にまとめる依頼の上限
+            max_wait_ms: 最初の依頼が届いてから、後続の依頼を待つ最大時間
+            collect_results: 結果を output_queue にも入れる (retrieve_memories 用)
+        """
         super().__init__(daemon=True)
         self.input_queue = queue.Queue()
         self.output_queue = queue.Queue()
         self.model_name = model_name
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self.collect_results = collect_results
         self.running = True
         self.embedder = None
         self.is_ready = False
+        # running の確認と投入を、停止の合図 (None) の投入と排他にする
+        self._submit_lock = threading.Lock()
 
     def run(self):
         """
         バックグラウンドスレッドのメインループ。
-        モデルをロードし、キューからテキストを取り出してベクトル化します。
+        モデルをロードし、キューに溜まった依頼をまとめてベクトル化します。
         """
         print(f"[MemoryCortex] 軽量モデルをロード中: {self.model_name}...")
         try:
-            self.embedder = SentenceTransformer(self.model_name)
+            self.embedder = self._load_model()
             self.is_ready = True
             print(f"[MemoryCortex] 準備完了。バックグラウンドで記憶待機中。")
         except Exception as e:
             print(f"[MemoryCortex] モデルロード失敗: {e}")
-            self.running = False
+            with self._submit_lock:
+                self.running = False
+                self._fail_pending(e)
             return
 
-        while self.running:
-            try:
-                # タイムアウト付きで取得することで、終了フラグを確認できる
-                text = self.input_queue.get(timeout=1.0)
+        while True:
+            # 依頼が来るまでブロックする (ポーリングしないので停止も即座に伝わる)
+            item = self.input_queue.get()
+            if item is None:
+                break
+            batch, stopping = _drain_batch(
+                self.input_queue, item, self.max_batch, self.max_wait
+            )
+            self._encode_batch(batch)
+            if stopping:
+                break
 
-                # ベクトル化（CPUでも高速）
-                vector = self.embedder.encode(text)
+    def _load_model(self):
+        return SentenceTransformer(self.model_name)
 
-                # 結果を出力キューへ（必要ならコールバック発火も可）
-                self.output_queue.put((text, vector))
+    def _encode_batch(self, batch: List[Tuple[str, Future, Optional[EncodeCallback]]]):
+        texts = [text for text, _, _ in batch]
+        try:
+            # ベクトル化（CPUでも高速。まとめて渡すとバッチで計算される）
+            vectors = self.embedder.encode(texts, batch_size=len(texts))
+        except Exception as e:
+            print(f"[MemoryCortex] エンコードエラー: {e}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
 
-                # デバッグ表示（本番では削除可）
-                # print(f"[MemoryCortex] 記憶を作成: '{text[:20]}...' (Vector: {vector.shape})")
+        for (text, future, callback), vector in zip(batch, vectors):
+            future.set_result(vector)
+            if callback is not None:
+                try:
+                    callback(text, vector)
+                except Exception as e:
+                    print(f"[MemoryCortex] コールバックエラー: {e}")
+            elif self.collect_results:
+                self.output_queue.put((text, vector))
 
+    def _fail_pending(self, error: BaseException):
+        """処理できなくなった依頼の Future を失敗させる"""
+        while True:
+            try:
+                item = self.input_queue.get_nowait()
             except queue.Empty:
-                continue
-            except Exception as e:
-                print(f"[MemoryCortex] エンコードエラー: {e}")
+                return
+            if item is not None:
+                item[1].set_exception(error)
 
-    def memorize(self, text: str):
+    def memorize(self, text: str, callback: Optional[EncodeCallback] = None) -> Future:
         """
         外部から記憶リクエストを送るメソッド。非ブロッキング。
+
+        Args:
+            text: ベクトル化するテキスト
+            callback: 完了時に (text, vector) で呼ばれる関数 (エンコードスレッド上で実行)
+
+        Returns:
+            ベクトルを結果に持つ Future
         """
-        if not self.running:
-            print("[MemoryCortex] 警告: 停止しているため記憶できません。")
-            return
-        self.input_queue.put(text)
+        future: Future = Future()
+        with self._submit_lock:
+            # stop() の後に投入すると、停止の合図より後ろに並んで処理されない
+            if self.running:
+                self.input_queue.put((text, future, callback))
+                return future
+        print("[MemoryCortex] 警告: 停止しているため記憶できません。")
+        future.set_exception(RuntimeError("MemoryCortex is stopped"))
+        return future
 
     def retrieve_memories(self) -> Optional[Tuple[str, np.ndarray]]:
         """
@@ -74,8 +163,359 @@ class MemoryCortex(threading.Thread):
         except queue.Empty:
             return None
 
-    def stop(self):
+    def stop(self, wait: bool = False, timeout: Optional[float] = None):
+        """
+        スレッドを安全に停止する (既定では終了を待たない)。
+        停止前に受け付けた依頼は処理してから終わり、以降の memorize は失敗する。
+
+        Args:
+            wait: スレッドが残りの依頼を処理し終えるまで待つ
+            timeout: wait するときの最大待ち時間
+        """
+        with self._submit_lock:
+            if not self.running:
+                return
+            self.running = False
+            self.input_queue.put(None)
+        if wait and self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+def _load_encoder(model_name: str, dim: int, cpus: Optional[Sequence[int]]):
+    """ワーカープロセスでモデルを読み込む (次元が結果スロットと合わなければ ValueError)"""
+    if cpus and hasattr(os, "sched_setaffinity"):
+        # 生成 (llama.cpp) 用のコアを奪わないよう、指定されたコアに固定する
+        os.sched_setaffinity(0, cpus)
+    embedder = SentenceTransformer(model_name)
+    if cpus:
+        import torch
+
+        torch.set_num_threads(len(cpus))
+    model_dim = embedder.get_sentence_embedding_dimension()
+    if model_dim != dim:
+        raise ValueError(f"{model_name} has dim {model_dim}, expected {dim}")
+    return embedder
+
+
+def _encoder_process(
+    model_name: str,
+    shm_name: str,
+    n_slots: int,
+    dim: int,
+    tasks,
+    results,
+    cpus: Optional[Sequence[int]],
+    max_batch: int,
+    max_wait: float,
+):
+    """
+    エンコーダーのワーカープロセス。
+    (スロット番号, テキスト) をまとめてベクトル化し、結果は共有メモリのスロットに直接書く。
+    親プロセスには完了したスロット番号だけを (種類, スロット番号のリスト, エラー) で送る
+    (配列は pickle しない)。results はこのワーカー専用のパイプなので、
+    ワーカーが強制終了されても他のワーカーの通知は止まらない。
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray((n_slots, dim), dtype=np.float32, buffer=shm.buf)
+        try:
+            embedder = _load_encoder(model_name, dim, cpus)
+        except Exception as e:
+            results.send(("failed", [], str(e)))
+            return
+        results.send(("ready", [], None))
+
+        stopping = False
+        while not stopping:
+            item = tasks.get()
+            if item is None:
+                break
+            batch, stopping = _drain_batch(tasks, item, max_batch, max_wait)
+            slots = [slot for slot, _ in batch]
+            try:
+                out[slots] = embedder.encode([text for _, text in batch])
+                results.send(("done", slots, None))
+            except Exception as e:
+                results.send(("error", slots, str(e)))
+    finally:
+        del out
+        shm.close()
+        results.close()
+
+
+class ProcessMemoryCortex:
+    """
+    プロセス版の非同期メモリエンコーダー。
+    SentenceTransformer を別プロセスで動かすので、エンコードが GIL や llama.cpp の
+    トークン生成ループと CPU を取り合いません。MemoryCortex と同じ
+    memorize / retrieve_memories / stop で使えます。
+
+    ベクトルは共有メモリ上の結果スロット (n_slots × dim, float32) で受け渡します。
+    スロットが全て使用中のとき、memorize は空きが出るまで待ちます。
+    依頼はワーカーごとのキューに振り分け、通知はワーカーごとのパイプで受け取ります。
+    ワーカーが落ちるとパイプが閉じるので、そのワーカーに振り分けた依頼だけを失敗させます。
+    生きているワーカーが無くなると停止し、以降の memorize は失敗します。
+    """
+
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        dim: int = config.MEMORY_ENCODE_DIM,
+        n_workers: int = config.MEMORY_ENCODE_WORKERS,
+        cpus: Optional[Sequence[int]] = config.MEMORY_ENCODE_CPUS,
+        n_slots: int = config.MEMORY_ENCODE_SLOTS,
+        max_batch: int = config.MEMORY_ENCODE_BATCH,
+        max_wait_ms: float = config.MEMORY_ENCODE_WAIT_MS,
+        collect_results: bool = True,
+    ):
         """
-        スレッドを安全に停止する。
+        Args:
+            model_name: SentenceTransformer のモデル名
+            dim: モデルの埋め込み次元 (結果スロットの大きさ)
+            n_workers: エンコーダープロセスの数
+            cpus: ワーカーを固定する CPU コア番号 (None なら固定しない。Linux のみ)
+            n_slots: 同時に処理中にできる依頼の上限 (共有メモリのスロット数)
+            max_batch: 1回の encode にまとめる依頼の上限
+            max_wait_ms: 最初の依頼が届いてから、後続の依頼を待つ最大時間
+            collect_results: 結果を output_queue にも入れる (retrieve_memories 用)
         """
+        self.model_name = model_name
+        self.dim = dim
+        self.n_workers = max(1, n_workers)
+        self.cpus = list(cpus) if cpus else None
+        self.n_slots = n_slots
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self.collect_results = collect_results
+
+        self.output_queue = queue.Queue()
         self.running = False
+        self.is_ready = False
+
+        # CUDA / llama.cpp のスレッドを引き継がないよう spawn で起動する
+        self._mp = mp.get_context("spawn")
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._free_slots: "queue.Queue[int]" = queue.Queue()
+        self._pending: Dict[int, Tuple[str, Future, Optional[EncodeCallback]]] = {}
+        self._assigned: Dict[int, int] = {}  # スロット → 担当ワーカー
+        self._lock = threading.Lock()
+        self._workers: List = []
+        self._task_queues: List = []
+        self._alive: Set[int] = set()
+        self._turn = 0
+        self._collector: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.running:
+            return
+        if self.cpus and not hasattr(os, "sched_setaffinity"):
+            print(
+                "[MemoryCortex] 警告: この OS では CPU の固定に対応していないため、"
+                f"cpus={self.cpus} は無視されます。"
+            )
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self.n_slots * self.dim * 4
+        )
+        self._vectors = np.ndarray(
+            (self.n_slots, self.dim), dtype=np.float32, buffer=self._shm.buf
+        )
+        for slot in range(self.n_slots):
+            self._free_slots.put(slot)
+
+        readers = {}
+        for worker_id in range(self.n_workers):
+            tasks = self._mp.Queue()
+            reader, writer = self._mp.Pipe(duplex=False)
+            worker = self._mp.Process(
+                target=_encoder_process,
+                args=(
+                    self.model_name,
+                    self._shm.name,
+                    self.n_slots,
+                    self.dim,
+                    tasks,
+                    writer,
+                    self.cpus,
+                    self.max_batch,
+                    self.max_wait,
+                ),
+                name=f"memory-cortex-{worker_id}",
+                daemon=True,
+            )
+            worker.start()
+            # 書き込み側はワーカーだけが持つ (終了すると読み込み側が EOF になる)
+            writer.close()
+            self._workers.append(worker)
+            self._task_queues.append(tasks)
+            readers[reader] = worker_id
+        self._alive = set(range(self.n_workers))
+        self.running = True
+
+        self._collector = threading.Thread(
+            target=self._collect,
+            args=(readers,),
+            name="memory-cortex-collector",
+            daemon=True,
+        )
+        self._collector.start()
+        print(
+            f"[MemoryCortex] {self.n_workers} 個のエンコーダープロセスを起動 "
+            f"(CPU: {self.cpus or 'all'})"
+        )
+
+    def _collect(self, readers: Dict):
+        """
+        ワーカーからの通知を受け取り、共有メモリのスロットから結果を取り出す。
+        全てのワーカーのパイプが閉じたら終わる。
+        """
+        while readers:
+            for reader in mp_connection.wait(list(readers)):
+                worker_id = readers[reader]
+                try:
+                    kind, slots, error = reader.recv()
+                except EOFError:
+                    # ワーカーが終了した (送られた通知はすべて読み終えている)
+                    del readers[reader]
+                    reader.close()
+                    self._worker_exited(worker_id)
+                    continue
+                self._handle(worker_id, kind, slots, error)
+
+    def _handle(self, worker_id: int, kind: str, slots: List[int], error):
+        if kind == "ready":
+            self.is_ready = True
+        elif kind == "failed":
+            print(f"[MemoryCortex] モデルロード失敗: {error}")
+            self._worker_exited(worker_id, RuntimeError(error))
+        elif kind == "done":
+            for slot in slots:
+                self._resolve(slot, worker_id, vector=self._vectors[slot])
+        else:
+            print(f"[MemoryCortex] エンコードエラー: {error}")
+            for slot in slots:
+                self._resolve(slot, worker_id, error=RuntimeError(error))
+
+    def _worker_exited(self, worker_id: int, error: Optional[BaseException] = None):
+        """終了したワーカーに振り分けた依頼を失敗させる"""
+        with self._lock:
+            if worker_id not in self._alive:
+                return
+            self._alive.discard(worker_id)
+            lost = [s for s, w in self._assigned.items() if w == worker_id]
+            none_left = not self._alive
+            unexpected = self.running  # stop() による終了なら警告しない
+            if none_left:
+                # 処理できるワーカーが無い: 以降の memorize はすぐに失敗させる
+                self.running = False
+        # 読む者がいないキューの書き出しを待って終了できなくならないようにする
+        self._task_queues[worker_id].cancel_join_thread()
+        if error is None:
+            error = RuntimeError(f"Encoder process {worker_id} exited")
+            if unexpected:
+                print(f"[MemoryCortex] 警告: {error}")
+        for slot in lost:
+            self._resolve(slot, worker_id, error=error)
+        if none_left:
+            self._fail_all(error)
+
+    def _resolve(
+        self,
+        slot: int,
+        worker_id: int,
+        vector: Optional[np.ndarray] = None,
+        error: Optional[BaseException] = None,
+    ):
+        with self._lock:
+            # 失敗させた後に届いた通知は捨てる (スロットは別の依頼に使われているかもしれない)
+            if self._assigned.get(slot) != worker_id:
+                return
+            del self._assigned[slot]
+            text, future, callback = self._pending.pop(slot)
+            if vector is not None:
+                # スロットはすぐ再利用されるのでコピーしてから返す
+                vector = vector.copy()
+        self._free_slots.put(slot)
+        if error is not None:
+            future.set_exception(error)
+            return
+        future.set_result(vector)
+        if callback is not None:
+            try:
+                callback(text, vector)
+            except Exception as e:
+                print(f"[MemoryCortex] コールバックエラー: {e}")
+        elif self.collect_results:
+            self.output_queue.put((text, vector))
+
+    def _fail_all(self, error: BaseException):
+        """処理中の依頼をすべて失敗させ、スロットを空ける (空きを待つ memorize も起きる)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            slots, self._assigned = list(self._assigned), {}
+        for slot in slots:
+            self._free_slots.put(slot)
+        for _, future, _ in pending.values():
+            future.set_exception(error)
+
+    def memorize(self, text: str, callback: Optional[EncodeCallback] = None) -> Future:
+        """
+        外部から記憶リクエストを送るメソッド (スロットに空きがあれば非ブロッキング)。
+        停止中や、生きているエンコーダープロセスが無いときは失敗した Future を返す。
+
+        Returns:
+            ベクトルを結果に持つ Future
+        """
+        future: Future = Future()
+        if self.running:
+            # 止まるときは _fail_all がスロットを空けるので、ここで待ち続けることはない
+            slot = self._free_slots.get()
+            with self._lock:
+                if self.running:
+                    # 生きているワーカーに順番に振り分ける
+                    alive = sorted(self._alive)
+                    worker_id = alive[self._turn % len(alive)]
+                    self._turn += 1
+                    self._pending[slot] = (text, future, callback)
+                    self._assigned[slot] = worker_id
+                    self._task_queues[worker_id].put((slot, text))
+                    return future
+            self._free_slots.put(slot)
+        print("[MemoryCortex] 警告: 停止しているため記憶できません。")
+        future.set_exception(RuntimeError("MemoryCortex is stopped"))
+        return future
+
+    def retrieve_memories(self) -> Optional[Tuple[str, np.ndarray]]:
+        """
+        作成された記憶（ベクトル）があれば取り出す。
+        """
+        try:
+            return self.output_queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        ワーカーを停止し、共有メモリを解放する。
+        停止前に受け付けた依頼は処理してから終わる。
+        """
+        if self._shm is None:
+            return
+        with self._lock:
+            self.running = False
+        for tasks in self._task_queues:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+
+        # 全てのワーカーのパイプが閉じると、コレクターも残りの通知を処理して終わる
+        self._collector.join()
+        self._fail_all(RuntimeError("MemoryCortex is stopped"))
+        self._workers, self._task_queues, self._alive = [], [], set()
+
+        self._vectors = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import config
+import cortex_log
+from hippocampus import Hippocampus
+
+_STOP = object()
+log = cortex_log.get_logger("memory_writer")
+
+
+class MemoryWriter:
+    """
+    LTM への記憶の固定化 (二値化・パック・追記) をバックグラウンドで行うライター。
+
+    /chat は submit() で記憶IDを受け取ったらすぐ応答を返し、書き込みはワーカースレッドが
+    キューから取り出して行います。溜まっている分はまとめて取り出し、LTMファイルごとに
+    1回の append_many (flush/fsync も1回) で書くので、同時に話しているNPCが多いほど効率が上がります。
+    キューが一杯のときは submit() が空きを待つ (バックプレッシャー)。
+    """
+
+    def __init__(
+        self,
+        hippocampus: Hippocampus,
+        max_queue: int = config.MEMORY_WRITE_QUEUE,
+        max_batch: int = config.MEMORY_WRITE_BATCH,
+        put_timeout: float = config.MEMORY_WRITE_TIMEOUT,
+    ):
+        """
+        Args:
+            hippocampus: 書き込み先の海馬モジュール
+            max_queue: 書き込み待ちの記憶の上限
+            max_batch: 1回にまとめて書く記憶の上限
+            put_timeout: キューが一杯のとき待つ秒数 (超えたら呼び出し元で直接書く)
+        """
+        self.hippocampus = hippocampus
+        self.max_batch = max_batch
+        self.put_timeout = put_timeout
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="ltm-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        vector: np.ndarray,
+        user_input: str,
+        response: str,
+        filepath: str,
+        importance: float = 0.5,
+    ) -> str:
+        """
+        記憶の保存を予約し、記憶IDをすぐに返す (引数は Hippocampus.save_memory と同じ)。
+        vector はバイポーラ化前の重ね合わせ (符号で二値化される) でもよい。
+        """
+        memory = self.hippocampus.new_memory(user_input, response, importance)
+        item = (filepath, memory, vector)
+        if self._thread is None:
+            self._write([item])
+            return memory["id"]
+        try:
+            self._queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            # ライターが追いつかない: 記憶を落とさないよう呼び出し元で書く
+            self._write([item])
+        return memory["id"]
+
+    def flush(self):
+        """予約済みの記憶がすべて書き込まれるまで待つ"""
+        self._queue.join()
+
+    def close(self):
+        """残りを書き込んでワーカーを止める"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # 溜まっている分をまとめて取り出す (待たない)
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = any(item is _STOP for item in batch)
+            items = [item for item in batch if item is not _STOP]
+            try:
+                if items:
+                    self._write(items)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                return
+
+    def _write(self, items: List[Tuple[str, Dict, np.ndarray]]):
+        start = time.perf_counter()
+        by_file: Dict[str, List[Tuple[Dict, np.ndarray]]] = defaultdict(list)
+        for filepath, memory, vector in items:
+            by_file[filepath].append((memory, vector))
+
+        saved = 0
+        for filepath, entries in by_file.items():
+            try:
+                # 破棄済みセッションのファイルは、書いたら閉じる (インデックスを残さない)
+                self.hippocampus.save_memories(
+                    filepath, entries, close_if_unloaded=True
+                )
+                saved += len(entries)
+            except Exception as e:  # 1ファイルの失敗で他のNPCの記憶を落とさない
+                log.error(
+                    "Failed to save %d memories to %s: %s", len(entries), filepath, e
+                )
+
+        elapsed = (time.perf_counter() - start) * 1000
+        cortex_log.activity.info(
+            "             [LTM]: 💾 %d memories saved (%d files, %.1fms)",
+            saved,
+            len(by_file),
+            elapsed,
+        )
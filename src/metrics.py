@@ -0,0 +1,176 @@
+"""
+Per-stage latency instrumentation for the hot path.
+各段階 (プロンプト組み立て・prefill・デコード・エントロピー・射影・想起・保存) の所要時間を
+ヒストグラムに溜め、/metrics で Prometheus のテキスト形式として公開します。
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import config
+
+# 計測する段階
+PROMPT_FORMAT = "prompt_format"
+PREFILL = "prefill"
+DECODE_STEP = "decode_step"
+ENTROPY = "entropy"
+PROJECT_THOUGHT = "project_thought"
+RECALL = "recall"
+SAVE_MEMORY = "save_memory"
+REQUEST = "request"
+
+# 秒。トークンごとの段階 (数十µs) から1リクエスト全体 (数秒) までを1組で覆う
+DEFAULT_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram with one series per label value.
+    Observations are bucketed on the spot, so memory does not grow with traffic.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label: str,
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        # ラベル値 → [バケットごとの件数, 合計, 件数]
+        self._series: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[label_value] = series
+            series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def count(self, label_value: str) -> int:
+        with self._lock:
+            series = self._series.get(label_value)
+            return series[2] if series else 0
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            snapshot = [
+                (value, list(counts), total, n)
+                for value, (counts, total, n) in sorted(self._series.items())
+            ]
+        for value, counts, total, n in snapshot:
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(
+                    f'{self.name}_bucket{{{label},le="{bound:g}"}} {cumulative}'
+                )
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {n}')
+            lines.append(f"{self.name}_sum{{{label}}} {total:.9g}")
+            lines.append(f"{self.name}_count{{{label}}} {n}")
+        return lines
+
+
+class StageTimings:
+    """
+    Per-request breakdown of the stages above (returned by /chat on request).
+    Stages may run on different threads (scheduler, request handler), hence the lock.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, List[float]] = {}  # 段階 → [合計秒, 回数]
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """{段階: {"ms": 合計ミリ秒, "count": 回数}}"""
+        with self._lock:
+            return {
+                stage: {"ms": round(total * 1000, 3), "count": n}
+                for stage, (total, n) in self._stages.items()
+            }
+
+
+STAGE_SECONDS = Histogram(
+    "cortex_stage_seconds",
+    "Time spent in each stage of the NPC reply path.",
+    label="stage",
+)
+_gauges: List[Tuple[str, str, Callable[[], float]]] = []
+
+
+def observe(stage: str, seconds: float, timings: Optional[StageTimings] = None):
+    """段階の所要時間を記録する (timings があればリクエストごとの内訳にも足す)"""
+    if not config.METRICS:
+        return
+    STAGE_SECONDS.observe(stage, seconds)
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage(name: str, timings: Optional[StageTimings] = None) -> Iterator[None]:
+    """with ブロックの所要時間を段階 name として記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, timings)
+
+
+def gauge(name: str, help_text: str, fn: Callable[[], float]):
+    """/metrics の出力時に fn() を読む値 (キューの長さなど) を登録する"""
+    _gauges[:] = [g for g in _gauges if g[0] != name]
+    _gauges.append((name, help_text, fn))
+
+
+def render() -> str:
+    """Prometheus のテキスト形式 (text/plain; version=0.0.4)"""
+    lines = STAGE_SECONDS.render()
+    for name, help_text, fn in list(_gauges):
+        try:
+            value = float(fn())
+        except Exception:  # 読めない値は出さない (/metrics 自体は失敗させない)
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines.append(f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
@@ -1,9 +1,14 @@
 import torch
 import torch.nn as nn
 import numpy as np
-from typing import List, Union, Tuple, Dict, Any
-from llama_cpp import Llama
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union, Tuple
+from llama_cpp import Llama, LogitsProcessorList
 import config
+import gguf_meta
+from entropy import EntropyProbe, entropy_from_logits
+import llama_backend
+from hdc_bits import hamming_similarity, pack_bipolar
 
 
 class HDCProjection(nn.Module):
@@ -55,19 +60,19 @@ class ActiveInferenceController(nn.Module):
     def forward(self, logits_np: np.ndarray) -> Tuple[bool, float]:
         """
         Args:
-            logits_np: numpy array of shape (n_tokens, vocab_size) or (1, vocab_size)
+            logits_np: numpy array of shape (n_tokens, vocab_size) or (vocab_size,)
+                       (only the last token's distribution is evaluated)
         """
-        # Convert to torch for easy entropy calc
-        logits = torch.tensor(logits_np, dtype=torch.float32)
-        if logits.dim() == 1:
-            logits = logits.unsqueeze(0)
+        # NumPy の log-softmax で直接計算する (torch.tensor への変換はしない)
+        logits = np.asarray(logits_np)
+        if logits.ndim == 2:
+            logits = logits[-1]
+        entropy = float(entropy_from_logits(logits))
+        return self.is_curious(entropy), entropy
 
-        # Calculate Entropy
-        probs = torch.softmax(logits, dim=-1)
-        log_probs = torch.log(probs + 1e-9)
-        entropy = -torch.sum(probs * log_probs, dim=-1)  # (1,)
-
-        return entropy.item() > self.curiosity_threshold.item(), entropy.item()
+    def is_curious(self, uncertainty: float) -> bool:
+        """不確実性が閾値を超えたら「考え直す」(reflection) べきと判断する"""
+        return uncertainty > self.curiosity_threshold.item()
 
 
 class EpisodicMemory(nn.Module):
@@ -96,15 +101,19 @@ class EpisodicMemory(nn.Module):
         self, query_vector: torch.Tensor, threshold: float = 0.0
     ) -> float:
         """
-        Checks if a query vector exists in the superposition via Cosine Similarity.
+        Checks if a query vector exists in the superposition.
+        The trace is read out by majority vote (sign) and compared bit-packed
+        via XOR + popcount, which equals cosine similarity for bipolar vectors.
         Returns:
             similarity: float (-1.0 to 1.0)
         """
         if torch.norm(self.memory_trace) < 1e-9:
             return 0.0
 
-        sim = torch.nn.functional.cosine_similarity(query_vector, self.memory_trace)
-        return sim.item()
+        trace_bits = pack_bipolar(self.memory_trace.detach().cpu().numpy())
+        query_bits = pack_bipolar(query_vector.detach().cpu().numpy().reshape(1, -1))
+        sim = hamming_similarity(query_bits[0], trace_bits, self.hdc_dim)
+        return float(sim[0])
 
 
 class NeuralSymbolicBrain(nn.Module):
@@ -116,33 +125,66 @@ class NeuralSymbolicBrain(nn.Module):
         self,
         model_path: str = config.MODEL_FILENAME,
         n_ctx: int = config.CTX_SIZE,
+        shared_model: bool = config.SHARED_MODEL,
         **kwargs,
     ):
         super().__init__()
         print(f"Loading Cortex (GGUF) from {model_path}...")
+        self.shared_model = shared_model
+
+        # 埋め込み次元は推論せずに GGUF のメタデータから読む
+        embed_dim = self._read_embed_dim(model_path)
+
+        def load(embedding: bool) -> Llama:
+            return Llama(
+                model_path=model_path,
+                n_ctx=n_ctx,
+                embedding=embedding,
+                logits_all=False,
+                verbose=False,
+                **kwargs,
+            )
 
-        # Instance 1: Generation (Left Hemisphere)
-        print("  - Initializing Generator (Left Hemisphere)...")
-        self.llm_gen = Llama(
-            model_path=model_path,
-            n_ctx=n_ctx,
-            embedding=False,
-            logits_all=False,
-            verbose=False,
-            **kwargs,
-        )
+        self.llm_embed = None
+        self._embed_ctx = None
+        self._embed_batch = None
+        if shared_model:
+            # Instance 1: Generation (Left Hemisphere)
+            print("  - Initializing Generator (Left Hemisphere)...")
+            self.llm_gen = load(embedding=False)
+            # 共有モード: 重み (mmap) も KV キャッシュも生成用インスタンス1つだけ。
+            # 思考ベクトルは生成中の隠れ状態から取り出す (HiddenStatePool)
+            print("  - Right Hemisphere shares the Generator's weights.")
+            embed_dim = embed_dim or llama_backend.n_embd(self.llm_gen.model)
+        else:
+            # Instance 1: Generation (Left Hemisphere)
+            # Instance 2: Embedding (Right Hemisphere / Hippocampus Feed)
+            # 2つのインスタンスは並列にロードする
+            print("  - Initializing Generator & Embedder (both Hemispheres)...")
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                gen = pool.submit(load, False)
+                embed = pool.submit(load, True)
+                self.llm_gen, self.llm_embed = gen.result(), embed.result()
+            embed_dim = embed_dim or self._detect_embed_dim()
+
+        self.embed_dim = embed_dim
+        print(f"Final Brain Embedding Dimension: {embed_dim}")
 
-        # Instance 2: Embedding (Right Hemisphere / Hippocampus Feed)
-        print("  - Initializing Embedder (Right Hemisphere)...")
-        self.llm_embed = Llama(
-            model_path=model_path,
-            n_ctx=n_ctx,
-            embedding=True,
-            logits_all=False,
-            verbose=False,
-            **kwargs,
-        )
+        # Components
+        self.hippocampus = HDCProjection(embed_dim, hdc_dim=config.HDC_DIM)
+        # Memory storage
+        self.episodic_memory = EpisodicMemory(hdc_dim=config.HDC_DIM)
+        self.pfc = ActiveInferenceController()
+
+    @staticmethod
+    def _read_embed_dim(model_path: str) -> Optional[int]:
+        try:
+            return gguf_meta.model_dims(model_path)["n_embd"]
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read GGUF metadata ({e}).")
+            return None
 
+    def _detect_embed_dim(self) -> int:
         # Inspect embedding size
         try:
             dummy_embed = self.llm_embed.create_embedding("Init")["data"][0][
@@ -159,19 +201,33 @@ class NeuralSymbolicBrain(nn.Module):
                 f"Warning: Could not detect embedding dimension ({e}). Fallback to {config.EMBED_DIM_DETECT}."
             )
             embed_dim = config.EMBED_DIM_DETECT
+        return embed_dim
 
-        print(f"Final Brain Embedding Dimension: {embed_dim}")
-
-        # Components
-        self.hippocampus = HDCProjection(embed_dim, hdc_dim=config.HDC_DIM)
-        # Memory storage
-        self.episodic_memory = EpisodicMemory(hdc_dim=config.HDC_DIM)
-        self.pfc = ActiveInferenceController()
+    def _embed_text(self, text: str) -> np.ndarray:
+        """
+        Mean-pooled hidden states of `text` in a small embeddings context that shares
+        the generator's weights (shared mode fallback when generation captured nothing).
+        """
+        if self._embed_ctx is None:
+            self._embed_ctx = llama_backend.new_context(
+                self.llm_gen.model,
+                n_ctx=config.EMBED_CTX_SIZE,
+                n_batch=config.EMBED_CTX_SIZE,
+                embeddings=True,
+            )
+            self._embed_batch = llama_backend.TokenBatch(config.EMBED_CTX_SIZE)
+        tokens = self.llm_gen.tokenize(text.encode("utf-8"), add_bos=False)
+        tokens = tokens[: config.EMBED_CTX_SIZE] or [self.llm_gen.token_eos()]
+        return llama_backend.mean_embedding(
+            self._embed_ctx, self._embed_batch, tokens, self.embed_dim
+        )
 
-    def forward(self, prompt, max_tokens=64):
+    def forward(self, prompt, max_tokens=64, reflect: bool = config.REFLECTION):
         """
         Generates text and captures the internal state of the 'thought'.
         Automatically stores the generated thought into episodic memory.
+        If `reflect` is set and the mean token entropy exceeds the curiosity threshold,
+        the answer is regenerated once after a reflection cue.
         """
         # Prepend System Prompt if available
         full_prompt = prompt
@@ -184,21 +240,40 @@ class NeuralSymbolicBrain(nn.Module):
             full_prompt = f"System: {self.system_prompt}\nUser: {prompt}\nAssistant:"
 
         # 1. Cortex Processing (Generation) via Left Hemisphere
-        response = self.llm_gen.create_completion(
-            full_prompt,
-            max_tokens=max_tokens,
-            echo=False,  # Do NOT echo system prompt in output text
-            stop=["User:", "System:"],  # Stop if it tries to hallucinate new turns
-        )
+        # 各トークンのエントロピーを生のロジットから測る (logits_all は不要)
+        probe = EntropyProbe()
+        logits_processor = LogitsProcessorList([probe])
+        # 共有モードでは生成しながら隠れ状態を平均プーリングする (再エンコード不要)
+        pool = None
+        if self.shared_model:
+            pool = llama_backend.HiddenStatePool(self.llm_gen, self.embed_dim)
+            logits_processor.append(pool)
+        try:
+            response = self.llm_gen.create_completion(
+                full_prompt,
+                max_tokens=max_tokens,
+                echo=False,  # Do NOT echo system prompt in output text
+                stop=["User:", "System:"],  # Stop if it tries to hallucinate new turns
+                logits_processor=logits_processor,
+            )
+        finally:
+            if pool is not None:
+                pool.close()
 
         text = response["choices"][0]["text"]
 
         # 2. Hippocampal Projection via Right Hemisphere
         # We assume the 'thought' state is represented by the embedding of the generated text
-        embed_resp = self.llm_embed.create_embedding(text)
-        current_embedding = embed_resp["data"][0][
-            "embedding"
-        ]  # List[float] OR List[List[float]]
+        if pool is not None:
+            current_embedding = pool.mean()
+            if current_embedding is None:
+                # 1トークンしか生成されなかった: 重みを共有する小さなコンテキストで埋め込む
+                current_embedding = self._embed_text(text)
+        else:
+            embed_resp = self.llm_embed.create_embedding(text)
+            current_embedding = embed_resp["data"][0][
+                "embedding"
+            ]  # List[float] OR List[List[float]]
 
         # Robust Mean Pooling
         embed_tensor = torch.tensor(current_embedding, dtype=torch.float32)
@@ -217,18 +292,42 @@ class NeuralSymbolicBrain(nn.Module):
         self.episodic_memory.add_memory(hdc_thought)
 
         # 3. Active Inference (Entropy check)
-        # Placeholder uncertainty since logprobs are unstable in this version
-        uncertainty = 0.0
+        # 生成した各トークンの予測エントロピーの平均を不確実性とする
+        uncertainty = probe.mean
+        needs_reflection = self.pfc.is_curious(uncertainty)
 
-        needs_reflection = uncertainty > self.pfc.curiosity_threshold.item()
+        reflection = None
+        if reflect and needs_reflection:
+            reflection = self._reflect(full_prompt, text, max_tokens)
 
         return {
-            "text": text,
+            "text": reflection if reflection else text,
             "hdc_thought": hdc_thought,
             "uncertainty": uncertainty,
             "needs_reflection": needs_reflection,
+            "reflection": reflection,
+            "token_entropies": probe.entropies,
+            "entropy_overhead_ms": probe.mean_ms,
         }
 
+    def _reflect(self, full_prompt: str, draft: str, max_tokens: int) -> str:
+        """
+        迷いが大きいときに、下書きを踏まえてもう一度答えさせる。
+        プロンプト + 下書きの KV は直前の生成のものがそのまま再利用される。
+        """
+        reflection_prompt = (
+            f"{full_prompt}{draft}\n"
+            "System: You seem unsure. Reconsider and answer again briefly.\n"
+            "Assistant:"
+        )
+        response = self.llm_gen.create_completion(
+            reflection_prompt,
+            max_tokens=max_tokens,
+            echo=False,
+            stop=["User:", "System:"],
+        )
+        return response["choices"][0]["text"]
+
     def save_brain(self, path):
         """Saves learned parameters + Metadata (System Prompt)."""
         # We wrap state_dict in a larger dict
@@ -0,0 +1,221 @@
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+import config
+import cortex_log
+
+_STOP = object()
+log = cortex_log.get_logger("prefix_cache")
+
+
+class PrefixCache:
+    """
+    Bounded cache of llama.cpp KV states for stable prompt prefixes
+    (persona system prompt, persona + unchanged context).
+
+    Entries are keyed by a hash of the model identity and the prefix token IDs, kept in
+    an in-memory LRU, and written to `directory` so that a restarted server can skip
+    re-prefilling the persona. The disk copy is bounded too (oldest files are removed).
+    Once start() is called, files are written and trimmed by a background writer so
+    that put() from the scheduler thread only touches memory.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str],
+        model_id: str,
+        max_entries: int = config.PREFIX_CACHE_MAX_ENTRIES,
+        max_disk_mb: float = config.PREFIX_CACHE_MAX_DISK_MB,
+        max_pending_writes: int = config.PREFIX_CACHE_WRITE_QUEUE,
+    ):
+        """
+        Args:
+            directory: Where snapshots are persisted (None = memory only)
+            model_id: Identifies the model weights; snapshots of other models never match
+            max_entries: Snapshots kept in memory
+            max_disk_mb: Total size of persisted snapshots
+            max_pending_writes: Snapshots waiting for the background writer
+                (beyond this the disk copy is skipped; the memory entry is kept)
+        """
+        self.directory = directory
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._writes: "queue.Queue" = queue.Queue(maxsize=max_pending_writes)
+        self._writer: Optional[threading.Thread] = None
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def model_id_for(model_path: str) -> str:
+        """ファイル名とサイズでモデルを識別する (同名の別量子化を取り違えない)"""
+        try:
+            size = os.path.getsize(model_path)
+        except OSError:
+            size = 0
+        return f"{os.path.basename(model_path)}:{size}"
+
+    def key(self, tokens: Sequence[int]) -> str:
+        h = hashlib.sha256(self.model_id.encode("utf-8"))
+        h.update(b"".join(int(t).to_bytes(4, "little", signed=True) for t in tokens))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.kv")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """スナップショットを返す (メモリ → ディスクの順に探す)"""
+        with self._lock:
+            state = self._entries.get(key)
+            if state is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return state
+
+        state = None
+        if self.directory and os.path.exists(self._path(key)):
+            try:
+                with open(self._path(key), "rb") as f:
+                    state = f.read()
+                os.utime(self._path(key))  # ディスク側の LRU 順を更新
+            except OSError:
+                state = None
+
+        with self._lock:
+            if state is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, state)
+        return state
+
+    def put(self, key: str, state: bytes):
+        """
+        スナップショットを登録し、ディスクにも書き出す。
+        start() 済みならディスクへの書き出しはバックグラウンドのライターが行う。
+        """
+        if not state:
+            return
+        with self._lock:
+            self._remember(key, state)
+        if not self.directory:
+            return
+        if self._writer is None:
+            self._write(key, state)
+            return
+        try:
+            self._writes.put_nowait((key, state))
+        except queue.Full:
+            # ライターが追いつかない: デコードを止めないよう、ディスクへの保存は諦める
+            log.debug("Prefix snapshot %s not persisted (write queue full)", key[:12])
+
+    # =========================================
+    # バックグラウンドでの書き出し
+    # =========================================
+
+    def start(self):
+        """ディスクへの書き出し用のワーカーを起動する"""
+        if self._writer is not None or not self.directory:
+            return
+        self._writer = threading.Thread(
+            target=self._run, name="prefix-cache-writer", daemon=True
+        )
+        self._writer.start()
+
+    def flush(self):
+        """予約済みのスナップショットがすべて書き出されるまで待つ"""
+        self._writes.join()
+
+    def close(self):
+        """残りを書き出してワーカーを止める"""
+        if self._writer is None:
+            return
+        self._writes.put(_STOP)
+        self._writer.join()
+        self._writer = None
+
+    def _run(self):
+        while True:
+            item = self._writes.get()
+            try:
+                if item is _STOP:
+                    return
+                self._write(*item)
+            except OSError as e:  # 書けなくてもメモリ上のエントリは使える
+                log.warning("Failed to persist prefix snapshot: %s", e)
+            finally:
+                self._writes.task_done()
+
+    def _write(self, key: str, state: bytes):
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(state)
+        os.replace(tmp_path, self._path(key))
+        self._trim_disk()
+
+    def preload(self) -> int:
+        """
+        ディスク上の新しいスナップショットから max_entries 件をメモリに読み込む (起動時用)。
+
+        Returns:
+            読み込んだ件数
+        """
+        if not self.directory:
+            return 0
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".kv"):
+                path = os.path.join(self.directory, name)
+                try:
+                    files.append((os.path.getmtime(path), name[: -len(".kv")], path))
+                except OSError:
+                    continue
+        loaded = 0
+        # 古い順に入れて、最も新しいものが LRU の末尾になるようにする
+        for _, key, path in sorted(files)[-self.max_entries :]:
+            try:
+                with open(path, "rb") as f:
+                    state = f.read()
+            except OSError:
+                continue
+            with self._lock:
+                self._remember(key, state)
+            loaded += 1
+        return loaded
+
+    def _remember(self, key: str, state: bytes):
+        self._entries[key] = state
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _trim_disk(self):
+        """ディスク上のスナップショットが上限を超えたら古いものから消す"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".kv"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
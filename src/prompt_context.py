@@ -0,0 +1,184 @@
+"""
+Versioned, canonical game context for the NPC prompt.
+/inject で注入されたキーを正規化 (キー順・値の表記を固定) して保持し、
+ゆっくり変わる世界の状態はシステムブロックの決まった位置に、頻繁に変わる値はプロンプトの末尾寄りに置きます。
+注入の順番や値の変わらない再注入ではプロンプトの先頭が変わらないので、KV キャッシュの再利用が効きます。
+"""
+
+import hashlib
+import json
+from collections.abc import Iterable, Iterator, Mapping, MutableMapping
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import config
+
+# プロンプトのセグメント (先頭から順に)
+PERSONA = "persona"
+WORLD = "world"
+HISTORY = "history"
+STATUS = "status"
+TURN = "turn"
+
+# NPCSession が STM を渡すときのキー (従来の dict 形式のコンテキストとの互換用)
+HISTORY_KEY = "conversation_history"
+
+Fields = Tuple[Tuple[str, str], ...]
+
+
+def canonical_value(value: Any) -> str:
+    """値をプロンプト用の文字列にする (dict・list はキーを並べ替えた JSON)"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return str(value)
+
+
+def render_fields(fields: Fields, label: str = "Status") -> str:
+    """[System: Status={k=v, ...}] の形にする (空なら "")"""
+    if not fields:
+        return ""
+    s = ", ".join(f"{k}={v}" for k, v in fields)
+    return f"[System: {label}={{{s}}}]"
+
+
+class ContextSnapshot(NamedTuple):
+    """One turn's context, canonicalized and split by how often each key changes."""
+
+    version: int
+    world: Fields  # 安定したキー (システムブロック)
+    status: Fields  # 頻繁に変わるキー (プロンプトの末尾寄り)
+    history: str = ""  # STM (直近の会話履歴)
+
+
+class PromptContext(MutableMapping):
+    """
+    The game context injected into one NPC's prompt.
+
+    Keys are kept in canonical (sorted) order and `version` only moves when a rendered
+    value actually changes. Keys listed in CONTEXT_FAST_KEYS, or that have changed
+    CONTEXT_VOLATILE_AFTER times, are rendered as fast-changing status near the end
+    of the prompt so they do not invalidate the cached world-state prefix.
+    """
+
+    def __init__(
+        self,
+        fast_keys: Iterable[str] = config.CONTEXT_FAST_KEYS,
+        volatile_after: int = config.CONTEXT_VOLATILE_AFTER,
+    ):
+        """
+        Args:
+            fast_keys: 常に末尾寄りに置くキー (時刻・HP など)
+            volatile_after: 値がこの回数変わったキーも末尾寄りに移す (0 なら移さない)
+        """
+        self.fast_keys = set(fast_keys)
+        self.volatile_after = volatile_after
+        self.version = 0
+        self._values: Dict[str, Any] = {}
+        self._rendered: Dict[str, str] = {}
+        self._changes: Dict[str, int] = {}  # キー → 値が変わった回数
+
+    def __getitem__(self, key: str) -> Any:
+        return self._values[key]
+
+    def __setitem__(self, key: str, value: Any):
+        key = str(key)
+        rendered = canonical_value(value)
+        self._values[key] = value
+        previous = self._rendered.get(key)
+        if previous == rendered:
+            return
+        if previous is not None:
+            self._changes[key] = self._changes.get(key, 0) + 1
+        self._rendered[key] = rendered
+        self.version += 1
+
+    def __delitem__(self, key: str):
+        del self._values[key]
+        del self._rendered[key]
+        # 消したキーを入れ直したときは、変化の回数を数え直す
+        self._changes.pop(key, None)
+        self.version += 1
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(sorted(self._values))
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def clear(self):
+        if self._values:
+            self.version += 1
+        self._values.clear()
+        self._rendered.clear()
+        self._changes.clear()
+
+    def is_fast(self, key: str) -> bool:
+        """key を末尾寄り (status) に置くか"""
+        if key in self.fast_keys:
+            return True
+        return 0 < self.volatile_after <= self._changes.get(key, 0)
+
+    def snapshot(self, history: str = "") -> ContextSnapshot:
+        """今の内容をプロンプト用に確定する"""
+        world, status = [], []
+        for key in sorted(self._rendered):
+            field = (key, self._rendered[key])
+            (status if self.is_fast(key) else world).append(field)
+        return ContextSnapshot(self.version, tuple(world), tuple(status), history)
+
+
+def as_snapshot(
+    context: Union[ContextSnapshot, Mapping[str, Any], None],
+) -> ContextSnapshot:
+    """
+    build_prompt に渡されたコンテキストを ContextSnapshot にする。
+    dict の場合は HISTORY_KEY を STM として取り出し、残りを CONTEXT_FAST_KEYS で振り分ける。
+    """
+    if isinstance(context, ContextSnapshot):
+        return context
+    if not context:
+        return ContextSnapshot(0, (), ())
+    fields = PromptContext()
+    for key, value in context.items():
+        if key != HISTORY_KEY:
+            fields[key] = value
+    return fields.snapshot(history=str(context.get(HISTORY_KEY, "")))
+
+
+def segment_digests(segments: List[Tuple[str, str]]) -> Dict[str, str]:
+    """セグメント名 → 内容のハッシュ"""
+    return {
+        name: hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+        for name, text in segments
+    }
+
+
+class SegmentDiff(NamedTuple):
+    """How a prompt differs from the same NPC's previous one."""
+
+    changed: List[str]  # 変わったセグメント名 (先頭から順に)
+    reused_chars: int  # 変わらずに続く先頭部分の文字数 (KV を使い回せる)
+    digests: Dict[str, str]  # 次のターンと比べるための segment_digests()
+
+
+def diff_segments(
+    previous: Optional[Dict[str, str]], segments: List[Tuple[str, str]]
+) -> SegmentDiff:
+    """
+    前のターンのプロンプトから変わったセグメントを調べる。
+    変わらずに続く先頭部分は KV を使い回せ、それ以降だけを prefill し直せばよい。
+
+    Args:
+        previous: 前のターンの digests (初回は None)
+        segments: 今回のプロンプトのセグメント (先頭から順に)
+    """
+    previous = previous or {}
+    digests = segment_digests(segments)
+    changed = [name for name, _ in segments if previous.get(name) != digests[name]]
+    reused = 0
+    for name, text in segments:
+        if name in changed:
+            break
+        reused += len(text)
+    return SegmentDiff(changed, reused, digests)
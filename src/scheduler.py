@@ -0,0 +1,572 @@
+import asyncio
+import codecs
+import queue
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import config
+import cortex_log
+import metrics
+from cortex_llm import DEFAULT_STOP_TOKENS, MonolithicCortex
+from decode_policy import AdaptiveDecodePolicy
+from prefix_cache import PrefixCache
+
+try:
+    import llama_backend
+except ImportError:  # 低レベル API が無い環境では逐次実行にフォールバック
+    llama_backend = None
+
+_TOKEN = "token"
+_DONE = "done"
+_ERROR = "error"
+
+
+log = cortex_log.get_logger("scheduler")
+
+
+class SchedulerBusy(Exception):
+    """The request queue is full (the caller should retry later)."""
+
+
+class ChatJob:
+    """
+    One queued generation request.
+    Iterating it yields (token, thought vector, entropy) as the scheduler decodes them,
+    exactly like MonolithicCortex.think_stream; `async for` does the same without
+    blocking the event loop (tokens are handed over with call_soon_threadsafe).
+    """
+
+    def __init__(
+        self,
+        prompt: str,
+        max_tokens: int = 128,
+        temperature: float = 0.4,
+        repeat_penalty: float = 1.05,
+        stop: Optional[List[str]] = None,
+        prefixes: Optional[List[str]] = None,
+        segments: Optional[List[Tuple[str, str]]] = None,
+    ):
+        self.prompt = prompt
+        self.prefixes = prefixes or []  # KV スナップショットを取る安定した先頭部分
+        self.segments = (
+            segments or []
+        )  # prompt を (セグメント名, テキスト) に分けたもの
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.repeat_penalty = repeat_penalty
+        self.stop = list(DEFAULT_STOP_TOKENS if stop is None else stop)
+        self.finish_reason: Optional[str] = None
+        self.timings = metrics.StageTimings()  # 段階ごとの所要時間 (/chat の timings)
+        self.submitted_at = time.perf_counter()
+        # プロンプトのどの部分が前のターンから変わったか (/chat の timings で返す)
+        self.prompt_report: Dict[str, Any] = {}
+
+        self._events: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+        self._cancelled = threading.Event()
+        self._claimed = False  # スケジューラがデコードを始めたか
+        self._state_lock = threading.Lock()
+        # async for で読む場合の受け渡し先 (読み始めたときに束縛する)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_events: "Optional[asyncio.Queue[Tuple[str, Any]]]" = None
+        self._bind_lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Stops decoding of this request at the next step (e.g. client disconnected)."""
+        with self._state_lock:
+            self._cancelled.set()
+            # まだキューで待っているなら、スケジューラは触らないのでここで終える
+            finish_now = not self._claimed and self.finish_reason is None
+        if finish_now:
+            self.finish("cancelled")
+
+    # --- scheduler side ---
+    def claim(self) -> bool:
+        """キューから取り出したジョブのデコードを始める (待っている間にキャンセルされていれば False)"""
+        with self._state_lock:
+            if self._cancelled.is_set():
+                return False
+            self._claimed = True
+            return True
+
+    def put_token(self, text: str, vector: np.ndarray, entropy: float):
+        self._emit(_TOKEN, (text, vector, entropy))
+
+    def finish(self, reason: str):
+        self.finish_reason = reason
+        self._emit(_DONE, reason)
+
+    def fail(self, error: BaseException):
+        self.finish_reason = "error"
+        self._emit(_ERROR, error)
+
+    def _emit(self, kind: str, payload: Any):
+        with self._bind_lock:
+            if self._async_events is None:
+                self._events.put((kind, payload))
+                return
+            loop, events = self._loop, self._async_events
+        try:
+            loop.call_soon_threadsafe(events.put_nowait, (kind, payload))
+        except RuntimeError:  # ループが閉じている: 読む側はもういない
+            self.cancel()
+
+    # --- caller side ---
+    def __iter__(self) -> Iterator[Tuple[str, np.ndarray, float]]:
+        try:
+            while True:
+                kind, payload = self._events.get()
+                if kind == _TOKEN:
+                    yield payload
+                elif kind == _DONE:
+                    return
+                else:
+                    raise payload
+        finally:
+            # 呼び出し側が途中で読むのをやめたら、デコードも止める
+            if self.finish_reason is None:
+                self.cancel()
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[str, np.ndarray, float]]:
+        events: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+        with self._bind_lock:
+            # 読み始める前に届いていたイベントを移してから、以降は直接受け取る
+            while not self._events.empty():
+                events.put_nowait(self._events.get_nowait())
+            self._loop = asyncio.get_running_loop()
+            self._async_events = events
+        try:
+            while True:
+                kind, payload = await events.get()
+                if kind == _TOKEN:
+                    yield payload
+                elif kind == _DONE:
+                    return
+                else:
+                    raise payload
+        finally:
+            if self.finish_reason is None:
+                self.cancel()
+
+
+class _Slot:
+    """Decoding state of one active sequence (one llama.cpp seq_id)."""
+
+    def __init__(self, seq_id: int, job: ChatJob, prompt_tokens: List[int]):
+        self.seq_id = seq_id
+        self.job = job
+        self.pending = list(prompt_tokens)  # まだ KV に入っていないトークン
+        self.n_past = 0
+        self.n_generated = 0
+        self.recent: List[int] = list(prompt_tokens[-64:])  # repeat penalty 用
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = ""  # 生成済みテキスト (stop 判定用)
+        self.emitted = 0  # 呼び出し元へ渡した文字数
+        self.hold_back = max((len(s) for s in job.stop), default=0)
+        self.policy = AdaptiveDecodePolicy()  # 早期終了・射影幅の判断
+        # prefill の計測開始 (最初のロジットが出るまで)
+        self.admitted_at = time.perf_counter()
+        # (トークン数, キャッシュキー): prefill がここに達したら KV を保存する
+        self.snapshots: List[Tuple[int, str]] = []
+
+
+class InferenceScheduler:
+    """
+    Queues /chat requests and decodes them together.
+
+    With llama.cpp's multi-sequence batching, every active request owns a seq_id in a
+    dedicated context that shares the model weights. Each step builds ONE batch holding
+    the next token of every decoding sequence plus prompt chunks of newly admitted ones
+    (continuous batching), so aggregate tokens/sec grows with the number of NPCs.
+    If the low-level API is unavailable, requests are decoded one at a time through
+    think_stream instead.
+    """
+
+    def __init__(
+        self,
+        cortex: MonolithicCortex,
+        max_concurrency: int = config.SCHEDULER_MAX_CONCURRENCY,
+        max_queue_depth: int = config.SCHEDULER_MAX_QUEUE,
+        seq_ctx: int = config.SCHEDULER_SEQ_CTX,
+        n_batch: int = config.SCHEDULER_BATCH_SIZE,
+        seed: Optional[int] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+    ):
+        """
+        Args:
+            cortex: Loaded MonolithicCortex (model, prompt format, hippocampus)
+            max_concurrency: Number of sequences decoded together
+            max_queue_depth: Waiting requests beyond this are rejected (SchedulerBusy)
+            seq_ctx: KV cache size (tokens) reserved per sequence
+            n_batch: Max tokens per llama_decode call
+            seed: Sampling seed
+            prefix_cache: KV snapshots of stable prompt prefixes (persona etc.)
+        """
+        self.cortex = cortex
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue_depth = max_queue_depth
+        self.seq_ctx = seq_ctx
+        self.n_batch = n_batch
+        self.rng = np.random.default_rng(seed)
+        self.prefix_cache = prefix_cache
+
+        self._waiting: "queue.Queue[ChatJob]" = queue.Queue()
+        self._submit_lock = threading.Lock()  # キューの長さの確認と投入をまとめて行う
+        self._slots: Dict[int, _Slot] = {}
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.batched = False
+        self._ctx = None
+        self._batch = None
+
+    # =========================================
+    # Public API
+    # =========================================
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._init_backend()
+        self._thread = threading.Thread(
+            target=self._run, name="cortex-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._waiting.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._batch is not None:
+            self._batch.free()
+            self._batch = None
+        if self._ctx is not None:
+            llama_backend.free_context(self._ctx)
+            self._ctx = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting.qsize()
+
+    @property
+    def active(self) -> int:
+        return len(self._slots)
+
+    def submit(
+        self,
+        user_input: str,
+        game_context: Optional[Dict[str, Any]] = None,
+        **params,
+    ) -> ChatJob:
+        """
+        Queues a request and returns its ChatJob (iterate it to stream tokens).
+        Raises SchedulerBusy when max_queue_depth requests are already waiting.
+        """
+        start = time.perf_counter()
+        # セグメントは1回だけ組み立て、プロンプト・プレフィックス・差分の記録に使い回す
+        segments = self.cortex.prompt_segments(user_input, game_context)
+        job = ChatJob(
+            "".join(text for _, text in segments),
+            prefixes=self.cortex.segment_prefixes(segments),
+            segments=segments,
+            **params,
+        )
+        metrics.observe(metrics.PROMPT_FORMAT, time.perf_counter() - start, job.timings)
+        with self._submit_lock:
+            waiting = self._waiting.qsize()
+            if waiting >= self.max_queue_depth:
+                raise SchedulerBusy(f"{waiting} requests are already waiting")
+            self._waiting.put(job)
+        return job
+
+    # =========================================
+    # Backend selection
+    # =========================================
+
+    def _init_backend(self):
+        if llama_backend is None or not llama_backend.supports_batching():
+            log.info("Multi-sequence batching unavailable; decoding serially.")
+            return
+        try:
+            self._ctx = llama_backend.new_context(
+                self.cortex.llm.model,
+                n_ctx=self.seq_ctx * self.max_concurrency,
+                n_batch=self.n_batch,
+                n_seq_max=self.max_concurrency,
+            )
+            self._batch = llama_backend.TokenBatch(self.n_batch, 1)
+            self.batched = True
+            if self.prefix_cache is not None and not llama_backend.supports_seq_state():
+                self.prefix_cache = None
+            log.info(
+                "Batched decoding enabled (%d sequences x %d tokens).",
+                self.max_concurrency,
+                self.seq_ctx,
+            )
+        except Exception as e:
+            log.warning("Could not create batched context (%s); decoding serially.", e)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self.batched:
+                    self._run_batched_step()
+                else:
+                    self._run_serial_job()
+            except Exception as e:  # デコード失敗は進行中の全リクエストへ伝える
+                log.exception("Decoding failed: %s", e)
+                for slot in list(self._slots.values()):
+                    self._release(slot)
+                    slot.job.fail(e)
+
+    # =========================================
+    # Serial fallback
+    # =========================================
+
+    def _run_serial_job(self):
+        job = self._waiting.get()
+        if job is None or not job.claim():
+            return
+        stream = self.cortex.stream_prompt(
+            job.prompt,
+            max_tokens=job.max_tokens,
+            temperature=job.temperature,
+            repeat_penalty=job.repeat_penalty,
+            stop_tokens=job.stop,
+            timings=job.timings,
+        )
+        try:
+            for token, vec, entropy in stream:
+                if job.cancelled:
+                    job.finish("cancelled")
+                    return
+                job.put_token(token, vec, entropy)
+            job.finish("stop")
+        except Exception as e:
+            job.fail(e)
+        finally:
+            stream.close()
+
+    # =========================================
+    # Batched decoding
+    # =========================================
+
+    def _admit(self):
+        """Moves waiting requests into free sequence slots."""
+        block = not self._slots
+        while len(self._slots) < self.max_concurrency:
+            try:
+                job = self._waiting.get(block=block, timeout=0.1 if block else None)
+            except queue.Empty:
+                return
+            block = False
+            if job is None or not job.claim():
+                continue
+
+            tokens = self.cortex.llm.tokenize(job.prompt.encode("utf-8"), special=True)
+            if len(tokens) >= self.seq_ctx:
+                job.fail(ValueError("Prompt exceeds the per-sequence context size"))
+                continue
+            seq_id = next(
+                i for i in range(self.max_concurrency) if i not in self._slots
+            )
+            slot = _Slot(seq_id, job, tokens)
+            if self.prefix_cache is not None:
+                self._restore_prefix(slot, tokens)
+            self._slots[seq_id] = slot
+
+    def _restore_prefix(self, slot: _Slot, tokens: List[int]):
+        """
+        キャッシュ済みの最長プレフィックスの KV をシーケンスに復元し、残りだけを prefill する。
+        キャッシュに無いプレフィックスは、prefill がその境界に達した時点で保存する。
+        """
+        boundaries: List[Tuple[int, str]] = []
+        for prefix in slot.job.prefixes:
+            prefix_tokens = self.cortex.llm.tokenize(
+                prefix.encode("utf-8"), special=True
+            )
+            n = len(prefix_tokens)
+            # 境界でトークン化が変わる場合 (トークンがまたがる) は使えない
+            if 0 < n < len(tokens) and tokens[:n] == prefix_tokens:
+                boundaries.append((n, self.prefix_cache.key(prefix_tokens)))
+        boundaries.sort()
+
+        restored = 0
+        for n, key in reversed(boundaries):
+            state = self.prefix_cache.get(key)
+            if state is None:
+                continue
+            if llama_backend.seq_state_set(self._ctx, state, slot.seq_id):
+                restored = n
+                break
+            llama_backend.kv_seq_rm(self._ctx, slot.seq_id, -1, -1)
+
+        slot.n_past = restored
+        slot.pending = list(tokens[restored:])
+        slot.snapshots = [(n, key) for n, key in boundaries if n > restored]
+
+    def _run_batched_step(self):
+        self._admit()
+        if not self._slots:
+            return
+
+        # 1. デコード中のシーケンスの次トークンを先に積む (1トークンずつ)
+        # 2. 残りの枠で新規シーケンスのプロンプトを分割して積む (prefill)
+        slots = sorted(self._slots.values(), key=lambda s: s.n_generated == 0)
+        wants_logits = self._fill_batch(slots)
+        if self._batch.n_tokens == 0:
+            return
+        start = time.perf_counter()
+        self._batch.decode(self._ctx)
+        elapsed = time.perf_counter() - start
+        metrics.observe(metrics.DECODE_STEP, elapsed)
+
+        self._save_snapshots(slots)
+        self._advance_all(wants_logits, elapsed)
+
+    def _fill_batch(self, slots: List[_Slot]) -> List[Tuple[_Slot, int]]:
+        """
+        バッチを組み立てる (キャンセルされたシーケンスはここで解放する)。
+
+        Returns:
+            ロジットを読む (スロット, バッチ内の位置) のリスト
+        """
+        batch = self._batch
+        batch.clear()
+        wants_logits: List[Tuple[_Slot, int]] = []
+        for slot in slots:
+            if slot.job.cancelled:
+                self._release(slot)
+                slot.job.finish("cancelled")
+                continue
+            room = batch.capacity - batch.n_tokens
+            if room <= 0:
+                break
+            if slot.snapshots:
+                # スナップショット境界で prefill を区切る
+                room = min(room, slot.snapshots[0][0] - slot.n_past)
+            feed = slot.pending[:room]
+            for j, token in enumerate(feed):
+                last = j == len(feed) - 1 and len(feed) == len(slot.pending)
+                i = batch.add(token, slot.n_past + j, slot.seq_id, last)
+                if last:
+                    wants_logits.append((slot, i))
+            slot.n_past += len(feed)
+            slot.pending = slot.pending[len(feed) :]
+        return wants_logits
+
+    def _save_snapshots(self, slots: List[_Slot]):
+        """prefill がプレフィックスの境界に達したシーケンスの KV を保存する"""
+        for slot in slots:
+            if self._slots.get(slot.seq_id) is not slot:
+                continue  # このステップでキャンセルされた
+            if slot.snapshots and slot.n_past == slot.snapshots[0][0]:
+                _, key = slot.snapshots.pop(0)
+                self.prefix_cache.put(
+                    key, llama_backend.seq_state_get(self._ctx, slot.seq_id)
+                )
+
+    def _advance_all(self, wants_logits: List[Tuple[_Slot, int]], elapsed: float):
+        n_vocab = self.cortex.llm.n_vocab()
+        for slot, i in wants_logits:
+            if slot.n_generated and config.METRICS:
+                # 1回の llama_decode は、そこでトークンを進めた全リクエストの待ち時間になる
+                slot.job.timings.add(metrics.DECODE_STEP, elapsed)
+            else:
+                metrics.observe(
+                    metrics.PREFILL,
+                    time.perf_counter() - slot.admitted_at,
+                    slot.job.timings,
+                )
+            logits = llama_backend.logits_row(self._ctx, i, n_vocab)
+            self._advance(slot, logits)
+
+    def _advance(self, slot: _Slot, logits: np.ndarray):
+        """Samples the next token of a sequence and streams it to the caller."""
+        job = slot.job
+
+        # 思考の計測は生のロジット (ペナルティ・温度適用前) から行う
+        entropy, vector = self.cortex.perceive_logits(
+            logits, slot.policy, timings=job.timings
+        )
+
+        token = self._sample(logits, slot, job)
+        model = self.cortex.llm.model
+        if llama_backend.is_eog(model, token) or token == self.cortex.llm.token_eos():
+            self._flush(slot, slot.text[slot.emitted :], vector, entropy)
+            self._release(slot)
+            job.finish("stop")
+            return
+
+        slot.n_generated += 1
+        slot.recent.append(token)
+        slot.pending = [token]
+        piece = slot.decoder.decode(self.cortex.llm.detokenize([token]))
+        slot.text += piece
+
+        # stop 文字列に達したら、その手前までを返して終了
+        for stop in job.stop:
+            cut = slot.text.find(stop, max(0, slot.emitted - len(stop)))
+            if cut != -1:
+                slot.text = slot.text[:cut]
+                self._flush(slot, slot.text[slot.emitted :], vector, entropy)
+                self._release(slot)
+                job.finish("stop")
+                return
+
+        # 迷いの無い文が閉じたら、max_tokens を待たずに終える
+        if slot.policy.should_stop(entropy, piece):
+            self._flush(slot, slot.text[slot.emitted :], vector, entropy)
+            self._release(slot)
+            job.finish("stop")
+            return
+
+        if slot.n_generated >= job.max_tokens or slot.n_past + 1 >= self.seq_ctx:
+            self._flush(slot, slot.text[slot.emitted :], vector, entropy)
+            self._release(slot)
+            job.finish("length")
+            return
+
+        # stop 文字列の先頭と一致しうる末尾は保留する
+        safe_end = len(slot.text)
+        for k in range(1, min(slot.hold_back, len(slot.text)) + 1):
+            if any(stop.startswith(slot.text[-k:]) for stop in job.stop):
+                safe_end = len(slot.text) - k
+        self._flush(slot, slot.text[slot.emitted : safe_end], vector, entropy)
+
+    def _flush(self, slot: _Slot, text: str, vector, entropy: float):
+        slot.emitted += len(text)
+        slot.job.put_token(text, vector, entropy)
+
+    def _release(self, slot: _Slot):
+        llama_backend.kv_seq_rm(self._ctx, slot.seq_id, -1, -1)
+        self._slots.pop(slot.seq_id, None)
+
+    def _sample(self, logits: np.ndarray, slot: _Slot, job: ChatJob) -> int:
+        """Repeat penalty → temperature → top-k / top-p / min-p (llama.cpp defaults)."""
+        logits = np.array(logits, dtype=np.float32)
+        if job.repeat_penalty != 1.0 and slot.recent:
+            recent = np.unique(np.asarray(slot.recent[-64:], dtype=np.int64))
+            values = logits[recent]
+            logits[recent] = np.where(
+                values > 0, values / job.repeat_penalty, values * job.repeat_penalty
+            )
+        if job.temperature <= 0:
+            return int(np.argmax(logits))
+
+        top = np.argpartition(-logits, 40)[:40]
+        top = top[np.argsort(-logits[top])]
+        scaled = logits[top] / job.temperature
+        probs = np.exp(scaled - scaled[0])
+        probs /= probs.sum()
+        keep = (np.cumsum(probs) - probs < 0.95) & (probs >= 0.05 * probs[0])
+        probs = probs[keep] / probs[keep].sum()
+        return int(top[keep][self.rng.choice(len(probs), p=probs)])
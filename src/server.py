@@ -1,15 +1,35 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
 import uvicorn
 import time
+import json
+import threading
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # Ensure src is in path for imports
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+import config
+import cortex_log
+import metrics
 from cortex_llm import MonolithicCortex
+from hippocampus import Hippocampus, ThoughtAccumulator
+from memory_writer import MemoryWriter
+from prefix_cache import PrefixCache
+from scheduler import ChatJob, InferenceScheduler, SchedulerBusy
+from session_manager import DEFAULT_NPC_ID, NPCSession, SessionManager
+from startup import StagedStartup, prefault_file
+
+# ログはキューに積むだけにし、コンソールへの書き出しはバックグラウンドのスレッドで行う
+cortex_log.setup()
+log = cortex_log.get_logger("server")
+activity = cortex_log.activity
 
 app = FastAPI(title="CortexAI", version="1.0.0")
 
@@ -41,14 +61,10 @@ if not os.path.exists(model_path):
     if os.path.exists(os.path.join(ROOT_DIR, "qwen2.5-1.5b-instruct-q4_k_m.gguf")):
         model_path = os.path.join(ROOT_DIR, "qwen2.5-1.5b-instruct-q4_k_m.gguf")
     else:
-        print(f"WARNING: Model not found at {model_path}")
+        log.warning("Model not found at %s", model_path)
         # Attempt default
         model_path = "qwen2.5-1.5b-instruct-q4_k_m.gguf"
 
-# --- Global Brain Instance ---
-print("\n--- [CortexAI] Initializing Monolithic Brain... ---")
-print(f"Loading Model: {model_path}")
-
 # --- Persona Loading (Modder-friendly) ---
 # Modderはこのファイルを編集することで、コードを触らずに性格を変更できます
 PERSONA_FILE = os.path.join(ROOT_DIR, "persona.txt")
@@ -57,33 +73,153 @@ DEFAULT_PERSONA = "あなたは賢明な哲学者であり、プレイヤーの
 if os.path.exists(PERSONA_FILE):
     with open(PERSONA_FILE, "r", encoding="utf-8") as f:
         system_prompt = f.read().strip()
-    print(f"[Persona] Loaded from persona.txt: {system_prompt[:50]}...")
+    log.info("Persona loaded from persona.txt: %s...", system_prompt[:50])
 else:
     system_prompt = DEFAULT_PERSONA
-    print(f"[Persona] Using default: {DEFAULT_PERSONA[:50]}...")
-
-brain = MonolithicCortex(system_prompt=system_prompt, model_path=model_path)
-current_context: Dict[str, Any] = {}
+    log.info("Using default persona: %s...", DEFAULT_PERSONA[:50])
 
 # --- Memory System ---
 # STM: 短期記憶 (直近N発話を保持)
-conversation_history: List[Dict[str, str]] = []
 MAX_STM_SIZE = 5  # 保持する最大発話数
 
 # LTM: 長期記憶 (永続ファイル)
+# npc_id 省略時は従来どおり ltm.json、それ以外は memories/npcs/<npc_id>-<ハッシュ>.mem
 LTM_FILE = os.path.join(MEMORIES_DIR, "ltm.json")
 
-print("--- [Cortex-Linker] Brain is Awake. Ready to Link. ---\n")
+# 海馬 (LTM) はモデルに依存しないので先に作る。モデルのロード中も /inject・/forget は使える
+hippocampus = Hippocampus()
+
+# NPCごとのセッション (STM・注入コンテキスト・LTM) を遅延ロードで管理
+sessions = SessionManager(
+    hippocampus,
+    MEMORIES_DIR,
+    default_ltm_file=LTM_FILE,
+    max_stm_size=MAX_STM_SIZE,
+)
+
+# LTM への書き込みは応答を返した後にバックグラウンドでまとめて行う
+memory_writer = MemoryWriter(hippocampus)
+
+# --- Global Brain Instance (loaded in the background) ---
+# ポートはすぐに開き、モデル・コードブック・LTM・プレフィックスキャッシュは並列に読み込む。
+# 読み込みが終わるまで /chat は 503 (Retry-After) を返し、/ready で進捗を確認できる。
+startup = StagedStartup()
+brain: Optional[MonolithicCortex] = None
+scheduler: Optional[InferenceScheduler] = None
+prefix_cache: Optional[PrefixCache] = None
+
+# /metrics で段階ごとのヒストグラムと一緒に出す現在値
+metrics.gauge(
+    "cortex_scheduler_queue_depth",
+    "Chat requests waiting for a decoding slot.",
+    lambda: scheduler.queue_depth if scheduler else 0,
+)
+metrics.gauge(
+    "cortex_scheduler_active",
+    "Chat requests currently being decoded.",
+    lambda: scheduler.active if scheduler else 0,
+)
+metrics.gauge("cortex_sessions", "NPC sessions held in memory.", lambda: len(sessions))
+metrics.gauge(
+    "cortex_log_dropped", "Log records dropped on a full queue.", cortex_log.dropped
+)
+
+
+def _load_prefix_cache() -> PrefixCache:
+    global prefix_cache
+    # ペルソナ (システムプロンプト) 部分の KV はスナップショットを再利用し、再起動後も使い回す
+    cache = PrefixCache(
+        os.path.join(ROOT_DIR, config.PREFIX_CACHE_DIRNAME),
+        model_id=PrefixCache.model_id_for(model_path),
+    )
+    cache.preload()
+    # ディスクへの書き出しはスケジューラのスレッドではなくライターで行う
+    cache.start()
+    prefix_cache = cache
+    return cache
+
+
+def _warm_up(scheduler: InferenceScheduler):
+    # ペルソナ部分を prefill して KV スナップショットと計算バッファを用意しておく
+    for _ in scheduler.submit("Hello", None, max_tokens=1):
+        pass
+
+
+def _wake_up():
+    """Loads the brain in parallel stages (runs in a background thread)."""
+    global brain, scheduler
+    activity.info("\n--- [CortexAI] Initializing Monolithic Brain... ---")
+    log.info("Loading model: %s", model_path)
+    try:
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix="wake-up") as pool:
+            if config.WARMUP_PREFAULT and os.path.exists(model_path):
+                pool.submit(startup.stage, "prefault", prefault_file, model_path)
+            ltm = pool.submit(
+                startup.stage, "ltm_index", hippocampus.index_for, LTM_FILE
+            )
+            cache = pool.submit(startup.stage, "prefix_cache", _load_prefix_cache)
+            new_brain = startup.stage(
+                "model",
+                MonolithicCortex,
+                system_prompt=system_prompt,
+                model_path=model_path,
+                hippocampus=hippocampus,
+            )
+            codebook = pool.submit(
+                startup.stage,
+                "codebook",
+                new_brain.attach_codebook,
+                os.path.join(MODELS_DIR, config.CODEBOOK_FILENAME),
+            )
+
+            # --- Inference Scheduler ---
+            # 複数NPCからのリクエストをキューに積み、llama.cpp のマルチシーケンスでまとめてデコードする
+            new_scheduler = InferenceScheduler(new_brain, prefix_cache=cache.result())
+            startup.stage("scheduler", new_scheduler.start)
+            ltm.result()
+            try:
+                codebook.result()
+            except Exception as e:  # コードブックが無くても文字列トークンの経路で動く
+                log.warning("Codebook unavailable: %s", e)
+
+        if config.WARMUP:
+            try:
+                startup.stage("warmup", _warm_up, new_scheduler)
+            except Exception as e:  # ウォームアップの失敗で起動は止めない
+                log.warning("Warm-up skipped: %s", e)
+    except Exception as e:
+        log.error("Brain failed to wake up: %s", e)
+        return
+
+    brain, scheduler = new_brain, new_scheduler
+    startup.mark_ready()
+    activity.info("--- [Cortex-Linker] Brain is Awake. Ready to Link. ---\n")
+
+
+def _require_brain():
+    """モデルの読み込みが終わっていなければ 503 (クライアントは Retry-After 後に再試行)"""
+    if not startup.ready:
+        detail = startup.error or "Brain is waking up"
+        raise HTTPException(
+            status_code=503, detail=detail, headers={"Retry-After": "2"}
+        )
 
 
 # --- Data Models ---
 class ChatRequest(BaseModel):
     text: str
     speaker: str = "Player"
+    npc_id: str = DEFAULT_NPC_ID
+    timings: bool = False  # 応答に段階ごとの所要時間 (ms) の内訳を含める
 
 
 class InjectRequest(BaseModel):
     info: Dict[str, Any]
+    npc_id: str = DEFAULT_NPC_ID
+
+
+class ForgetRequest(BaseModel):
+    npc_id: str = DEFAULT_NPC_ID
 
 
 # --- Console Visualizer ---
@@ -92,9 +228,9 @@ def log_brain_activity(speaker: str, message: str, emotion: str = None):
     Simulates a high-tech console output for Modders.
     """
     timestamp = time.strftime("%H:%M:%S")
-    print(f"[{timestamp}] {speaker:>10}: {message}")
+    activity.info("[%s] %10s: %s", timestamp, speaker, message)
     if emotion:
-        print(f"             [Emotion]: {emotion}")
+        activity.info("             [Emotion]: %s", emotion)
 
 
 # --- Emotion System (Entropy-based) ---
@@ -117,97 +253,215 @@ def get_emotion_from_entropy(entropy: float) -> str:
 # --- API Endpoints ---
 
 
+@asynccontextmanager
+async def _session(npc_id: str) -> AsyncIterator[NPCSession]:
+    """
+    sessions.session() のイベントループ版。取得はロックだけなのでその場で行い、
+    解放時の破棄 (LTM の flush) はスレッドプールで行う。
+    """
+    scope = sessions.session(npc_id)
+    session = scope.__enter__()
+    try:
+        yield session
+    finally:
+        await run_in_threadpool(scope.__exit__, None, None, None)
+
+
 @app.post("/chat")
-def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest):
     """
     [Main Function]
-    Input: Player speech
+    Input: Player speech (+ npc_id to address a specific NPC)
     Output: NPC speech + Emotion
-    Side-effect: Auto-memory recall & formation (STM + LTM)
+    Side-effect: Auto-memory recall & formation (STM + LTM, per NPC)
+    Decoding runs on the scheduler thread, so the event loop stays free for
+    /inject, /health, etc. while the reply is generated.
+    """
+    _require_brain()
+    async with _session(req.npc_id) as session:
+        job = _submit_turn(req, session)
+        result: Dict[str, Any] = {}
+        async for event in _chat_events(req, session, job):
+            result = event
+        result.pop("type", None)
+        return result
+
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest):
+    """
+    [Streaming] Same as /chat, but pushes the reply as Server-Sent Events:
+      event: token  data: {"text", "emotion", "entropy"}   (one per token)
+      event: done   data: {"reply", "emotion", "resonance", "memories_recalled", "memory_id"}
+                    (+ "timings" when requested)
+    Decoding stops as soon as the client disconnects.
     """
-    global conversation_history
+    _require_brain()
+    scope = _session(req.npc_id)
+    session = await scope.__aenter__()
+    try:
+        job = _submit_turn(req, session)
+    except BaseException:
+        await scope.__aexit__(None, None, None)
+        raise
+
+    released = False
+
+    async def release():
+        # 切断 (キャンセル) 時はスケジューラ側のデコードを止め、セッションを返す (1回だけ)
+        nonlocal released
+        if released:
+            return
+        released = True
+        job.cancel()
+        await scope.__aexit__(None, None, None)
+
+    async def event_source():
+        try:
+            async for event in _chat_events(req, session, job):
+                yield _sse_frame(event)
+        finally:
+            await release()
+
+    return _ScopedStreamingResponse(
+        event_source(),
+        release,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
+class _ScopedStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that always runs `release` once the response is over.
+    The body generator's own cleanup is not enough: if the client disconnects before
+    the first chunk, the generator is never started and its `finally` never runs.
+    """
+
+    def __init__(self, content, release: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._release()
+
+
+def _sse_frame(event: Dict[str, Any]) -> str:
+    payload = dict(event)
+    kind = payload.pop("type")
+    return f"event: {kind}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _submit_turn(req: ChatRequest, session: NPCSession) -> ChatJob:
+    """STM を含んだコンテキストで思考をスケジューラに投入する (キューが一杯なら 503)"""
     log_brain_activity(req.speaker, req.text)
 
     # 0. Build STM context (直近の会話履歴をプロンプトに含める)
-    stm_context = ""
-    if conversation_history:
-        stm_context = "\n[Recent Conversation]\n"
-        for turn in conversation_history[-MAX_STM_SIZE:]:
-            stm_context += f"- {turn['speaker']}: {turn['text']}\n"
+    # STMを含んだ拡張コンテキスト (/inject と競合しないよう、セッションのロック下でコピーする)
+    extended_context = session.prompt_context()
 
+    # Using the tuned parameters: Temp=0.4, Penalty=1.05
+    # スケジューラのキューが一杯なら 503 を返す (クライアントは再試行する)
+    try:
+        job = scheduler.submit(
+            req.text,
+            extended_context,
+            temperature=0.4,
+            repeat_penalty=1.05,
+        )
+    except SchedulerBusy as e:
+        raise HTTPException(status_code=503, detail=f"Brain is busy: {e}")
+
+    # 前のターンから変わったセグメントを記録する (変わらない先頭部分は KV を使い回せる)
+    diff = session.track_prompt(job.segments)
+    job.prompt_report = {
+        "context_version": extended_context.version,
+        "changed_segments": diff.changed,
+        "reused_chars": diff.reused_chars,
+    }
+    log.debug(
+        "%s prompt changed: %s (%d chars reused)",
+        req.npc_id,
+        ", ".join(diff.changed),
+        diff.reused_chars,
+    )
+    return job
+
+
+async def _chat_events(
+    req: ChatRequest, session: NPCSession, job: ChatJob
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    1ターン分の対話 (想起 → 思考 → STM/LTM 更新) を NPC のセッション上で行う。
+    生成されたトークンを1つずつ "token" イベントとして返し、最後に "done" イベントを返す。
+    イベントループ上で動くので、ブロックしうる処理 (想起・記憶の投入) はスレッドプールで行う。
+    """
     # 1. LTM Recall: 過去の類似記憶を検索
-    ltm_context = ""
     recalled_memories = []
-    # まず入力からクエリベクトルを作成（簡易版: 最初のトークンのlogprobsを使用）
-    # 本格版ではEmbeddingモデルを使うが、ここではHippocampusの既存機能を活用
 
-    # 2. Thinking Process (Stream -> Buffer)
+    # 2. Thinking Process (Stream)
     full_response = ""
     max_entropy = 0.0
     recalled = False
-    thought_vectors = []  # 思考ベクトルを収集
-
-    # STMを含んだ拡張コンテキスト
-    extended_context = current_context.copy()
-    if stm_context:
-        extended_context["conversation_history"] = stm_context
+    # 思考ベクトルはリストに溜めず、逐次的に重ね合わせる (Running Sum)
+    thought = ThoughtAccumulator(hippocampus.hdc_dim)
 
-    # Using the tuned parameters: Temp=0.4, Penalty=1.05
-    stream = brain.think_stream(
-        user_input=req.text,
-        game_context=extended_context,
-        temperature=0.4,
-        repeat_penalty=1.05,
-    )
+    activity.info("             [Cortex]: Thinking... (%s)", req.npc_id)
 
-    print("             [Cortex]: Thinking...", end="", flush=True)
-
-    for token, vec, entropy in stream:
+    async for token, vec, entropy in job:
         full_response += token
         if entropy > max_entropy:
             max_entropy = entropy
 
-        # 思考ベクトルを収集
-        if vec.any():
-            thought_vectors.append(vec)
-
-        # LTM Recall: 生成中に類似記憶を検索
-        if not recalled and vec.any():
-            recalled_memories = brain.hippocampus.recall(vec, LTM_FILE, top_k=2)
+        # 思考ベクトルを重ね合わせ、LTM Recall: 生成中に類似記憶を検索
+        if thought.add(vec) and not recalled:
+            with metrics.stage(metrics.RECALL, job.timings):
+                recalled_memories = await run_in_threadpool(
+                    hippocampus.recall, thought.snapshot(), session.ltm_file, top_k=2
+                )
             if recalled_memories:
-                print(
-                    f"\n             [Hippocampus]: ⚡ Memory Recalled! ({len(recalled_memories)} matches) ⚡",
-                    end="",
+                activity.info(
+                    "             [Hippocampus]: ⚡ Memory Recalled! (%d matches) ⚡",
+                    len(recalled_memories),
                 )
                 recalled = True
 
-    print(" Done.")
-
-    # 3. STM Update: 今回の発話を履歴に追加
-    conversation_history.append({"speaker": req.speaker, "text": req.text})
-    conversation_history.append({"speaker": "NPC", "text": full_response})
-
-    # STMが上限を超えたら古いものを削除
-    while len(conversation_history) > MAX_STM_SIZE * 2:
-        conversation_history.pop(0)
-
-    # 4. LTM Save: 重要な発話を長期記憶に保存
+        # トークンごとのイベントは LOG_TOKEN_SAMPLE 件に1件だけ記録される (既定は無効)
+        cortex_log.tokens.debug("%s %r entropy=%.3f", req.npc_id, token, entropy)
+        if token:
+            yield {
+                "type": "token",
+                "text": token,
+                "emotion": get_emotion_from_entropy(entropy),
+                "entropy": round(float(entropy), 3),
+            }
+
+    if job.finish_reason == "cancelled":
+        # クライアントが切断した: 途中までの応答は記憶しない
+        activity.info("             [Cortex]: Cancelled. (%s)", req.npc_id)
+        return
+    activity.info("             [Cortex]: Done. (%s)", req.npc_id)
+
+    # 3. STM Update: 今回の発話を履歴に追加 (上限を超えた古いものはリングバッファから押し出される)
+    session.remember_turn(req.speaker, req.text, full_response)
+
+    # 4. LTM Save: 重要な発話を長期記憶に保存 (書き込みはバックグラウンドのライターが行う)
     # 重要度の判定: エントロピーを正規化（典型的なLLMのmax entropyは~4.0）
     normalized_entropy = min(max_entropy / 4.0, 1.0)  # 0.0-1.0に正規化
     importance = 1.0 - normalized_entropy
-    if thought_vectors:  # 常に保存（テスト用）
-        # 代表ベクトルとして全思考ベクトルの平均を使用
-        import numpy as np
-
-        avg_vector = np.mean(thought_vectors, axis=0)
-        avg_vector = np.where(avg_vector >= 0, 1.0, -1.0)  # 二値化
-
-        brain.hippocampus.save_memory(
-            vector=avg_vector,
+    memory_id = None
+    if thought.count:  # 常に保存（テスト用）
+        # 代表ベクトルとして全思考ベクトルの重ね合わせを二値化したものを使用
+        # 書き込みキューが一杯のときは待つことがあるので、ループの外で投入する
+        memory_id = await run_in_threadpool(
+            memory_writer.submit,
+            vector=thought.snapshot(),
             user_input=req.text,
             response=full_response,
-            filepath=LTM_FILE,
+            filepath=session.ltm_file,
             importance=importance,
         )
 
@@ -220,39 +474,107 @@ def chat_endpoint(req: ChatRequest):
         for m in recalled_memories
     ]
 
-    return {
+    done = {
+        "type": "done",
         "reply": full_response,
         "emotion": get_emotion_from_entropy(max_entropy),  # 動的感情検出
         "resonance": int((1.0 - max_entropy) * 100) if max_entropy < 1.0 else 0,
         "memories_recalled": memories_recalled,
+        "memory_id": memory_id,
     }
+    # 投入から応答完成まで (キュー待ちを含む)
+    metrics.observe(
+        metrics.REQUEST, time.perf_counter() - job.submitted_at, job.timings
+    )
+    if req.timings:
+        done["timings"] = job.timings.as_dict()
+        done["prompt"] = job.prompt_report
+    yield done
 
 
 @app.post("/inject")
 def inject_endpoint(req: InjectRequest):
     """
     [Context Injection]
-    Updates the brain's understanding of the world without direct speech.
+    Updates the NPC's understanding of the world without direct speech.
+    Keys are merged into a canonical, versioned context (see prompt_context.py).
     """
-    global current_context
-    current_context.update(req.info)
-    print(f"             [System]: Context Injected -> {req.info}")
-    return {"status": "ok", "current_context": current_context}
+    with sessions.session(req.npc_id) as session:
+        current_context = session.inject(req.info)
+        activity.info(
+            "             [System]: Context Injected (%s) -> %s", req.npc_id, req.info
+        )
+        return {
+            "status": "ok",
+            "current_context": current_context,
+            "context_version": session.context.version,
+        }
 
 
 @app.post("/forget")
-def forget_endpoint():
+def forget_endpoint(req: Optional[ForgetRequest] = None):
     """
     [Debug/Reset]
-    Clears current context (and in future, short-term memory).
+    Clears the NPC's current context and short-term memory (LTM is kept).
     """
-    global current_context
-    current_context = {}
-    # TODO: brain.hippocampus.reset() if implemented
-    print(f"             [System]: 🧹 Memory Wiped (Tabula Rasa)")
+    npc_id = req.npc_id if req else DEFAULT_NPC_ID
+    session = sessions.peek(npc_id)
+    if session is not None:
+        session.reset()
+    activity.info("             [System]: 🧹 Memory Wiped (Tabula Rasa) (%s)", npc_id)
     return {"status": "wiped"}
 
 
+@app.get("/metrics")
+def metrics_endpoint():
+    """
+    [Monitoring] Per-stage latency histograms in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/health")
+async def health_endpoint():
+    """
+    [Liveness] The server process is up (answers immediately, even while loading).
+    """
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+def ready_endpoint():
+    """
+    [Readiness] 200 once the brain is loaded; 503 with per-stage progress until then.
+    """
+    status = startup.status()
+    if not status["ready"]:
+        return JSONResponse(
+            status_code=503, content=status, headers={"Retry-After": "2"}
+        )
+    return status
+
+
+@app.on_event("startup")
+def startup_event():
+    memory_writer.start()
+    # モデルの読み込みはバックグラウンドで行い、ポートはすぐに開く
+    threading.Thread(target=_wake_up, name="wake-up", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if scheduler is not None:
+        scheduler.stop()
+    if prefix_cache is not None:
+        prefix_cache.close()  # 書き出し待ちのスナップショットを保存してから閉じる
+    memory_writer.close()  # 書き込み待ちの記憶を保存してから閉じる
+    # 全NPCのLTMストアを flush して閉じる
+    sessions.close_all()
+    cortex_log.shutdown()  # 溜まっているログを書き出す
+
+
 if __name__ == "__main__":
     # 0.0.0.0 allows access from WSL/LAN if needed, but localhost is safer for mods
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,215 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import config
+from hippocampus import Hippocampus
+from prompt_context import ContextSnapshot, PromptContext, diff_segments
+
+DEFAULT_NPC_ID = "default"
+# NPCごとの記憶は既定の ltm.json とは別のディレクトリに置く
+NPC_MEMORIES_DIRNAME = "npcs"
+
+
+class NPCSession:
+    """
+    NPC 1体分の会話セッション。
+    短期記憶 (STM) のリングバッファ、注入されたゲームコンテキスト、LTMファイルを持ちます。
+    STM とコンテキストは /chat・/inject・/forget が別々のスレッドから触るので、lock で守ります
+    (保持するのは読み書きの間だけで、生成中は持たない)。
+    """
+
+    def __init__(self, npc_id: str, ltm_file: str, max_stm_size: int):
+        self.npc_id = npc_id
+        self.ltm_file = ltm_file
+        self.max_stm_size = max_stm_size
+        # STM: 直近N往復 (プレイヤー発話 + NPC応答) を保持
+        self.history: Deque[Dict[str, str]] = deque(maxlen=max_stm_size * 2)
+        self.context = PromptContext()
+        # 前のターンのプロンプトのセグメントごとのハッシュ (変わった部分の追跡用)
+        self.prompt_digests: Optional[Dict[str, str]] = None
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def stm_context(self) -> str:
+        """直近の会話履歴をプロンプト用の文字列にする"""
+        with self.lock:
+            history = list(self.history)
+        if not history:
+            return ""
+        lines = [f"- {turn['speaker']}: {turn['text']}\n" for turn in history]
+        return "\n[Recent Conversation]\n" + "".join(lines)
+
+    def prompt_context(self) -> ContextSnapshot:
+        """注入されたコンテキストに STM を加えたもの (プロンプト用に確定したもの)"""
+        stm_context = self.stm_context()
+        with self.lock:
+            return self.context.snapshot(history=stm_context)
+
+    def track_prompt(self, segments: List[Tuple[str, str]]):
+        """
+        今回のプロンプトのセグメントを前のターンと比べ、次のターン用に記録する。
+        diff_segments の結果 (SegmentDiff) を返す。
+        """
+        with self.lock:
+            diff = diff_segments(self.prompt_digests, segments)
+            self.prompt_digests = diff.digests
+        return diff
+
+    def inject(self, info: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        ゲームコンテキストにキーをマージする (値が変わらなければ version も変わらない)。
+
+        Returns:
+            マージ後のコンテキスト (コピー)
+        """
+        with self.lock:
+            self.context.update(info)
+            return dict(self.context)
+
+    def remember_turn(self, speaker: str, text: str, reply: str):
+        """今回の発話と応答を STM に追加する (古いものはリングバッファから押し出される)"""
+        with self.lock:
+            self.history.append({"speaker": speaker, "text": text})
+            self.history.append({"speaker": "NPC", "text": reply})
+
+    def reset(self):
+        """コンテキストと STM を消去する (LTM は残る)"""
+        with self.lock:
+            self.context.clear()
+            self.history.clear()
+            self.prompt_digests = None
+
+
+class SessionManager:
+    """
+    npc_id ごとのセッションを管理する。
+    セッションは初めて話しかけられたときに作られ、LTM も最初の想起/保存まで読み込まれない。
+    LRU 順で保持し、件数・アイドル時間 (TTL)・LTM インデックスのメモリ量の上限を超えたら
+    使われていないものから破棄します。破棄時は LTM ストアを flush して閉じます。
+    """
+
+    def __init__(
+        self,
+        hippocampus: Hippocampus,
+        memories_dir: str,
+        default_ltm_file: Optional[str] = None,
+        max_stm_size: int = 5,
+        max_sessions: int = config.MAX_SESSIONS,
+        ttl_seconds: float = config.SESSION_TTL,
+        memory_budget_mb: float = config.SESSION_MEMORY_BUDGET_MB,
+    ):
+        """
+        Args:
+            hippocampus: LTM を扱う海馬モジュール (全セッションで共有)
+            memories_dir: 記憶ファイルを置くディレクトリ (NPCごとのものは npcs/ の下)
+            default_ltm_file: npc_id 省略時のLTMファイル (従来の ltm.json)
+            max_stm_size: STM に保持する往復数
+            max_sessions: 同時に保持するセッション数の上限
+            ttl_seconds: これ以上アイドルなセッションは破棄する
+            memory_budget_mb: 読み込み済み LTM インデックスの合計サイズの上限
+        """
+        self.hippocampus = hippocampus
+        self.memories_dir = memories_dir
+        self.default_ltm_file = default_ltm_file or os.path.join(
+            memories_dir, "ltm.json"
+        )
+        self.max_stm_size = max_stm_size
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+
+        self._sessions: "OrderedDict[str, NPCSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def ltm_file_for(self, npc_id: str) -> str:
+        """
+        npc_id に対応する記憶ファイルのパス (npcs/<読める名前>-<npc_id のハッシュ>.mem)。
+        名前部分はファイル名に使えない文字を '_' にしたもので、衝突はハッシュで避ける
+        ("a/b" と "a_b"、大文字小文字を区別しないファイルシステムでの "Lydia" と "lydia")。
+        """
+        if npc_id == DEFAULT_NPC_ID:
+            return self.default_ltm_file
+        readable = re.sub(r"[^\w\-]", "_", npc_id)[:40] or "_"
+        digest = hashlib.sha1(npc_id.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(
+            self.memories_dir, NPC_MEMORIES_DIRNAME, f"{readable}-{digest}.mem"
+        )
+
+    @contextmanager
+    def session(self, npc_id: str = DEFAULT_NPC_ID) -> Iterator[NPCSession]:
+        """
+        セッションを取得する (無ければ作る)。ブロック内では破棄されない。
+        """
+        with self._lock:
+            session = self._sessions.get(npc_id)
+            if session is None:
+                session = NPCSession(
+                    npc_id, self.ltm_file_for(npc_id), self.max_stm_size
+                )
+                self._sessions[npc_id] = session
+            self._sessions.move_to_end(npc_id)
+            session.in_use += 1
+        try:
+            yield session
+        finally:
+            with self._lock:
+                session.in_use -= 1
+                session.last_used = time.monotonic()
+            self.enforce_budget()
+
+    def peek(self, npc_id: str) -> Optional[NPCSession]:
+        """既存のセッションを返す (作成・LRU 更新はしない)"""
+        return self._sessions.get(npc_id)
+
+    def _memory_usage(self) -> int:
+        total = 0
+        for session in self._sessions.values():
+            index = self.hippocampus.loaded_index(session.ltm_file)
+            if index is not None:
+                total += index.nbytes
+        return total
+
+    def enforce_budget(self) -> List[str]:
+        """
+        上限を超えているセッションを LRU 順に破棄する。
+
+        Returns:
+            破棄した npc_id のリスト
+        """
+        evicted: List[NPCSession] = []
+        with self._lock:
+            now = time.monotonic()
+            for npc_id, session in list(self._sessions.items()):
+                if session.in_use == 0 and now - session.last_used > self.ttl_seconds:
+                    evicted.append(self._sessions.pop(npc_id))
+
+            idle = [s for s in self._sessions.values() if s.in_use == 0]
+            while idle and (
+                len(self._sessions) > self.max_sessions
+                or self._memory_usage() > self.memory_budget
+            ):
+                session = idle.pop(0)  # 最も長く使われていないもの
+                evicted.append(self._sessions.pop(session.npc_id))
+
+        # flush は重いのでロックの外で行う
+        for session in evicted:
+            self.hippocampus.close(session.ltm_file)
+        return [s.npc_id for s in evicted]
+
+    def close_all(self):
+        """全セッションを破棄し、LTM ストアを flush して閉じる"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            self.hippocampus.close(session.ltm_file)
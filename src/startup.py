@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import cortex_log
+
+log = cortex_log.get_logger("startup")
+
+PENDING = "pending"
+LOADING = "loading"
+DONE = "done"
+FAILED = "failed"
+
+
+class StagedStartup:
+    """
+    Tracks the background loading stages of the server (model, LTM index, ...).
+
+    Each stage records its state and duration so that /ready can report progress while
+    the port is already bound. The brain is ready once mark_ready() is called; a failed
+    stage is reported through `error`.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.error: Optional[str] = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def stage(self, name: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """ステージを実行し、状態と所要時間を記録する (例外はそのまま送出)"""
+        with self._lock:
+            self.stages[name] = {"state": LOADING}
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            with self._lock:
+                self.stages[name] = {"state": FAILED, "error": str(e)}
+                self.error = f"{name}: {e}"
+            raise
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stages[name] = {"state": DONE, "seconds": round(elapsed, 3)}
+        log.info("%s ready (%.2fs)", name, elapsed)
+        return result
+
+    def mark_ready(self):
+        self._ready.set()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "error": self.error,
+                "uptime": round(time.monotonic() - self.started_at, 3),
+                "stages": {name: dict(info) for name, info in self.stages.items()},
+            }
+
+
+def prefault_file(path: str, chunk_size: int = 8 * 1024 * 1024) -> int:
+    """
+    ファイルを先読みしてページキャッシュに載せる (モデルの mmap のページフォルトを前倒しする)。
+
+    Returns:
+        読み込んだバイト数
+    """
+    total = 0
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # カーネルに非同期の先読みを依頼してから、順に読んで確実に載せる
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            total += n
+    return total
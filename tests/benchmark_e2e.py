@@ -0,0 +1,467 @@
+"""
+End-to-end latency benchmark for the llama.cpp paths.
+
+MonolithicCortex.think_stream / NeuralSymbolicBrain.forward / CortexBrainAPI.think と
+FastAPI の /chat (プロセス内クライアント) を計測し、ロード時間・最初のトークンまでの時間 (TTFT)・
+tokens/sec・トークンごとの海馬オーバーヘッド・同時 NPC 数 1/4/16 での p50/p95/p99 を JSON で出力する。
+
+--model に小さな GGUF を渡せば実モデルで、省略すれば決定的なスタブバックエンド
+(ロジットを乱数で作る偽の Llama) で動く。どちらも CPU・オフラインで動く。
+
+    python tests/benchmark_e2e.py --output e2e.json
+    python tests/benchmark_e2e.py --model models/qwen-1.5b.gguf --concurrency 1,4
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import config
+import cortex_llm
+import scheduler as scheduler_module
+from benchmark_hippocampus import peak_rss_mb, summarize
+from cortex_llm import MonolithicCortex
+from decode_policy import AdaptiveDecodePolicy
+
+PROMPTS = [
+    "Hello, who are you?",
+    "What do you think about the old castle?",
+    "Can you help me find the blacksmith?",
+    "Tell me about your travels.",
+]
+
+
+class StubLlama:
+    """
+    決定的なスタブバックエンド (llama_cpp.Llama の代わり)。
+    トークンごとに乱数のロジットを作って logits processor に通し、最大のものを選ぶ。
+    プロンプトが同じなら出力も同じ。token_ms でモデルのデコード時間を模擬する。
+    """
+
+    n_vocab_size = 8192
+    embed_dim = 64
+    token_ms = 0.0
+
+    def __init__(self, model_path: str = "", **kwargs):
+        self.model_path = model_path
+
+    def n_vocab(self) -> int:
+        return self.n_vocab_size
+
+    def token_eos(self) -> int:
+        return self.n_vocab_size - 1
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return list(text)
+
+    def detokenize(self, tokens, special: bool = False) -> bytes:
+        return b"".join(f" w{t % 1000}".encode() for t in tokens)
+
+    def _rng(self, text: str) -> np.random.Generator:
+        return np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+
+    def _generate(self, prompt: str, max_tokens: int, logits_processor):
+        rng = self._rng(prompt)
+        input_ids = np.array(self.tokenize(prompt.encode("utf-8")), dtype=np.intc)
+        for _ in range(max_tokens):
+            if self.token_ms:
+                time.sleep(self.token_ms / 1000.0)
+            scores = rng.standard_normal(self.n_vocab_size).astype(np.float32) * 3.0
+            for processor in logits_processor or []:
+                scores = processor(input_ids, scores)
+            token = int(np.argmax(scores[:-1]))  # EOS は選ばない (常に max_tokens まで)
+            input_ids = np.append(input_ids, token)
+            yield self.detokenize([token]).decode("utf-8")
+
+    def create_completion(
+        self,
+        prompt: str,
+        max_tokens: int = 16,
+        stream: bool = False,
+        logits_processor=None,
+        **kwargs,
+    ):
+        pieces = self._generate(prompt, max_tokens, logits_processor)
+        if not stream:
+            text = "".join(pieces)
+            return {"choices": [{"text": text, "finish_reason": "length"}]}
+        return self._stream(pieces)
+
+    @staticmethod
+    def _stream(pieces):
+        for piece in pieces:
+            yield {"choices": [{"text": piece, "finish_reason": None}]}
+        yield {"choices": [{"text": "", "finish_reason": "length"}]}
+
+    def create_embedding(self, text: str):
+        embedding = self._rng(text).standard_normal(self.embed_dim).tolist()
+        return {"data": [{"embedding": embedding}]}
+
+
+def use_stub_backend(token_ms: float):
+    """llama.cpp の代わりにスタブを使う (スケジューラは逐次デコードになる)"""
+    StubLlama.token_ms = token_ms
+    cortex_llm.Llama = StubLlama
+    scheduler_module.llama_backend = None
+    try:
+        import monolithic_brain
+    except ImportError:  # torch が無い
+        return
+    monolithic_brain.Llama = StubLlama
+
+
+class PerceptionTimer:
+    """MonolithicCortex.perceive_logits (エントロピー + 海馬への射影) の所要時間を溜める"""
+
+    def __init__(self, cortex: MonolithicCortex):
+        self.total = 0.0
+        self.calls = 0
+        self._perceive = cortex.perceive_logits
+        cortex.perceive_logits = self
+
+    def __call__(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return self._perceive(*args, **kwargs)
+        finally:
+            self.total += time.perf_counter() - t0
+            self.calls += 1
+
+    def reset(self):
+        self.total = 0.0
+        self.calls = 0
+
+
+def bench_think_stream(args, model_path):
+    t0 = time.perf_counter()
+    cortex = MonolithicCortex(
+        model_path=model_path, system_prompt=config.DEFAULT_PERSONA
+    )
+    load_s = time.perf_counter() - t0
+    timer = PerceptionTimer(cortex)
+
+    def run_once(prompt):
+        # スタブと揃えるため早期終了しない方針で、max_tokens まで生成する
+        policy = AdaptiveDecodePolicy(enabled=False)
+        t0 = time.perf_counter()
+        ttft, n_tokens = None, 0
+        for token, _, _ in cortex.think_stream(
+            prompt, max_tokens=args.max_tokens, policy=policy
+        ):
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            n_tokens += 1
+        return ttft or 0.0, time.perf_counter() - t0, n_tokens
+
+    run_once(PROMPTS[0])  # ウォームアップ
+    timer.reset()
+    ttfts, latencies = [], []
+    n_total = 0
+    for i in range(args.iterations):
+        ttft, total, n_tokens = run_once(PROMPTS[i % len(PROMPTS)])
+        ttfts.append(ttft)
+        latencies.append(total)
+        n_total += n_tokens
+    # 最初のトークン以降のデコード速度 (全回の合計で割る)
+    decode_s = sum(latencies) - sum(ttfts)
+
+    # 海馬を通さない生のストリームとの比較 (同じプロンプト・同じ長さ)
+    raw_latencies = []
+    for i in range(args.iterations):
+        prompt = cortex.build_prompt(PROMPTS[i % len(PROMPTS)])
+        t0 = time.perf_counter()
+        for _ in cortex.llm.create_completion(
+            prompt, max_tokens=args.max_tokens, stream=True
+        ):
+            pass
+        raw_latencies.append(time.perf_counter() - t0)
+
+    per_token_us = timer.total / max(timer.calls, 1) * 1e6
+    return {
+        "load_seconds": round(load_s, 3),
+        "ttft": summarize(ttfts),
+        "latency": summarize(latencies),
+        "raw_latency": summarize(raw_latencies),
+        "tokens_per_sec": (
+            round((n_total - len(ttfts)) / decode_s, 1) if decode_s > 0 else None
+        ),
+        "tokens": n_total,
+        "hippocampus_us_per_token": round(per_token_us, 1),
+        "hippocampus_share": round(timer.total / max(sum(latencies), 1e-9), 4),
+    }
+
+
+def bench_neural_symbolic(args, model_path, workdir):
+    """NeuralSymbolicBrain.forward と、保存した .brain を読む CortexBrainAPI.think"""
+    try:
+        from cortex_api import CortexBrainAPI
+        from monolithic_brain import NeuralSymbolicBrain
+    except ImportError as e:
+        skipped = {"skipped": f"{e}"}
+        return skipped, skipped
+
+    # スタブは隠れ状態を持たないので、埋め込みは別インスタンス (create_embedding) から取る
+    shared = {} if args.model else {"shared_model": False}
+    t0 = time.perf_counter()
+    brain = NeuralSymbolicBrain(model_path=model_path, **shared)
+    load_s = time.perf_counter() - t0
+    brain.system_prompt = config.DEFAULT_PERSONA
+
+    brain(PROMPTS[0], max_tokens=args.max_tokens)  # ウォームアップ
+    latencies, entropy_ms = [], []
+    for i in range(args.iterations):
+        t0 = time.perf_counter()
+        result = brain(PROMPTS[i % len(PROMPTS)], max_tokens=args.max_tokens)
+        latencies.append(time.perf_counter() - t0)
+        entropy_ms.append(result["entropy_overhead_ms"])
+    forward = {
+        "load_seconds": round(load_s, 3),
+        "latency": summarize(latencies),
+        "entropy_ms_per_token": round(float(np.mean(entropy_ms)), 4),
+    }
+
+    brain_path = os.path.join(workdir, "bench.brain")
+    brain.save_brain(brain_path)
+    del brain
+    api = CortexBrainAPI(brain_path=brain_path, model_path=model_path)
+    if args.model:
+        t0 = time.perf_counter()
+        api.load()
+        api_load_s = round(time.perf_counter() - t0, 3)
+    else:
+        # load() は共有モードで読み込むが、スタブには隠れ状態が無い
+        api.brain = NeuralSymbolicBrain.load_brain(
+            brain_path, model_path=model_path, shared_model=False
+        )
+        api.loaded = True
+        api_load_s = None
+
+    latencies = []
+    for i in range(args.iterations):
+        t0 = time.perf_counter()
+        reply = api.think(PROMPTS[i % len(PROMPTS)], {"location": "tavern"})
+        latencies.append(time.perf_counter() - t0)
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+    think = {"load_seconds": api_load_s, "latency": summarize(latencies)}
+    return forward, think
+
+
+async def _stream_ttft(app, body) -> float:
+    """
+    /chat/stream を ASGI で直接呼び、最初の token イベントまでの時間を返す。
+    (httpx の ASGITransport はレスポンス全体を溜めてから返すので TTFT を測れない)
+    """
+    payload = json.dumps(body).encode("utf-8")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat/stream",
+        "raw_path": b"/chat/stream",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"bench"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(payload)).encode()),
+        ],
+        "client": ("127.0.0.1", 0),
+        "server": ("bench", 80),
+    }
+    done = asyncio.Event()
+    sent_request = False
+    t0 = time.perf_counter()
+    ttft = None
+
+    async def receive():
+        nonlocal sent_request
+        if not sent_request:
+            sent_request = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await done.wait()  # 応答が終わるまでクライアントは切断しない
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal ttft
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            raise RuntimeError(f"/chat/stream returned {message['status']}")
+        if message["type"] == "http.response.body":
+            if ttft is None and b"event: token" in message.get("body", b""):
+                ttft = time.perf_counter() - t0
+            if not message.get("more_body", False):
+                done.set()
+
+    await app(scope, receive, send)
+    return ttft
+
+
+async def _chat_round(client, app, concurrency, requests_per_npc, stream):
+    """concurrency 体の NPC がそれぞれ順に話しかける。(レイテンシ, TTFT) のリストを返す"""
+
+    async def npc(n):
+        results = []
+        for i in range(requests_per_npc):
+            body = {"text": PROMPTS[(n + i) % len(PROMPTS)], "npc_id": f"npc{n}"}
+            t0 = time.perf_counter()
+            ttft = None
+            if stream:
+                ttft = await _stream_ttft(app, body)
+            else:
+                resp = await client.post("/chat", json=body)
+                resp.raise_for_status()
+            results.append((time.perf_counter() - t0, ttft))
+        return results
+
+    rounds = await asyncio.gather(*(npc(n) for n in range(concurrency)))
+    return [r for npc_results in rounds for r in npc_results]
+
+
+async def _bench_server(args, server):
+    import httpx
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        await _chat_round(client, server.app, 1, 1, stream=False)  # ウォームアップ
+        levels = []
+        for concurrency in args.concurrency:
+            t0 = time.perf_counter()
+            results = await _chat_round(
+                client, server.app, concurrency, args.requests, False
+            )
+            wall = time.perf_counter() - t0
+            streamed = await _chat_round(client, server.app, concurrency, 1, True)
+            level = {
+                "concurrency": concurrency,
+                "latency": summarize([latency for latency, _ in results]),
+                "ttft": summarize([ttft for _, ttft in streamed if ttft is not None]),
+            }
+            level["latency"]["per_sec"] = round(len(results) / wall, 2)
+            levels.append(level)
+        return levels
+
+
+def bench_server(args, model_path, workdir):
+    """FastAPI アプリをプロセス内で起動し、/chat・/chat/stream を ASGI 経由で叩く"""
+    try:
+        import httpx  # noqa: F401
+    except ImportError as e:
+        return {"skipped": f"{e}"}
+
+    # server はインポート時に実行ディレクトリ直下へ models/・memories/ を作る
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import server
+
+        server.model_path = model_path
+        t0 = time.perf_counter()
+        server.startup_event()
+        while not server.startup.ready:
+            if server.startup.error:
+                raise RuntimeError(server.startup.error)
+            time.sleep(0.01)
+        load_s = time.perf_counter() - t0
+        try:
+            levels = asyncio.run(_bench_server(args, server))
+        finally:
+            server.shutdown_event()
+    finally:
+        os.chdir(cwd)
+    return {
+        "load_seconds": round(load_s, 3),
+        "batched": server.scheduler.batched,
+        "levels": levels,
+    }
+
+
+def run_benchmark(args):
+    if args.model:
+        model_path = os.path.abspath(args.model)
+    else:
+        use_stub_backend(args.stub_token_ms)
+        model_path = "stub.gguf"
+
+    report = {
+        "benchmark": "e2e",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "system": platform.system(),
+            "cpus": os.cpu_count(),
+        },
+        "params": {
+            "backend": os.path.basename(model_path) if args.model else "stub",
+            "stub_token_ms": None if args.model else args.stub_token_ms,
+            "max_tokens": args.max_tokens,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "requests_per_npc": args.requests,
+        },
+    }
+    with tempfile.TemporaryDirectory(prefix="e2e_bench_") as workdir:
+        # 各コンポーネントのログ出力は計測から外す (進捗は stderr へ)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            print("[benchmark] think_stream...", file=sys.stderr, flush=True)
+            report["think_stream"] = bench_think_stream(args, model_path)
+            print("[benchmark] NeuralSymbolicBrain...", file=sys.stderr, flush=True)
+            forward, think = bench_neural_symbolic(args, model_path, workdir)
+            report["neural_symbolic_forward"] = forward
+            report["cortex_api_think"] = think
+            print("[benchmark] /chat...", file=sys.stderr, flush=True)
+            report["chat"] = bench_server(args, model_path, workdir)
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", help="GGUF file (omit to use the stub backend)")
+    parser.add_argument(
+        "--stub-token-ms",
+        type=float,
+        default=2.0,
+        help="simulated decode time per token of the stub backend",
+    )
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument(
+        "--iterations", type=int, default=10, help="calls per single-request stage"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1, 4, 16],
+        help="comma-separated numbers of concurrent NPCs",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=3, help="/chat requests per NPC and level"
+    )
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"✅ Benchmark written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
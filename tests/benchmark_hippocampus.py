@@ -0,0 +1,259 @@
+"""
+Hippocampus (LTM) scaling benchmark.
+
+合成した記憶バンク (既定 100 〜 1M 件) に対して project_thought / save_memory /
+load_memories / recall のレイテンシ・スループットとピーク RSS を計測し、JSON で出力する。
+モデルファイルは不要 (オフラインで動く)。リリース間の結果は JSON の diff で比較できる。
+
+    python tests/benchmark_hippocampus.py --output bench.json
+    python tests/benchmark_hippocampus.py --sizes 100,10000 --queries 50
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import config
+from hippocampus import Hippocampus
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = [100, 1_000, 10_000, 100_000, 1_000_000]
+BUILD_CHUNK = 10_000
+
+
+def peak_rss_mb():
+    """このプロセスのピーク RSS (MB)。取得できない環境では None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB, macOS は bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(latencies):
+    """秒単位のレイテンシ列 → ミリ秒の統計とスループット"""
+    ms = np.asarray(latencies) * 1000.0
+    total = float(np.sum(latencies))
+    return {
+        "n": len(ms),
+        "mean_ms": round(float(ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(ms, 99)), 4),
+        "per_sec": round(len(ms) / total, 1) if total > 0 else None,
+    }
+
+
+def timed(fn, repeat):
+    latencies = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def synthetic_logprobs(rng, n_steps, top_k=40, vocab=5000):
+    """生成ステップごとの top_logprobs (確率の高い順) を合成する"""
+    steps = []
+    for _ in range(n_steps):
+        ids = rng.choice(vocab, size=top_k, replace=False)
+        logits = np.sort(rng.normal(0.0, 2.0, size=top_k))[::-1]
+        log_probs = logits - np.log(np.sum(np.exp(logits)))
+        steps.append({f"tok{i}": float(lp) for i, lp in zip(ids, log_probs)})
+    return steps
+
+
+def noisy_query(rng, packed, similarity):
+    """保存済みベクトルを、類似度がおよそ similarity になるようにビット反転したクエリ"""
+    bits = np.unpackbits(packed)
+    flip = rng.random(bits.shape) < (1.0 - similarity) / 2.0
+    return np.packbits(bits ^ flip)
+
+
+def bench_projection(args):
+    """project_thought はバンクの大きさに依存しないので1回だけ測る"""
+    rng = np.random.default_rng(args.seed)
+    hippo = Hippocampus(hdc_dim=config.HDC_DIM)
+    steps = synthetic_logprobs(rng, args.steps)
+    # 1周目はコードブックの LRU が埋まる (コールド)、2周目はキャッシュ済み (ウォーム)
+    cold = timed(lambda i: hippo.project_thought(steps[i]), len(steps))
+    warm = timed(lambda i: hippo.project_thought(steps[i]), len(steps))
+    return {
+        "top_k": len(steps[0]),
+        "cold": summarize(cold),
+        "warm": summarize(warm),
+    }
+
+
+def build_bank(hippo, filepath, size, rng):
+    """size 件の合成記憶をまとめて書き込む (ストアへの追記は BUILD_CHUNK 件ずつ)"""
+    for start in range(0, size, BUILD_CHUNK):
+        n = min(BUILD_CHUNK, size - start)
+        packed = rng.integers(0, 256, size=(n, config.HDC_DIM // 8), dtype=np.uint8)
+        entries = [
+            (
+                hippo.new_memory(f"synthetic input {start + i}", "synthetic reply"),
+                packed[i],
+            )
+            for i in range(n)
+        ]
+        hippo.save_memories(filepath, entries)
+
+
+def bench_bank(size, args):
+    """1つのバンクサイズの計測 (ピーク RSS を分けるため、サイズごとに別プロセスで動く)"""
+    rng = np.random.default_rng(args.seed + size)
+    workdir = tempfile.mkdtemp(prefix="hippo_bench_")
+    filepath = os.path.join(workdir, "ltm.json")
+    hippo = Hippocampus(hdc_dim=config.HDC_DIM, max_memories=size + args.saves + 1)
+    result = {"size": size}
+    try:
+        t0 = time.perf_counter()
+        build_bank(hippo, filepath, size, rng)
+        build_s = time.perf_counter() - t0
+        result["build"] = {
+            "seconds": round(build_s, 3),
+            "per_sec": round(size / build_s, 1),
+        }
+
+        # 1件ずつの保存 (/chat の1ターン分)。保存ログの print は計測から外す
+        vectors = rng.choice([-1.0, 1.0], size=(args.saves, config.HDC_DIM))
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            saves = timed(
+                lambda i: hippo.save_memory(vectors[i], "hello", "hi", filepath),
+                args.saves,
+            )
+        result["save_memory"] = summarize(saves)
+
+        # 閉じてからストアを開き直す (セッション復帰時のコールドロード)
+        hippo.close()
+        t0 = time.perf_counter()
+        index = hippo.index_for(filepath)
+        result["open"] = {"seconds": round(time.perf_counter() - t0, 3)}
+
+        if size <= args.max_load_size:
+            t0 = time.perf_counter()
+            memories = hippo.load_memories(filepath)
+            result["load_memories"] = {
+                "seconds": round(time.perf_counter() - t0, 3),
+                "entries": len(memories),
+            }
+            del memories
+        else:
+            # 全件を Base64 の dict にするので、大きなバンクではメモリが足りなくなる
+            result["load_memories"] = {"skipped": f"size > {args.max_load_size}"}
+
+        rows = rng.integers(0, len(index), size=args.queries)
+        queries = [noisy_query(rng, index.packed[row], args.similarity) for row in rows]
+        for exact in (False, True):
+            hippo.recall(queries[0], filepath, exact=exact)  # LSH の構築を計測から外す
+            hits = []
+
+            def recall(i):
+                hits.append(hippo.recall(queries[i], filepath, top_k=3, exact=exact))
+
+            stats = summarize(timed(recall, args.queries))
+            expected = [index.records[row]["id"] for row in rows]
+            stats["hit_rate"] = round(
+                float(
+                    np.mean(
+                        [bool(h) and h[0][0]["id"] == e for h, e in zip(hits, expected)]
+                    )
+                ),
+                3,
+            )
+            result["recall_exact" if exact else "recall"] = stats
+
+        result["index_mb"] = round(index.nbytes / (1024 * 1024), 1)
+        result["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        hippo.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def run_benchmark(args):
+    report = {
+        "benchmark": "hippocampus",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "system": platform.system(),
+            "cpus": os.cpu_count(),
+        },
+        "params": {
+            "hdc_dim": config.HDC_DIM,
+            "sizes": args.sizes,
+            "steps": args.steps,
+            "saves": args.saves,
+            "queries": args.queries,
+            "similarity": args.similarity,
+            "ann_min_size": config.LTM_ANN_MIN_SIZE,
+            "seed": args.seed,
+        },
+        "project_thought": bench_projection(args),
+        "banks": [],
+    }
+
+    # サイズごとに新しいプロセスで計測し、ピーク RSS が前のサイズに引きずられないようにする
+    ctx = get_context("spawn")
+    for size in args.sizes:
+        print(f"[benchmark] {size} memories...", file=sys.stderr, flush=True)
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            report["banks"].append(pool.submit(bench_bank, size, args).result())
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=DEFAULT_SIZES,
+        help="comma-separated bank sizes",
+    )
+    parser.add_argument("--steps", type=int, default=500, help="project_thought calls")
+    parser.add_argument("--saves", type=int, default=200, help="save_memory calls")
+    parser.add_argument("--queries", type=int, default=200, help="recall calls")
+    parser.add_argument(
+        "--similarity", type=float, default=0.8, help="query/target similarity"
+    )
+    parser.add_argument(
+        "--max-load-size",
+        type=int,
+        default=200_000,
+        help="skip load_memories for larger banks",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"✅ Benchmark written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
@@ -0,0 +1,43 @@
+import sys
+import os
+import asyncio
+import threading
+import time
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from scheduler import ChatJob
+
+
+def test_chat_job_async_iteration_receives_scheduler_tokens():
+    job = ChatJob("prompt")
+    vec = np.zeros(4, dtype=np.float32)
+    job.put_token("early", vec, 0.1)  # 読み始める前に届いたトークンも失わない
+
+    def scheduler_thread():
+        for token in ("a", "b"):
+            time.sleep(0.01)
+            job.put_token(token, vec, 0.2)
+        job.finish("stop")
+
+    async def collect():
+        threading.Thread(target=scheduler_thread).start()
+        return [token async for token, _, _ in job]
+
+    assert asyncio.run(collect()) == ["early", "a", "b"]
+    assert job.finish_reason == "stop" and not job.cancelled
+
+    # 途中で読むのをやめたら、スケジューラ側のデコードも止める
+    job = ChatJob("prompt")
+    job.put_token("x", vec, 0.1)
+
+    async def first_only():
+        async for token, _, _ in job:
+            return token
+
+    assert asyncio.run(first_only()) == "x"
+    assert job.cancelled
+
+
+if __name__ == "__main__":
+    test_chat_job_async_iteration_receives_scheduler_tokens()
+    print("✅ Async streaming tests passed")
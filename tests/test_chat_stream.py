@@ -0,0 +1,136 @@
+import sys
+import os
+import asyncio
+import json
+import tempfile
+import threading
+import time
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from fastapi.testclient import TestClient
+from cortex_llm import MonolithicCortex
+from scheduler import ChatJob
+
+# server は読み込み時にカレントディレクトリに models/・memories/ を作るので、一時ディレクトリで読み込む
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    import server
+finally:
+    os.chdir(_cwd)
+
+
+class PromptOnlyCortex(MonolithicCortex):
+    """モデルを読み込まず、プロンプトの組み立てだけを行う"""
+
+    def __init__(self):
+        self.system_prompt = "persona"
+
+
+class ScriptedScheduler:
+    """投入されたジョブに決まったトークンを別スレッドから流す"""
+
+    def __init__(self, tokens, token_seconds=0.0):
+        self.tokens = tokens
+        self.token_seconds = token_seconds
+        self.jobs = []
+
+    def submit(self, prompt, game_context=None, **params):
+        job = ChatJob(prompt)
+        self.jobs.append(job)
+        threading.Thread(target=self._decode, args=(job,), daemon=True).start()
+        return job
+
+    def _decode(self, job):
+        vec = np.ones(server.hippocampus.hdc_dim, dtype=np.float32)
+        for token in self.tokens:
+            if job.cancelled:
+                return
+            time.sleep(self.token_seconds)
+            job.put_token(token, vec, 0.5)
+        job.finish("stop")
+
+
+def _serve(scheduler):
+    server.brain = PromptOnlyCortex()
+    server.scheduler = scheduler
+    server.startup.mark_ready()
+
+
+def _parse_sse(body):
+    events = []
+    for frame in body.split("\n\n"):
+        if not frame:
+            continue
+        kind, data = frame.split("\n")
+        assert kind.startswith("event: ") and data.startswith("data: ")
+        events.append((kind[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_stream_frames_tokens_and_done():
+    _serve(ScriptedScheduler(["He", "llo"]))
+    client = TestClient(server.app)
+    res = client.post(
+        "/chat/stream", json={"text": "hi", "npc_id": "sse-framing", "timings": True}
+    )
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/event-stream")
+    assert res.text.endswith("\n\n")
+
+    events = _parse_sse(res.text)
+    kinds = [kind for kind, _ in events]
+    assert kinds == ["token", "token", "done"]
+    assert [data["text"] for _, data in events[:-1]] == ["He", "llo"]
+    assert events[0][1]["entropy"] == 0.5
+
+    done = events[-1][1]
+    assert done["reply"] == "Hello"
+    assert done["memory_id"]
+    assert {"timings", "prompt"} <= set(done)
+    assert server.sessions.peek("sse-framing").in_use == 0
+
+
+def test_disconnect_before_first_event_releases_session():
+    scheduler = ScriptedScheduler(["x"] * 200, token_seconds=0.01)
+    _serve(scheduler)
+    body = json.dumps({"text": "hi", "npc_id": "sse-disconnect"}).encode()
+    sent = []
+
+    async def receive():
+        if not sent:
+            sent.append(True)
+            return {"type": "http.request", "body": body, "more_body": False}
+        # 最初のイベントより前にクライアントが切断する
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            await asyncio.sleep(0.2)  # ヘッダーの送信中に切断が届く
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat/stream",
+        "raw_path": b"/chat/stream",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    asyncio.run(server.app(scope, receive, send))
+
+    # デコードは止まり、セッションは返されている (破棄・LTM の flush ができる)
+    job = scheduler.jobs[0]
+    assert job.cancelled
+    assert server.sessions.peek("sse-disconnect").in_use == 0
+
+
+if __name__ == "__main__":
+    test_stream_frames_tokens_and_done()
+    test_disconnect_before_first_event_releases_session()
+    print("✅ Chat stream tests passed")
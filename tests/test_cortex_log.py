@@ -0,0 +1,65 @@
+import sys
+import os
+import io
+import logging
+import queue
+from contextlib import redirect_stdout
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import cortex_log
+
+
+def test_queue_handler_drops_instead_of_blocking():
+    handler = cortex_log.DroppingQueueHandler(queue.Queue(maxsize=2))
+    logger = logging.getLogger("test.dropping")
+    logger.propagate = False
+    logger.handlers = [handler]
+    for i in range(5):
+        logger.warning("record %d", i)
+    assert handler.queue.qsize() == 2 and handler.dropped == 3
+    # キューに積む前にメッセージは展開されている (書き出し側で引数を触らない)
+    assert handler.queue.get_nowait().getMessage() == "record 0"
+
+
+def test_sample_filter_passes_every_nth():
+    sample = cortex_log.SampleFilter(4)
+    record = logging.makeLogRecord({"msg": "token"})
+    assert [sample.filter(record) for _ in range(8)] == [True, False, False, False] * 2
+
+
+def test_setup_writes_in_background():
+    cortex_log.shutdown()
+    out = io.StringIO()
+    with redirect_stdout(out):
+        cortex_log.setup(level="INFO", brain_activity=True, token_sample=2)
+        try:
+            cortex_log.activity.info("[%s] %10s: %s", "12:00:00", "NPC", "hello")
+            cortex_log.get_logger("test").info("Loading model: %s", "tiny.gguf")
+            cortex_log.get_logger("test").debug("hidden below INFO")
+            for i in range(4):
+                cortex_log.tokens.debug("token %d", i)
+        finally:
+            cortex_log.shutdown()  # 残りを書き出してから戻る
+    lines = out.getvalue().splitlines()
+
+    # 活動表示は従来どおりメッセージだけ、それ以外は時刻・レベル・ロガー名付き
+    assert "[12:00:00]        NPC: hello" in lines
+    assert any(l.endswith("INFO [cortex.test] Loading model: tiny.gguf") for l in lines)
+    assert not any("hidden" in l for l in lines)
+    assert [l.split("] ")[1] for l in lines if "cortex.tokens" in l] == [
+        "token 0",
+        "token 2",
+    ]
+
+    # 活動表示を切ると、活動のレコードは作られない
+    cortex_log.setup(brain_activity=False)
+    try:
+        assert not cortex_log.activity.isEnabledFor(logging.INFO)
+    finally:
+        cortex_log.shutdown()
+
+
+if __name__ == "__main__":
+    test_queue_handler_drops_instead_of_blocking()
+    test_sample_filter_passes_every_nth()
+    test_setup_writes_in_background()
+    print("✅ Logging tests passed")
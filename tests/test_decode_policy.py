@@ -0,0 +1,51 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from decode_policy import AdaptiveDecodePolicy
+
+
+def _feed(policy, pieces, entropy):
+    for i, piece in enumerate(pieces):
+        if policy.should_stop(entropy, piece):
+            return i
+    return None
+
+
+def test_early_exit_after_calm_closed_sentence():
+    pieces = ["Hello", " there", ",", " traveler", ".", " Welcome", " to", " the", " village", "!"]
+
+    # 短すぎる応答は閉じても続ける。min_tokens を超えた後の文末で終わる
+    policy = AdaptiveDecodePolicy(enabled=True, calm_entropy=0.6, min_tokens=6)
+    assert _feed(policy, pieces, 0.2) == 9
+
+    # 迷いながら書いた文では終わらない
+    policy = AdaptiveDecodePolicy(enabled=True, calm_entropy=0.6, min_tokens=1)
+    assert _feed(policy, pieces, 1.2) is None
+
+    # 数字中のピリオドや空白だけのトークンは文末ではない
+    policy = AdaptiveDecodePolicy(enabled=True, calm_entropy=0.6, min_tokens=1)
+    assert _feed(policy, ["It", " costs", " 3", ".", "5", " gold"], 0.1) is None
+    assert _feed(policy, ["」", " "], 0.1) is None
+
+    # 無効なら常に続ける
+    policy = AdaptiveDecodePolicy(enabled=False, min_tokens=1)
+    assert _feed(policy, pieces, 0.0) is None
+
+
+def test_projection_width_follows_entropy():
+    policy = AdaptiveDecodePolicy(
+        enabled=True, base_k=8, wide_k=40, spike_entropy=1.5, skip_entropy=0.05
+    )
+    # 最初のトークンはほぼ決定的でも射影する
+    assert policy.projection_k(0.0) == 8
+    assert policy.projection_k(0.01) == 0
+    assert policy.projection_k(0.5) == 8
+    assert policy.projection_k(2.0) == 40
+
+    assert AdaptiveDecodePolicy(enabled=False, wide_k=40).projection_k(0.0) == 40
+
+
+if __name__ == "__main__":
+    test_early_exit_after_calm_closed_sentence()
+    test_projection_width_follows_entropy()
+    print("✅ Decode policy tests passed")
@@ -0,0 +1,43 @@
+import sys
+import os
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from entropy import EntropyProbe, entropy_from_logits, log_softmax
+
+
+def test_entropy_matches_definition():
+    rng = np.random.default_rng(0)
+    logits = rng.normal(size=(3, 1000)).astype(np.float32) * 4
+    p = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    p /= p.sum(axis=-1, keepdims=True)
+    expected = -np.sum(p * np.log(p), axis=-1)
+    assert np.allclose(entropy_from_logits(logits), expected, atol=1e-4)
+    assert np.allclose(np.exp(log_softmax(logits)).sum(axis=-1), 1.0, atol=1e-5)
+
+    # 一様分布は log V、極端に尖った分布は 0 (大きな値でもオーバーフローしない)
+    assert abs(float(entropy_from_logits(np.zeros(1000))) - np.log(1000)) < 1e-4
+    peaked = np.full(1000, -1e4, dtype=np.float32)
+    peaked[7] = 1e4
+    assert float(entropy_from_logits(peaked)) < 1e-6
+
+
+def test_probe_records_and_thins_out_over_budget():
+    logits = np.zeros(500, dtype=np.float32)
+    probe = EntropyProbe(budget_ms=1000.0)
+    for _ in range(5):
+        assert probe(np.array([1, 2]), logits) is logits
+    assert len(probe.entropies) == 5 and probe.stride == 1
+    assert abs(probe.mean - np.log(500)) < 1e-4
+
+    # 予算 0 では計測が間引かれ、max_stride で頭打ちになる
+    probe = EntropyProbe(budget_ms=0.0, max_stride=4)
+    for _ in range(32):
+        probe(np.array([1]), logits)
+    assert probe.stride == 4
+    assert len(probe.entropies) < 32
+
+
+if __name__ == "__main__":
+    test_entropy_matches_definition()
+    test_probe_records_and_thins_out_over_budget()
+    print("✅ Entropy tests passed")
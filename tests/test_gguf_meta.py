@@ -0,0 +1,69 @@
+import sys
+import os
+import struct
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from gguf_meta import GGUFArray, model_dims, read_metadata
+
+
+def _string(s):
+    data = s.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def _write_gguf(path, n_vocab=1000):
+    kvs = [
+        (_string("general.architecture"), 8, _string("qwen2")),
+        (_string("qwen2.embedding_length"), 4, struct.pack("<I", 1536)),
+        (_string("qwen2.context_length"), 4, struct.pack("<I", 32768)),
+        (_string("qwen2.block_count"), 4, struct.pack("<I", 28)),
+        (_string("qwen2.rope.freq_base"), 6, struct.pack("<f", 1000000.0)),
+        (
+            _string("tokenizer.ggml.tokens"),
+            9,
+            struct.pack("<IQ", 8, n_vocab) + b"".join(_string(f"tok{i}") for i in range(n_vocab)),
+        ),
+        (_string("tokenizer.ggml.add_bos_token"), 7, struct.pack("<?", False)),
+    ]
+    with open(path, "wb") as f:
+        f.write(b"GGUF" + struct.pack("<IQQ", 3, 0, len(kvs)))
+        for key, value_type, value in kvs:
+            f.write(key + struct.pack("<I", value_type) + value)
+
+
+def test_reads_dims_without_loading_model():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model.gguf")
+        _write_gguf(path)
+
+        metadata = read_metadata(path)
+        # 大きな配列は読み飛ばし、後続のキーも正しく読めている
+        assert metadata["tokenizer.ggml.tokens"] == GGUFArray(8, 1000)
+        assert metadata["tokenizer.ggml.add_bos_token"] is False
+        assert abs(metadata["qwen2.rope.freq_base"] - 1e6) < 1
+
+        assert model_dims(path) == {
+            "architecture": "qwen2",
+            "n_embd": 1536,
+            "n_ctx_train": 32768,
+            "n_layer": 28,
+            "n_vocab": 1000,
+        }
+
+
+def test_rejects_non_gguf():
+    with tempfile.NamedTemporaryFile(suffix=".gguf") as f:
+        f.write(b"not a model")
+        f.flush()
+        try:
+            read_metadata(f.name)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError")
+
+
+if __name__ == "__main__":
+    test_reads_dims_without_loading_model()
+    test_rejects_non_gguf()
+    print("✅ GGUF metadata tests passed")
@@ -0,0 +1,73 @@
+import sys
+import os
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from tiny_model import N_EMBD, tiny_model_path
+
+PROMPT = "System: you is the hello\nUser: hello a\nAssistant:"
+
+
+class ScoreRecorder:
+    """後ろに置いて、生成に使われるロジットを記録する"""
+
+    def __init__(self):
+        self.scores = []
+
+    def __call__(self, input_ids, scores):
+        self.scores.append(np.array(scores, copy=True))
+        return scores
+
+
+def generate(llm, with_pool):
+    """MonolithicBrain.think の共有モードと同じ並び (EntropyProbe → HiddenStatePool) で生成する"""
+    import llama_backend
+    from llama_cpp import LogitsProcessorList
+    from entropy import EntropyProbe
+
+    probe, recorder = EntropyProbe(), ScoreRecorder()
+    processors = [probe]
+    pool = None
+    if with_pool:
+        pool = llama_backend.HiddenStatePool(llm, llama_backend.n_embd(llm.model))
+        processors.append(pool)
+    processors.append(recorder)
+    llm.reset()
+    try:
+        response = llm.create_completion(
+            PROMPT,
+            max_tokens=8,
+            temperature=0,
+            logits_processor=LogitsProcessorList(processors),
+        )
+    finally:
+        if pool is not None:
+            pool.close()
+    return response["choices"][0]["text"], recorder.scores, pool
+
+
+def test_pool_collects_hidden_states_without_changing_logits():
+    from llama_cpp import Llama
+
+    llm = Llama(tiny_model_path(), n_ctx=256, verbose=False)
+    text, scores, _ = generate(llm, with_pool=False)
+    pooled_text, pooled_scores, pool = generate(llm, with_pool=True)
+
+    # 隠れ状態の出力を有効にしても、サンプリングに使うロジットは変わらない
+    assert pooled_text == text
+    assert len(pooled_scores) == len(scores)
+    for a, b in zip(pooled_scores, scores):
+        np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-5)
+
+    # プロンプト評価の後、生成した各トークンの隠れ状態が平均される
+    assert pool.count == len(scores) - 1
+    thought = pool.mean()
+    assert thought.shape == (N_EMBD,) and thought.dtype == np.float32
+    assert np.isfinite(thought).all() and np.abs(thought).sum() > 0
+
+    # close() 後は通常の生成に戻る
+    assert generate(llm, with_pool=False)[0] == text
+
+
+if __name__ == "__main__":
+    test_pool_collects_hidden_states_without_changing_logits()
+    print("✅ Hidden state pool tests passed")
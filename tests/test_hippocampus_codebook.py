@@ -0,0 +1,142 @@
+import sys
+import os
+import subprocess
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from codebook import TokenCodebook
+from hippocampus import Hippocampus, ThoughtAccumulator
+import numpy as np
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../src'))
+
+
+def test_codebook_is_deterministic():
+    a = TokenCodebook(seed=42)
+    b = TokenCodebook(seed=42)
+    c = TokenCodebook(seed=7)
+    assert np.array_equal(a.packed("リンゴ"), b.packed("リンゴ"))
+    assert not np.array_equal(a.packed("リンゴ"), c.packed("リンゴ"))
+    assert a.packed("apple").shape == (4096 // 8,)
+
+
+def test_codebook_survives_hash_randomization():
+    """PYTHONHASHSEED が違うプロセスでも同じベクトルになること"""
+    code = (
+        "import sys; sys.path.insert(0, %r);"
+        "from codebook import TokenCodebook;"
+        "print(TokenCodebook().packed('hello').tobytes().hex())" % SRC_DIR
+    )
+    outputs = set()
+    for hash_seed in ("1", "2"):
+        env = dict(os.environ, PYTHONHASHSEED=hash_seed)
+        out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+        outputs.add(out.stdout.strip())
+    assert len(outputs) == 1
+
+
+def test_lru_is_bounded():
+    codebook = TokenCodebook(cache_size=4)
+    for i in range(10):
+        codebook.packed(f"tok{i}")
+    assert len(codebook._cache) == 4
+
+
+def test_vocab_table_matches_string_path():
+    pieces = [f"piece{i}".encode("utf-8") for i in range(32)]
+    codebook = TokenCodebook()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "codebook.npy")
+        table = codebook.attach_vocab(path, len(pieces), pieces.__getitem__)
+        assert table.shape == (32, 512)
+        rows = codebook.packed_ids([3, 5])
+        assert np.array_equal(rows[0], codebook.packed("piece3"))
+        assert np.array_equal(rows[1], codebook.packed("piece5"))
+
+        # 再オープン時は構築せずに mmap する
+        reopened = TokenCodebook().attach_vocab(path, len(pieces), pieces.__getitem__)
+        assert isinstance(reopened, np.memmap)
+
+
+def test_project_thought_is_stable_bipolar():
+    hippocampus = Hippocampus()
+    logprobs = {"りん": -0.1, "ご": -1.5, "車": -4.0}
+    v1 = hippocampus.project_thought(logprobs)
+    v2 = Hippocampus().project_thought(logprobs)
+    assert v1.shape == (4096,)
+    assert set(np.unique(v1)) <= {-1.0, 1.0}
+    assert np.array_equal(v1, v2)
+
+    # 重み付き和の二値化と一致すること
+    probs = np.exp(np.array(list(logprobs.values())))
+    probs /= probs.sum()
+    bipolar = np.unpackbits(hippocampus.codebook.packed_rows(list(logprobs)), axis=1) * 2.0 - 1.0
+    expected = np.where(probs @ bipolar >= 0, 1.0, -1.0)
+    assert np.array_equal(v1, expected)
+
+
+def test_project_ids_matches_string_path():
+    pieces = ["りん".encode("utf-8"), "ご".encode("utf-8"), "車".encode("utf-8"), b"x"]
+    logprobs = {"りん": -0.1, "ご": -1.5, "車": -4.0}
+    expected = Hippocampus().project_thought(logprobs)
+    ids = np.array([0, 1, 2])
+    log_probs = np.array(list(logprobs.values()), dtype=np.float32)
+
+    # 語彙テーブルが無ければ ID → バイト列で引く
+    hippocampus = Hippocampus()
+    assert np.array_equal(hippocampus.project_ids(ids, log_probs, pieces.__getitem__), expected)
+
+    # 語彙テーブルがあれば ID で直接引く (文字列化しない)
+    with tempfile.TemporaryDirectory() as tmp:
+        hippocampus.codebook.attach_vocab(os.path.join(tmp, "codebook.npy"), len(pieces), pieces.__getitem__)
+        assert np.array_equal(hippocampus.project_ids(ids, log_probs), expected)
+
+
+def test_project_sequence_matches_per_token():
+    hippocampus = Hippocampus()
+    sequence = [
+        {"こん": -0.2, "今日": -1.8, "はい": -3.0},
+        {},
+        {"にち": -0.05, "ばん": -3.2},
+        {"は": -0.5, "、": -1.0, "！": -2.5, "。": -6.0},
+    ]
+    per_step, pooled = hippocampus.project_sequence(sequence)
+    assert per_step.shape == (4, 4096)
+    assert not per_step[1].any()
+
+    expected = [hippocampus.project_thought(step) for step in sequence]
+    for row, vec in zip(per_step, expected):
+        assert np.array_equal(row, vec)
+
+    stacked = np.array([v for v in expected if v.any()])
+    assert np.array_equal(pooled, np.where(stacked.sum(axis=0) >= 0, 1.0, -1.0))
+
+
+def test_thought_accumulator_matches_list_pooling():
+    rng = np.random.default_rng(1)
+    vectors = [np.where(rng.random(4096) < 0.5, -1.0, 1.0).astype(np.float32) for _ in range(7)]
+    vectors.insert(3, np.zeros(4096, dtype=np.float32))  # 射影されなかったトークン
+
+    thought = ThoughtAccumulator(4096)
+    added = [thought.add(v) for v in vectors]
+    assert added.count(False) == 1 and thought.count == 7
+    expected = np.packbits(np.mean([v for v in vectors if v.any()], axis=0) >= 0)
+    assert np.array_equal(thought.snapshot(), expected)
+
+    # 重み付き: 重要度の高いベクトルが優勢になる
+    thought.reset()
+    thought.add(vectors[0], weight=5.0)
+    thought.add(vectors[1])
+    assert np.array_equal(thought.snapshot(), np.packbits(vectors[0] >= 0))
+    assert thought.total_weight == 6.0
+
+
+if __name__ == "__main__":
+    test_codebook_is_deterministic()
+    test_codebook_survives_hash_randomization()
+    test_lru_is_bounded()
+    test_vocab_table_matches_string_path()
+    test_project_thought_is_stable_bipolar()
+    test_project_ids_matches_string_path()
+    test_project_sequence_matches_per_token()
+    test_thought_accumulator_matches_list_pooling()
+    print("✅ Codebook tests passed")
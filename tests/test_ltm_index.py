@@ -0,0 +1,183 @@
+import sys
+import os
+import json
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from hippocampus import Hippocampus
+from ltm_index import BitSamplingLSH, LTMIndex
+from hdc_bits import hamming_similarity, pack_bipolar, unpack_bipolar
+import base64
+import numpy as np
+
+
+def random_bipolar(rng, n, dim=4096):
+    return np.where(rng.random((n, dim)) < 0.5, 1.0, -1.0).astype(np.float32)
+
+
+def test_search_matches_linear_scan():
+    rng = np.random.default_rng(0)
+    vectors = random_bipolar(rng, 200)
+    index = LTMIndex()
+    for i, vec in enumerate(vectors):
+        index.add({"id": str(i)}, vec)
+
+    query = vectors[17].copy()
+    query[:1000] *= -1  # 類似度 ~0.5 のノイズ入りクエリ
+    results = index.search(query, top_k=3, similarity_threshold=0.0)
+
+    sims = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+    expected = np.argsort(-sims)[:3]
+    assert [r[0]["id"] for r in results] == [str(i) for i in expected]
+    assert abs(results[0][1] - sims[17]) < 1e-5
+
+
+def test_remove_compacts_rows():
+    rng = np.random.default_rng(1)
+    vectors = random_bipolar(rng, 5)
+    index = LTMIndex(capacity=2)
+    for i, vec in enumerate(vectors):
+        index.add({"id": str(i)}, vec)
+    assert index.remove(["1", "3"]) == 2
+    assert [r["id"] for r in index.records] == ["0", "2", "4"]
+    assert np.array_equal(index.vectors, vectors[[0, 2, 4]])
+
+
+def test_recall_uses_resident_index():
+    rng = np.random.default_rng(2)
+    hippocampus = Hippocampus()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ltm.json")
+        vectors = random_bipolar(rng, 4)
+        for i, vec in enumerate(vectors):
+            hippocampus.save_memory(
+                vec, f"in{i}", f"out{i}", path, importance=0.1 * (i + 1)
+            )
+
+        # ストアを消してもインデックスから想起できる (ディスクを読まない)
+        store_dir = hippocampus.store_path(path)
+        backup = store_dir + ".bak"
+        os.rename(store_dir, backup)
+        results = hippocampus.recall(vectors[2], path, top_k=1)
+        assert results[0][0]["user_input"] == "in2"
+        assert results[0][1] > 0.99
+        os.rename(backup, store_dir)
+        hippocampus.close()
+
+        # 別インスタンスはストアから読み直す
+        fresh = Hippocampus()
+        assert fresh.recall(vectors[0], path, top_k=1)[0][0]["user_input"] == "in0"
+        fresh.close()
+
+
+def test_hamming_matches_cosine():
+    rng = np.random.default_rng(3)
+    vectors = random_bipolar(rng, 50)
+    packed = pack_bipolar(vectors)
+    assert packed.shape == (50, 512)
+    assert np.array_equal(unpack_bipolar(packed, 4096), vectors)
+
+    sims = hamming_similarity(packed[0], packed, 4096)
+    cos = vectors @ vectors[0] / 4096
+    assert np.allclose(sims, cos, atol=1e-6)
+
+
+def test_legacy_float_vectors_are_repacked():
+    rng = np.random.default_rng(4)
+    vec = random_bipolar(rng, 1)[0]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ltm.json")
+        legacy = {
+            "id": "old",
+            "timestamp": "2026-01-01T00:00:00",
+            "user_input": "hi",
+            "response": "hello",
+            "vector": base64.b64encode(vec.tobytes()).decode("ascii"),
+            "importance": 0.5,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump([legacy], f)
+
+        hippocampus = Hippocampus()
+        assert hippocampus.recall(vec, path, top_k=1)[0][0]["id"] == "old"
+
+        # 512 bytes のパック形式で保持される
+        hippocampus.save_memory(vec, "again", "hello", path)
+        stored = hippocampus.load_memories(path)
+        assert [m["user_input"] for m in stored] == ["hi", "again"]
+        assert all(len(base64.b64decode(m["vector"])) == 512 for m in stored)
+        hippocampus.close()
+
+
+def test_approximate_search_finds_similar_memories():
+    rng = np.random.default_rng(3)
+    vectors = random_bipolar(rng, 3000)
+    index = LTMIndex(ann_min_size=1000, ann_merge_rows=256)
+    index.extend(
+        [{"id": str(i)} for i in range(3000)],
+        pack_bipolar(vectors),
+        np.ones(3000, dtype=bool),
+    )
+
+    def noisy(vec, similarity):
+        flip = rng.random(vec.shape) < (1 - similarity) / 2
+        return np.where(flip, -vec, vec)
+
+    for i in (5, 1234, 2999):
+        query = noisy(vectors[i], 0.8)
+        approx = index.search(query, top_k=3, similarity_threshold=0.3)
+        exact = index.search(query, top_k=3, similarity_threshold=0.3, exact=True)
+        assert approx == exact and approx[0][0]["id"] == str(i)
+    assert index._lsh is not None and index._lsh.n_indexed == 3000
+
+    # 追加した記憶は、LSH へのマージ前 (末尾の全件比較) でも後でも想起できる
+    new_vectors = random_bipolar(rng, 300)
+    for j, vec in enumerate(new_vectors):
+        index.add({"id": f"new{j}"}, vec)
+        if j == 10:
+            assert index.search(noisy(vec, 0.8), top_k=1)[0][0]["id"] == "new10"
+    assert index.search(noisy(new_vectors[299], 0.8), top_k=1)[0][0]["id"] == "new299"
+    assert index._lsh.n_indexed == 3300
+
+    # 削除した行はバケットから抜き、後ろの行番号を詰める (作り直さない)
+    lsh = index._lsh
+    index.remove(["5"])
+    assert index._lsh is lsh and lsh.n_indexed == 3299
+    assert index.search(noisy(vectors[1234], 0.8), top_k=1)[0][0]["id"] == "1234"
+    assert all(r[0]["id"] != "5" for r in index.search(vectors[5], top_k=3))
+
+
+def test_lsh_removal_matches_a_fresh_build():
+    rng = np.random.default_rng(7)
+    vectors = random_bipolar(rng, 600)
+    index = LTMIndex(ann_min_size=100, ann_merge_rows=50)
+    for i, vec in enumerate(vectors[:500]):
+        index.add({"id": str(i)}, vec)
+    index.search(vectors[0], top_k=1)  # 500 行で LSH を作る
+    for i, vec in enumerate(vectors[500:], start=500):
+        index.add({"id": str(i)}, vec)  # 未マージの末尾の行
+
+    gone = {str(i) for i in range(0, 600, 7)}
+    index.remove(gone)
+    kept = [i for i in range(600) if str(i) not in gone]
+
+    # 残った行の LSH は、詰め直した行から作り直したものと同じになる
+    n = index._lsh.n_indexed
+    assert n == len([i for i in kept if i < 500])
+    rebuilt = BitSamplingLSH(index.hdc_dim)
+    rebuilt.insert(index.packed[:n])
+    assert np.array_equal(index._lsh._entries, rebuilt._entries)
+    assert np.array_equal(index._lsh._directory, rebuilt._directory)
+    for i in kept[::25]:
+        assert index.search(vectors[i], top_k=1)[0][0]["id"] == str(i)
+
+
+if __name__ == "__main__":
+    test_search_matches_linear_scan()
+    test_remove_compacts_rows()
+    test_recall_uses_resident_index()
+    test_hamming_matches_cosine()
+    test_legacy_float_vectors_are_repacked()
+    test_approximate_search_finds_similar_memories()
+    test_lsh_removal_matches_a_fresh_build()
+    print("✅ LTM index tests passed")
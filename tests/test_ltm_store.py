@@ -0,0 +1,138 @@
+import sys
+import os
+import json
+import tempfile
+import threading
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from ltm_store import LTMStore
+from hippocampus import Hippocampus
+import numpy as np
+
+
+def make_records(n, start=0):
+    rng = np.random.default_rng(start)
+    records = [
+        {"id": f"m{i}", "timestamp": f"2026-01-01T00:00:{i:02d}", "importance": (i % 5) / 10}
+        for i in range(start, start + n)
+    ]
+    packed = rng.integers(0, 256, size=(n, 512), dtype=np.uint8)
+    return records, packed
+
+
+def test_append_and_reopen():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = LTMStore(os.path.join(tmp, "npc.ltm"))
+        store.open()
+        records, packed = make_records(5)
+        for r, p in zip(records, packed):
+            store.append(r, p)
+        store.append({"id": "broken"}, np.zeros(512, dtype=np.uint8), valid=False)
+        store.close()
+
+        loaded, loaded_packed, valid = LTMStore(os.path.join(tmp, "npc.ltm")).open()
+        assert [r["id"] for r in loaded] == [r["id"] for r in records] + ["broken"]
+        assert np.array_equal(loaded_packed[:5], packed)
+        assert valid.tolist() == [True] * 5 + [False]
+
+
+def test_torn_tail_is_truncated():
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "npc.ltm")
+        store = LTMStore(directory)
+        store.open()
+        records, packed = make_records(3)
+        store.append_many(records, packed)
+
+        # クラッシュを模擬: ベクトルだけ書かれた行と、途中で切れたメタデータ行
+        store._vec_file.write(packed[0].tobytes())
+        store._vec_file.flush()
+        store._meta_file.write(b'{"id": "torn", "timest')
+        store._meta_file.flush()
+
+        reopened = LTMStore(directory)
+        loaded, loaded_packed, _ = reopened.open()
+        assert [r["id"] for r in loaded] == ["m0", "m1", "m2"]
+        assert loaded_packed.shape == (3, 512)
+
+        # 復旧後の追記は正しい位置に続く
+        extra, extra_packed = make_records(1, start=9)
+        reopened.append(extra[0], extra_packed[0])
+        reopened.close()
+        loaded, loaded_packed, _ = LTMStore(directory).open()
+        assert [r["id"] for r in loaded] == ["m0", "m1", "m2", "m9"]
+        assert np.array_equal(loaded_packed[3], extra_packed[0])
+
+
+def test_compaction_applies_eviction_policy():
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "npc.ltm")
+        evicted_ids = []
+        store = LTMStore(directory, max_memories=4, compact_slack=10.0, on_compact=evicted_ids.extend)
+        store.open()
+        records, packed = make_records(10)
+        store.append_many(records, packed)
+
+        evicted = store.compact()
+        assert len(evicted) == 6 and evicted == evicted_ids
+        store.close()
+
+        with open(os.path.join(directory, "MANIFEST.json")) as f:
+            assert json.load(f)["generation"] == 1
+        loaded, loaded_packed, _ = LTMStore(directory).open()
+        # 重要度 0.4, 0.3 の記憶 (m4, m9, m3, m8) が残る
+        assert sorted(r["id"] for r in loaded) == ["m3", "m4", "m8", "m9"]
+        for r, p in zip(loaded, loaded_packed):
+            assert np.array_equal(p, packed[int(r["id"][1:])])
+        assert sorted(os.listdir(directory)) == ["MANIFEST.json", "meta.1.jsonl", "vectors.1.bin"]
+
+
+def test_appends_during_compaction_are_not_blocked():
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "npc.ltm")
+        store = LTMStore(directory, max_memories=4, compact_slack=10.0)
+        store.open()
+        records, packed = make_records(10)
+        store.append_many(records, packed)
+        late, late_packed = make_records(2, start=20)
+
+        # 書き直しの途中 (生き残りを選んでいる間) に別スレッドから追記する
+        select = store._select_survivors
+
+        def select_while_appending(rows):
+            writer = threading.Thread(target=store.append_many, args=(late, late_packed))
+            writer.start()
+            writer.join(timeout=5)
+            assert not writer.is_alive()  # ロックを持ったまま書き直していない
+            return select(rows)
+
+        store._select_survivors = select_while_appending
+        assert len(store.compact()) == 6
+        assert store.n_rows == 6
+        store.close()
+
+        loaded, loaded_packed, _ = LTMStore(directory).open()
+        # 途中で追記された記憶も新しい世代の末尾に残る
+        assert [r["id"] for r in loaded][-2:] == ["m20", "m21"]
+        assert np.array_equal(loaded_packed[-2:], late_packed)
+
+
+def test_background_compaction_updates_index():
+    rng = np.random.default_rng(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ltm.json")
+        hippocampus = Hippocampus(max_memories=5)
+        for i in range(7):
+            vec = np.where(rng.random(4096) < 0.5, 1.0, -1.0)
+            hippocampus.save_memory(vec, f"in{i}", "out", path, importance=i / 10)
+        hippocampus._stores[path]._compactor.join()
+        assert len(hippocampus.index_for(path)) == 5
+        hippocampus.close()
+
+
+if __name__ == "__main__":
+    test_append_and_reopen()
+    test_torn_tail_is_truncated()
+    test_compaction_applies_eviction_policy()
+    test_appends_during_compaction_are_not_blocked()
+    test_background_compaction_updates_index()
+    print("✅ LTM store tests passed")
@@ -0,0 +1,189 @@
+import sys
+import os
+import signal
+import threading
+import time
+import numpy as np
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+pytest.importorskip("sentence_transformers")
+from memory_cortex import MemoryCortex, ProcessMemoryCortex
+
+
+class CountingEmbedder:
+    """encode の呼び出しごとのバッチを記録する (ベクトルは文字数)"""
+
+    def __init__(self, gate=None):
+        self.batches = []
+        self.gate = gate
+
+    def encode(self, texts, batch_size=None):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.batches.append(list(texts))
+        return np.array([[len(t)] * 4 for t in texts], dtype=np.float32)
+
+
+class ScriptedMemoryCortex(MemoryCortex):
+    """SentenceTransformer を読み込まずに CountingEmbedder を使う"""
+
+    def __init__(self, embedder, **kwargs):
+        super().__init__(**kwargs)
+        self.fake = embedder
+
+    def _load_model(self):
+        return self.fake
+
+
+def test_requests_are_micro_batched():
+    gate = threading.Event()
+    embedder = CountingEmbedder(gate)
+    memory = ScriptedMemoryCortex(embedder, max_batch=3, max_wait_ms=200)
+    memory.start()
+    first = memory.memorize("a")
+    while memory.input_queue.qsize():  # 最初の依頼が取り出されるまで待つ
+        time.sleep(0.001)
+    # ワーカーが最初のバッチを集めている間に届いた依頼は、同じ encode にまとめられる
+    futures = [first] + [memory.memorize(t) for t in ("bb", "ccc", "dddd", "eeeee")]
+    gate.set()
+
+    vectors = [f.result(timeout=5) for f in futures]
+    assert [int(v[0]) for v in vectors] == [1, 2, 3, 4, 5]
+    assert [len(b) for b in embedder.batches] == [3, 2]
+    memory.stop(wait=True, timeout=5)
+
+
+def test_futures_callbacks_and_output_queue():
+    seen = []
+    memory = ScriptedMemoryCortex(CountingEmbedder(), max_wait_ms=0)
+    memory.start()
+    with_callback = memory.memorize("hello", callback=lambda t, v: seen.append(t))
+    collected = memory.memorize("hi")
+    assert with_callback.result(timeout=5)[0] == 5
+    assert collected.result(timeout=5)[0] == 2
+    memory.stop(wait=True, timeout=5)
+
+    # コールバックを渡した結果は output_queue に入らない
+    assert seen == ["hello"]
+    text, vector = memory.retrieve_memories()
+    assert text == "hi" and vector[0] == 2
+    assert memory.retrieve_memories() is None
+
+
+def test_stop_finishes_accepted_requests_and_rejects_new_ones():
+    gate = threading.Event()
+    memory = ScriptedMemoryCortex(CountingEmbedder(gate), max_batch=1, max_wait_ms=0)
+    memory.start()
+    accepted = [memory.memorize(t) for t in ("a", "bb", "ccc")]
+
+    # 既定では終了を待たない (ワーカーはまだ encode で止まっている)
+    started = time.monotonic()
+    memory.stop()
+    assert time.monotonic() - started < 1.0
+    assert memory.is_alive()
+
+    # 停止の合図より後ろには並ばない: すぐに失敗する
+    late = memory.memorize("late")
+    with pytest.raises(RuntimeError):
+        late.result(timeout=1)
+
+    gate.set()
+    memory.join(5)
+    assert not memory.is_alive()
+    assert [int(f.result(timeout=0)[0]) for f in accepted] == [1, 2, 3]
+
+
+def test_memorize_racing_stop_never_hangs():
+    memory = ScriptedMemoryCortex(CountingEmbedder(), max_wait_ms=0)
+    memory.start()
+    futures = []
+
+    def submit():
+        for i in range(200):
+            futures.append(memory.memorize(str(i)))
+
+    producer = threading.Thread(target=submit)
+    producer.start()
+    memory.stop()
+    producer.join()
+    memory.join(5)
+
+    # 受け付けられた依頼はベクトルに、停止後の依頼はエラーになる (宙に浮くものは無い)
+    for future in futures:
+        assert future.done()
+
+
+def test_model_load_failure_fails_pending_requests():
+    class BrokenMemoryCortex(MemoryCortex):
+        def _load_model(self):
+            raise OSError("no such model")
+
+    memory = BrokenMemoryCortex()
+    pending = memory.memorize("queued before start")
+    memory.start()
+    memory.join(5)
+    with pytest.raises(OSError):
+        pending.result(timeout=0)
+    with pytest.raises(RuntimeError):
+        memory.memorize("after failure").result(timeout=0)
+
+
+def test_process_cortex_encodes_through_shared_memory():
+    memory = ProcessMemoryCortex(n_workers=2, n_slots=4, max_wait_ms=0)
+    memory.start()
+    try:
+        futures = [memory.memorize(f"text {i}") for i in range(10)]
+        vectors = [f.result(timeout=120) for f in futures]
+        assert all(v.shape == (memory.dim,) for v in vectors)
+        assert sum(1 for _ in iter(memory.retrieve_memories, None)) == 10
+    finally:
+        memory.stop(timeout=10)
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGSTOP"), reason="needs POSIX signals")
+def test_process_cortex_fails_requests_of_a_dead_worker():
+    memory = ProcessMemoryCortex(n_workers=2, n_slots=4, max_wait_ms=0)
+    memory.start()
+    try:
+        # 依頼は順番に振り分けられるので、2件終われば両方のワーカーがモデルを読み込み済み
+        for future in [memory.memorize("warm"), memory.memorize("up")]:
+            future.result(timeout=120)
+        os.kill(memory._workers[0].pid, signal.SIGSTOP)
+        futures = [memory.memorize(f"text {i}") for i in range(4)]
+        memory._workers[0].kill()
+
+        # 落ちたワーカーに振り分けた依頼は失敗し、残りは生きているワーカーが処理する
+        assert isinstance(futures[0].exception(timeout=10), RuntimeError)
+        assert isinstance(futures[2].exception(timeout=10), RuntimeError)
+        assert futures[1].result(timeout=10).shape == (memory.dim,)
+        assert futures[3].result(timeout=10).shape == (memory.dim,)
+        assert memory.running
+        assert memory.memorize("after").result(timeout=10).shape == (memory.dim,)
+    finally:
+        memory.stop(timeout=10)
+
+
+def test_process_cortex_memorize_fails_when_no_worker_is_alive():
+    memory = ProcessMemoryCortex(n_workers=1, n_slots=2, max_wait_ms=0)
+    memory.start()
+    try:
+        memory._workers[0].kill()
+        # スロット数を超えて依頼しても、空きを待ったまま止まらない
+        futures = [memory.memorize(f"text {i}") for i in range(4)]
+        for future in futures:
+            assert isinstance(future.exception(timeout=10), RuntimeError)
+        assert not memory.running
+    finally:
+        memory.stop(timeout=10)
+
+
+if __name__ == "__main__":
+    test_requests_are_micro_batched()
+    test_futures_callbacks_and_output_queue()
+    test_stop_finishes_accepted_requests_and_rejects_new_ones()
+    test_memorize_racing_stop_never_hangs()
+    test_model_load_failure_fails_pending_requests()
+    test_process_cortex_encodes_through_shared_memory()
+    test_process_cortex_fails_requests_of_a_dead_worker()
+    test_process_cortex_memorize_fails_when_no_worker_is_alive()
+    print("✅ Memory cortex tests passed")
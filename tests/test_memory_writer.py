@@ -0,0 +1,55 @@
+import sys
+import os
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from hippocampus import Hippocampus
+from memory_writer import MemoryWriter
+import numpy as np
+
+
+def test_background_writes_are_batched_per_file():
+    with tempfile.TemporaryDirectory() as tmp:
+        hippo = Hippocampus()
+        files = [os.path.join(tmp, f"npc{i}.mem") for i in range(3)]
+        for path in files:
+            hippo.index_for(path)
+        writer = MemoryWriter(hippo, max_queue=8, max_batch=16)
+        writer.start()
+
+        rng = np.random.default_rng(0)
+        expected = {path: [] for path in files}
+        for i in range(30):
+            path = files[i % 3]
+            thought_sum = rng.normal(size=hippo.hdc_dim).astype(np.float32)
+            memory_id = writer.submit(thought_sum, f"q{i}", f"a{i}", path, importance=0.5)
+            expected[path].append((memory_id, np.packbits(thought_sum >= 0)))
+        writer.close()
+
+        for path in files:
+            memories = hippo.load_memories(path)
+            assert [m["id"] for m in memories] == [mid for mid, _ in expected[path]]
+            # 重ね合わせは符号で二値化されて保存される
+            for memory, (_, vector) in zip(memories, expected[path]):
+                assert np.array_equal(hippo._decode_vector(memory["vector"]), vector)
+
+        # 再起動後もストアから読める
+        hippo.close()
+        assert len(Hippocampus().load_memories(files[0])) == 10
+
+
+def test_write_to_closed_file_does_not_leak_index():
+    with tempfile.TemporaryDirectory() as tmp:
+        hippo = Hippocampus()
+        path = os.path.join(tmp, "evicted.mem")
+        # ライターが動いていなければ呼び出し元で直接書く
+        writer = MemoryWriter(hippo)
+        memory_id = writer.submit(np.ones(hippo.hdc_dim), "hi", "hello", path)
+        assert hippo.loaded_index(path) is None
+        memories = hippo.load_memories(path)
+        assert memories[0]["id"] == memory_id
+
+
+if __name__ == "__main__":
+    test_background_writes_are_batched_per_file()
+    test_write_to_closed_file_does_not_leak_index()
+    print("✅ Memory writer tests passed")
@@ -0,0 +1,57 @@
+import sys
+import os
+import tempfile
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+import metrics
+from hippocampus import Hippocampus
+
+
+def test_histogram_renders_prometheus_text():
+    hist = metrics.Histogram("t_seconds", "Test.", label="stage", buckets=(0.001, 0.01))
+    for seconds in (0.0005, 0.005, 0.005, 1.0):
+        hist.observe("decode", seconds)
+    lines = hist.render()
+    assert lines[:2] == ["# HELP t_seconds Test.", "# TYPE t_seconds histogram"]
+    # バケットは累積で、+Inf は全件
+    assert 't_seconds_bucket{stage="decode",le="0.001"} 1' in lines
+    assert 't_seconds_bucket{stage="decode",le="0.01"} 3' in lines
+    assert 't_seconds_bucket{stage="decode",le="+Inf"} 4' in lines
+    assert 't_seconds_count{stage="decode"} 4' in lines
+    assert 't_seconds_sum{stage="decode"} 1.0105' in lines
+
+
+def test_stage_feeds_histogram_and_request_breakdown():
+    timings = metrics.StageTimings()
+    before = metrics.STAGE_SECONDS.count(metrics.RECALL)
+    for _ in range(2):
+        with metrics.stage(metrics.RECALL, timings):
+            pass
+    metrics.observe(metrics.PREFILL, 0.25, timings)
+    assert metrics.STAGE_SECONDS.count(metrics.RECALL) == before + 2
+
+    breakdown = timings.as_dict()
+    assert breakdown[metrics.RECALL]["count"] == 2
+    assert breakdown[metrics.PREFILL] == {"ms": 250.0, "count": 1}
+
+    metrics.gauge("t_queue_depth", "Test gauge.", lambda: 3)
+    metrics.gauge("t_broken", "Never rendered.", lambda: 1 / 0)
+    text = metrics.render()
+    assert "t_queue_depth 3\n" in text and "t_broken" not in text
+    assert 'cortex_stage_seconds_count{stage="recall"}' in text
+
+
+def test_save_memory_is_timed():
+    hippo = Hippocampus(hdc_dim=256)
+    before = metrics.STAGE_SECONDS.count(metrics.SAVE_MEMORY)
+    with tempfile.TemporaryDirectory() as tmp:
+        hippo.save_memory(np.ones(256), "hi", "hello", os.path.join(tmp, "ltm.json"))
+        hippo.close()
+    assert metrics.STAGE_SECONDS.count(metrics.SAVE_MEMORY) == before + 1
+
+
+if __name__ == "__main__":
+    test_histogram_renders_prometheus_text()
+    test_stage_feeds_histogram_and_request_breakdown()
+    test_save_memory_is_timed()
+    print("✅ Metrics tests passed")
@@ -0,0 +1,87 @@
+import sys
+import os
+import tempfile
+import threading
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from prefix_cache import PrefixCache
+
+
+def test_snapshots_survive_restart():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = PrefixCache(tmp, model_id="qwen:1", max_entries=2)
+        key = cache.key([1, 2, 3])
+        cache.put(key, b"kv-state")
+        assert cache.get(key) == b"kv-state"
+
+        # 再起動後 (新しいインスタンス) もディスクから読める
+        restarted = PrefixCache(tmp, model_id="qwen:1", max_entries=2)
+        assert restarted.get(key) == b"kv-state"
+        assert restarted.hits == 1
+
+        # 別モデルのスナップショットとは一致しない
+        other = PrefixCache(tmp, model_id="qwen:2")
+        assert other.key([1, 2, 3]) != key
+        assert other.get(other.key([1, 2, 3])) is None
+        assert other.misses == 1
+
+
+def test_cache_is_bounded():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = PrefixCache(tmp, model_id="m", max_entries=2, max_disk_mb=2.5 / 1024)
+        keys = [cache.key([i]) for i in range(4)]
+        for i, key in enumerate(keys):
+            cache.put(key, bytes([i]) * 1024)
+            # mtime の分解能に依存しないよう、古い順に並べておく
+            os.utime(os.path.join(tmp, f"{key}.kv"), (i, i))
+
+        assert len(cache._entries) == 2
+        assert list(cache._entries) == keys[2:]
+        # ディスク上は 2.5KB 以内 (古いものから削除)
+        files = sorted(os.listdir(tmp))
+        assert files == sorted(f"{k}.kv" for k in keys[2:])
+
+
+def test_background_writer_keeps_put_off_the_disk():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = PrefixCache(tmp, model_id="m", max_pending_writes=1)
+        writing, release = threading.Event(), threading.Event()
+        write = cache._write
+
+        def slow_write(key, state):
+            writing.set()
+            release.wait(5)
+            write(key, state)
+
+        cache._write = slow_write
+        cache.start()
+        first, second, third = (cache.key([i]) for i in range(3))
+        cache.put(first, b"1")  # ライターが書き出し中
+        assert writing.wait(5)
+        cache.put(second, b"2")  # キューで待つ
+        cache.put(third, b"3")  # キューが一杯: ディスクには書かない
+        # put はディスクを待たず、メモリ上のエントリはすぐに使える
+        assert cache.get(third) == b"3"
+        assert not os.path.exists(os.path.join(tmp, f"{first}.kv"))
+
+        release.set()
+        cache.close()
+        assert os.path.exists(os.path.join(tmp, f"{first}.kv"))
+        assert os.path.exists(os.path.join(tmp, f"{second}.kv"))
+        assert not os.path.exists(os.path.join(tmp, f"{third}.kv"))
+        assert PrefixCache(tmp, model_id="m").get(second) == b"2"
+
+
+def test_memory_only():
+    cache = PrefixCache(None, model_id="m", max_entries=1)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") is None
+    assert cache.get("b") == b"2"
+
+
+if __name__ == "__main__":
+    test_snapshots_survive_restart()
+    test_cache_is_bounded()
+    test_background_writer_keeps_put_off_the_disk()
+    test_memory_only()
+    print("✅ Prefix cache tests passed")
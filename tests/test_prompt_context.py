@@ -0,0 +1,86 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from cortex_llm import MonolithicCortex
+from prompt_context import PromptContext, as_snapshot, diff_segments
+
+
+def test_context_is_canonical_and_versioned():
+    a = PromptContext(fast_keys=("time",))
+    a.update({"weather": "rain", "location": "Castle", "time": "night"})
+    b = PromptContext(fast_keys=("time",))
+    b.update({"time": "night", "location": "Castle"})
+    b["weather"] = "rain"
+    # 注入の順番によらず同じ内容になる
+    assert a.snapshot().world == b.snapshot().world == (
+        ("location", "Castle"),
+        ("weather", "rain"),
+    )
+    assert a.snapshot().status == (("time", "night"),)
+
+    # 同じ値の再注入では version は変わらない (dict はキー順も正規化)
+    version = a.version
+    a.update({"location": "Castle", "party": {"b": 2, "a": 1}})
+    a.update({"party": {"a": 1, "b": 2}})
+    assert a.version == version + 1
+    assert ("party", '{"a": 1, "b": 2}') in a.snapshot().world
+    assert a == {"location": "Castle", "party": {"a": 1, "b": 2}, "time": "night", "weather": "rain"}
+
+    a.clear()
+    assert a == {} and a.version == version + 2
+
+
+def test_volatile_keys_move_to_the_tail():
+    context = PromptContext(fast_keys=(), volatile_after=2)
+    context["location"] = "Castle"
+    for hp in (100, 90):
+        context["player_hp"] = hp
+    assert ("player_hp", "90") in context.snapshot().world
+    context["player_hp"] = 80  # 2回変わったので末尾寄りへ
+    snapshot = context.snapshot()
+    assert snapshot.world == (("location", "Castle"),)
+    assert snapshot.status == (("player_hp", "80"),)
+
+    # 消して入れ直したキーは、変化の回数を数え直す (世界の状態に戻る)
+    del context["player_hp"]
+    context["player_hp"] = 70
+    assert ("player_hp", "70") in context.snapshot().world
+
+
+def test_only_the_tail_changes_between_turns():
+    cortex = MonolithicCortex.__new__(MonolithicCortex)
+    cortex.system_prompt = "You are Lydia."
+    context = PromptContext(fast_keys=("time",))
+    context.update({"location": "Whiterun", "time": "noon"})
+
+    first = cortex.prompt_segments("Hello", context.snapshot())
+    diff = diff_segments(None, first)
+    assert diff.changed == [name for name, _ in first] and diff.reused_chars == 0
+
+    context["time"] = "dusk"
+    second = cortex.prompt_segments(
+        "Any news?", context.snapshot(history="\n[Recent Conversation]\n- Player: Hello\n")
+    )
+    diff = diff_segments(diff.digests, second)
+    assert diff.changed == ["history", "status", "turn"]
+    assert diff.reused_chars == len(first[0][1]) + len(first[1][1])
+
+    # ペルソナ + 世界の状態は会話履歴があってもプレフィックスとして使える
+    prompt = cortex.build_prompt("Any news?", context.snapshot(history="x"))
+    prefixes = cortex.prompt_prefixes(context.snapshot(history="x"))
+    assert len(prefixes) == 2 and all(prompt.startswith(p) for p in prefixes)
+    assert prompt.index("location=Whiterun") < prompt.index("time=dusk")
+
+    # 従来の dict 形式のコンテキストも同じ形で組み立てる
+    legacy = {"time": "dusk", "location": "Whiterun", "conversation_history": "x"}
+    assert as_snapshot(legacy).world == context.snapshot().world
+    assert cortex.build_prompt("Hi", legacy) == cortex.build_prompt(
+        "Hi", context.snapshot(history="x")
+    )
+
+
+if __name__ == "__main__":
+    test_context_is_canonical_and_versioned()
+    test_volatile_keys_move_to_the_tail()
+    test_only_the_tail_changes_between_turns()
+    print("✅ Prompt context tests passed")
@@ -0,0 +1,126 @@
+import sys
+import os
+import threading
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from cortex_llm import MonolithicCortex
+from scheduler import InferenceScheduler, SchedulerBusy
+from tiny_model import tiny_model_path
+
+PERSONA = "you is the hello " * 10
+PROMPTS = [f"hello {c}" for c in "abcde"]
+
+_cortex = None
+
+
+def tiny_cortex():
+    global _cortex
+    if _cortex is None:
+        _cortex = MonolithicCortex(model_path=tiny_model_path(), system_prompt=PERSONA, n_ctx=1024)
+    return _cortex
+
+
+def promptless_cortex():
+    """プロンプトの組み立てだけができる (モデルを読み込まない) cortex"""
+    cortex = MonolithicCortex.__new__(MonolithicCortex)
+    cortex.system_prompt = PERSONA
+    return cortex
+
+
+def run_all(scheduler, prompts, parallel, **params):
+    results = {}
+
+    def run(i):
+        job = scheduler.submit(prompts[i], {"location": "x"}, **params)
+        results[i] = ("".join(t for t, _, _ in job), job.finish_reason)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+        if not parallel:
+            thread.join()
+    for thread in threads:
+        thread.join()
+    return [results[i] for i in range(len(prompts))]
+
+
+def batched_scheduler(max_concurrency):
+    scheduler = InferenceScheduler(tiny_cortex(), max_concurrency=max_concurrency, seq_ctx=512, n_batch=64, seed=0)
+    scheduler.start()
+    if not scheduler.batched:
+        scheduler.stop()
+        pytest.skip("llama.cpp multi-sequence batching is unavailable")
+    return scheduler
+
+
+def test_batched_greedy_output_matches_one_at_a_time():
+    params = dict(max_tokens=10, temperature=0.0)
+    scheduler = batched_scheduler(max_concurrency=3)
+    try:
+        together = run_all(scheduler, PROMPTS, parallel=True, **params)
+        alone = run_all(scheduler, PROMPTS, parallel=False, **params)
+    finally:
+        scheduler.stop()
+    assert together == alone
+    assert all(reason in ("stop", "length") for _, reason in together)
+
+
+def test_stop_strings_and_max_tokens_end_a_sequence():
+    scheduler = batched_scheduler(max_concurrency=2)
+    try:
+        job = scheduler.submit("hello a", None, max_tokens=5, temperature=0.0, stop=[])
+        tokens = list(job)
+        full = "".join(t for t, _, _ in tokens)
+        if job.finish_reason == "stop":
+            pytest.skip("the tiny model produced EOS before max_tokens")
+        assert job.finish_reason == "length" and len(tokens) <= 5
+
+        # 生成されるはずの文字列の途中を stop にすると、その手前で止まる
+        stop = full.strip()[1:3]
+        assert len(stop) == 2
+        job = scheduler.submit("hello a", None, max_tokens=5, temperature=0.0, stop=[stop])
+        assert "".join(t for t, _, _ in job) == full[: full.find(stop)]
+        assert job.finish_reason == "stop"
+    finally:
+        scheduler.stop()
+
+
+def test_cancelling_a_waiting_job_finishes_it():
+    # スケジューラが動いていない = 全てのジョブがキューで待っている
+    scheduler = InferenceScheduler(promptless_cortex(), max_queue_depth=4)
+    job = scheduler.submit("hello", None)
+    # プロンプトはセグメントを1回だけ組み立てたもの (差分の記録にも使う)
+    assert job.prompt == "".join(text for _, text in job.segments)
+    assert job.prefixes == promptless_cortex().prompt_prefixes(None)
+    job.cancel()
+    assert list(job) == [] and job.finish_reason == "cancelled"
+    assert not job.claim()  # キューから取り出されても、デコードはされない
+
+
+def test_full_queue_is_rejected():
+    scheduler = InferenceScheduler(promptless_cortex(), max_queue_depth=3)
+    accepted, rejected = [], []
+    barrier = threading.Barrier(8)
+
+    def submit():
+        barrier.wait()
+        try:
+            accepted.append(scheduler.submit("hello", None))
+        except SchedulerBusy:
+            rejected.append(True)
+
+    threads = [threading.Thread(target=submit) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(accepted) == 3 and len(rejected) == 5
+    assert scheduler.queue_depth == 3
+
+
+if __name__ == "__main__":
+    test_batched_greedy_output_matches_one_at_a_time()
+    test_stop_strings_and_max_tokens_end_a_sequence()
+    test_cancelling_a_waiting_job_finishes_it()
+    test_full_queue_is_rejected()
+    print("✅ Scheduler tests passed")
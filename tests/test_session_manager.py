@@ -0,0 +1,119 @@
+import sys
+import os
+import tempfile
+import threading
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from hippocampus import Hippocampus
+from session_manager import SessionManager
+import numpy as np
+
+
+def test_sessions_are_isolated():
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = SessionManager(Hippocampus(), tmp, max_stm_size=2)
+        with manager.session("Lydia") as lydia:
+            lydia.context["location"] = "Whiterun"
+            for i in range(3):
+                lydia.remember_turn("Dragonborn", f"hello {i}", f"reply {i}")
+        with manager.session("Villager_A") as villager:
+            assert villager.context == {}
+            assert villager.stm_context() == ""
+
+        with manager.session("Lydia") as lydia:
+            # STM は直近2往復だけを保持する
+            assert len(lydia.history) == 4
+            assert "hello 0" not in lydia.stm_context()
+            assert lydia.ltm_file.startswith(os.path.join(tmp, "npcs", "Lydia-"))
+        assert manager.ltm_file_for("default") == os.path.join(tmp, "ltm.json")
+        evil = manager.ltm_file_for("../evil npc")
+        assert os.path.dirname(evil) == os.path.join(tmp, "npcs")
+        assert os.path.basename(evil).startswith("___evil_npc-")
+
+
+def test_lru_eviction_flushes_ltm():
+    with tempfile.TemporaryDirectory() as tmp:
+        hippocampus = Hippocampus()
+        manager = SessionManager(hippocampus, tmp, max_sessions=2)
+        vec = np.ones(4096)
+        for npc in ("a", "b", "c"):
+            with manager.session(npc) as session:
+                hippocampus.save_memory(vec, "hi", npc, session.ltm_file)
+
+        # 最も古い "a" が破棄され、LTM も閉じられている
+        assert manager.peek("a") is None
+        assert manager.peek("c") is not None
+        assert hippocampus.loaded_index(manager.ltm_file_for("a")) is None
+
+        # 再び話しかけると遅延ロードされる
+        with manager.session("a") as session:
+            assert hippocampus.recall(vec, session.ltm_file)[0][0]["response"] == "a"
+        manager.close_all()
+
+
+def test_npc_stores_never_collide():
+    with tempfile.TemporaryDirectory() as tmp:
+        hippocampus = Hippocampus()
+        manager = SessionManager(hippocampus, tmp)
+        npc_ids = ["default", "ltm", "a/b", "a_b", "Lydia", "lydia", "a" * 60, "a" * 61]
+        stores = [hippocampus.store_path(manager.ltm_file_for(n)) for n in npc_ids]
+        # 大文字小文字を区別しないファイルシステム (Windows) でも別のストアになる
+        assert len({os.path.normcase(p).lower() for p in stores}) == len(npc_ids)
+
+        # "ltm" という NPC の記憶は、既定の NPC (ltm.json) の記憶と混ざらない
+        vec = np.ones(4096)
+        for npc in ("default", "ltm"):
+            with manager.session(npc) as session:
+                hippocampus.save_memory(vec, "hi", npc, session.ltm_file)
+        for npc in ("default", "ltm"):
+            with manager.session(npc) as session:
+                assert [m["response"] for m, _ in hippocampus.recall(vec, session.ltm_file)] == [npc]
+        manager.close_all()
+
+
+def test_ttl_skips_sessions_in_use():
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = SessionManager(Hippocampus(), tmp, ttl_seconds=0.0)
+        with manager.session("busy"):
+            time.sleep(0.01)
+            assert manager.enforce_budget() == []
+        assert manager.peek("busy") is None
+
+
+def test_inject_and_chat_share_the_session_lock():
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = SessionManager(Hippocampus(), tmp, max_stm_size=50)
+        with manager.session("Lydia") as lydia:
+            merged = lydia.inject({"location": "Whiterun"})
+            merged["location"] = "changed"  # 返り値はコピー
+            assert lydia.inject({"weather": "rain"}) == {
+                "location": "Whiterun",
+                "weather": "rain",
+            }
+
+            # 別スレッドの書き込みと並行して、プロンプト用のコピーを取れる
+            def chatter():
+                for i in range(2000):
+                    lydia.remember_turn("Dragonborn", f"hello {i}", "reply")
+                    lydia.inject({f"key{i % 50}": i})
+
+            writer = threading.Thread(target=chatter)
+            writer.start()
+            snapshots = 0
+            while writer.is_alive() or not snapshots:
+                assert ("location", "Whiterun") in lydia.prompt_context().world
+                snapshots += 1
+            writer.join()
+            assert "hello 1999" in lydia.prompt_context().history
+
+            lydia.reset()
+            assert lydia.context == {} and lydia.prompt_context().history == ""
+
+
+if __name__ == "__main__":
+    test_sessions_are_isolated()
+    test_lru_eviction_flushes_ltm()
+    test_npc_stores_never_collide()
+    test_ttl_skips_sessions_in_use()
+    test_inject_and_chat_share_the_session_lock()
+    print("✅ Session manager tests passed")
@@ -0,0 +1,77 @@
+"""
+A tiny random-weight llama GGUF for tests that need a real llama.cpp model.
+重みは乱数なので出力は意味を持たないが、決定的で数十ms で読み込める。
+gguf・llama_cpp が無い環境では、使うテストはスキップされる。
+"""
+import os
+import string
+import tempfile
+import numpy as np
+import pytest
+
+N_EMBD, N_FF, N_LAYER, N_HEAD = 64, 128, 2, 4
+
+_path = None
+
+
+def tiny_model_path():
+    """モデルを一時ディレクトリに1度だけ書き出し、そのパスを返す"""
+    global _path
+    pytest.importorskip("llama_cpp")
+    gguf = pytest.importorskip("gguf")
+    if _path is not None and os.path.exists(_path):
+        return _path
+
+    path = os.path.join(tempfile.mkdtemp(prefix="cortex-tiny-"), "tiny.gguf")
+    rng = np.random.default_rng(0)
+    writer = gguf.GGUFWriter(path, "llama")
+    tokens = ["<unk>", "<s>", "</s>", "<|im_start|>", "<|im_end|>"]
+    types = [2, 3, 3, 3, 3]
+    for b in range(256):
+        tokens.append(f"<0x{b:02X}>")
+        types.append(6)
+    words = ["▁" + c for c in string.ascii_lowercase] + list(string.ascii_lowercase)
+    words += ["▁the", "▁a", "▁is", "▁you", "▁I", "system", "user", "assistant", "▁hello", "\n"]
+    for word in words:
+        if word not in tokens:
+            tokens.append(word)
+            types.append(1)
+    scores = [len(t) - i / 100 if types[i] == 1 else 0.0 for i, t in enumerate(tokens)]
+
+    writer.add_context_length(4096)
+    writer.add_embedding_length(N_EMBD)
+    writer.add_block_count(N_LAYER)
+    writer.add_feed_forward_length(N_FF)
+    writer.add_head_count(N_HEAD)
+    writer.add_head_count_kv(N_HEAD)
+    writer.add_layer_norm_rms_eps(1e-5)
+    writer.add_rope_dimension_count(N_EMBD // N_HEAD)
+    writer.add_tokenizer_model("llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores(scores)
+    writer.add_token_types(types)
+    writer.add_bos_token_id(1)
+    writer.add_eos_token_id(2)
+    writer.add_unk_token_id(0)
+    writer.add_add_bos_token(False)
+
+    def weight(name, *shape):
+        writer.add_tensor(name, (rng.normal(size=shape) * 0.5).astype(np.float32))
+
+    weight("token_embd.weight", len(tokens), N_EMBD)
+    for i in range(N_LAYER):
+        writer.add_tensor(f"blk.{i}.attn_norm.weight", np.ones(N_EMBD, np.float32))
+        for name in ("attn_q", "attn_k", "attn_v", "attn_output"):
+            weight(f"blk.{i}.{name}.weight", N_EMBD, N_EMBD)
+        writer.add_tensor(f"blk.{i}.ffn_norm.weight", np.ones(N_EMBD, np.float32))
+        weight(f"blk.{i}.ffn_gate.weight", N_FF, N_EMBD)
+        weight(f"blk.{i}.ffn_up.weight", N_FF, N_EMBD)
+        weight(f"blk.{i}.ffn_down.weight", N_EMBD, N_FF)
+    writer.add_tensor("output_norm.weight", np.ones(N_EMBD, np.float32))
+    weight("output.weight", len(tokens), N_EMBD)
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+    _path = path
+    return path